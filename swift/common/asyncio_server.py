@@ -0,0 +1,747 @@
+"""
+An HTTP/1.1 server on asyncio for the proxy pipeline, chosen with
+``server_backend = asyncio``; see :func:`swift.common.wsgi.run_server`.
+
+The event loop does all of the socket work: it parses requests, keeps
+connections alive between them (pipelined requests wait their turn) and
+streams bodies both ways. The pipeline itself stays synchronous WSGI, so
+every request is run on a thread of a bounded executor,
+``executor_threads`` of them; further requests queue for a free thread.
+Bodies are never buffered whole. A request body is handed to the
+thread as it arrives, and reading from the client pauses while too much is
+waiting to be read. A response body goes out chunk by chunk, and the
+thread waits whenever the client is slow to take it.
+
+Responses with a Content-Length are sent as they are, others with chunked
+transfer encoding (or by closing the connection, for HTTP/1.0 clients).
+If a response body ends early, or raises after its first byte (as
+:mod:`swift.common.middleware.catch_errors` lets it), the connection is
+closed so the client cannot mistake it for a complete one.
+
+This needs Python 3. The green threads a request starts run on the hub
+of its executor thread, whenever that thread waits through eventlet.
+That hub is idle in between, so work that outlives requests, such as
+writing the access log, is run on daemon threads of its own instead (see
+:func:`swift.common.utils.use_background_threads`), and how late the hub
+runs says nothing of the worker's load: the lag the gatekeeper and
+healthcheck go by is measured here and handed to them as
+``swift.loop_lag`` (see :class:`AsyncioLoopLag`). Filters' shared state
+is locked, as several threads run requests at once.
+"""
+import asyncio
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import unquote
+
+from swift.common.utils import LoopLagMonitor, close_if_possible, \
+    monotonic, use_background_threads, worker_exiting
+from swift.common.wsgi import loadapp
+from swift.ipvl.inspect_custom import tracer
+
+MAX_HEADER_SIZE = 65536
+# request body bytes held for the app before reading from the client stops
+MAX_BUFFERED_INPUT = 262144
+
+_STATUS_ONLY = {
+    400: b'HTTP/1.1 400 Bad Request\r\n',
+    413: b'HTTP/1.1 413 Request Entity Too Large\r\n',
+    431: b'HTTP/1.1 431 Request Header Fields Too Large\r\n',
+    501: b'HTTP/1.1 501 Not Implemented\r\n',
+}
+_CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+# parser states
+_HEAD, _BODY, _CHUNK_SIZE, _CHUNK_DATA, _CHUNK_END, _TRAILERS = range(6)
+
+
+class BadRequest(Exception):
+
+    def __init__(self, status, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+
+
+class ClientDisconnected(IOError):
+    pass
+
+
+def parse_head(head):
+    """
+    Parses a request line and its headers, ``head`` being the bytes before
+    the blank line that ends them.
+
+    :returns: ``(method, target, version, headers)``, ``headers`` being a
+              list of ``(name, value)``
+    :raises BadRequest: if it is not HTTP/1.x
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise BadRequest(400, 'Bad request line')
+    if version not in ('HTTP/1.1', 'HTTP/1.0') or not method or \
+            not target:
+        raise BadRequest(400, 'Bad request line')
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep or not name or name[-1] in ' \t' or \
+                line[0] in ' \t':
+            raise BadRequest(400, 'Bad header line')
+        headers.append((name, value.strip()))
+    return method, target, version, headers
+
+
+class _Input(object):
+    """
+    The ``wsgi.input`` of a request. The event loop feeds it what arrives
+    and the app's thread blocks reading until there is enough.
+    """
+
+    def __init__(self, protocol, length, expect_continue):
+        self.protocol = protocol
+        self.length = length
+        self.expect_continue = expect_continue
+        self.cond = threading.Condition()
+        self.buf = bytearray()
+        self.complete = length == 0
+        self.discard = False
+        self.disconnected = False
+
+    # event loop side
+
+    def feed(self, data):
+        with self.cond:
+            if self.discard:
+                return
+            self.buf += data
+            if len(self.buf) > MAX_BUFFERED_INPUT:
+                self.protocol.pause_input()
+            self.cond.notify()
+
+    def feed_eof(self):
+        with self.cond:
+            self.complete = True
+            self.cond.notify()
+
+    def feed_disconnect(self):
+        with self.cond:
+            self.disconnected = True
+            self.cond.notify()
+
+    def drop(self):
+        """The response is done; whatever else the client sends is unread."""
+        with self.cond:
+            self.discard = True
+            del self.buf[:]
+
+    # app side
+
+    def _wait(self, ready):
+        if self.expect_continue:
+            self.expect_continue = False
+            self.protocol.send_continue()
+        while not ready():
+            if self.complete:
+                return
+            if self.disconnected:
+                raise ClientDisconnected('Client disconnected')
+            self.protocol.resume_input()
+            self.cond.wait()
+
+    def _take(self, size):
+        if size < 0 or size > len(self.buf):
+            size = len(self.buf)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        if len(self.buf) < MAX_BUFFERED_INPUT // 2:
+            self.protocol.resume_input()
+        return data
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        with self.cond:
+            if size < 0:
+                self._wait(lambda: False)
+            else:
+                self._wait(lambda: len(self.buf) >= size)
+            return self._take(size)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        with self.cond:
+            self._wait(lambda: b'\n' in self.buf or
+                       0 <= size <= len(self.buf))
+            end = self.buf.find(b'\n') + 1 or len(self.buf)
+            if 0 <= size < end:
+                end = size
+            return self._take(end)
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+class _Response(object):
+    """
+    Writes one response from the app's thread. The head waits to go out
+    with the first chunk of the body, so a small response is one write.
+    """
+
+    def __init__(self, protocol, method, version, keep_alive):
+        self.protocol = protocol
+        self.method = method
+        self.version = version
+        self.keep_alive = keep_alive
+        self.status = self.headers = None
+        self.head_sent = False
+        self.chunked = False
+        self.no_body = method == 'HEAD'
+        self.length = None
+        self.sent = 0
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.head_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def _head(self, body_size):
+        if self.status is None:
+            raise AssertionError('Body sent before start_response')
+        code = self.status[:3]
+        if code in ('204', '304') or code[0] == '1':
+            self.no_body = True
+        lines = ['%s %s' % (self.version, self.status)]
+        for name, value in self.headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                self.length = int(value)
+            elif lower == 'connection':
+                if value.lower() == 'close':
+                    self.keep_alive = False
+                continue
+            elif lower == 'transfer-encoding':
+                continue
+            lines.append('%s: %s' % (name, value))
+        if self.length is None and not self.no_body:
+            if body_size is not None:
+                # the whole body is in hand
+                self.length = body_size
+                lines.append('Content-Length: %d' % body_size)
+            elif self.version == 'HTTP/1.1':
+                self.chunked = True
+                lines.append('Transfer-Encoding: chunked')
+            else:
+                self.keep_alive = False
+        lines.append('Date: %s' % self.protocol.server.date())
+        if not self.keep_alive:
+            lines.append('Connection: close')
+        elif self.version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        self.head_sent = True
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def write(self, data, last=False):
+        if not isinstance(data, bytes):
+            data = data.encode('latin-1')
+        if not data and self.head_sent:
+            return
+        out = b''
+        if not self.head_sent:
+            out = self._head(len(data) if last else None)
+        if data and not self.no_body:
+            self.sent += len(data)
+            if self.chunked:
+                data = b'%x\r\n%s\r\n' % (len(data), data)
+            out += data
+        if out:
+            self.protocol.write_from_thread(out)
+
+    def finish(self):
+        """Ends the body, returning False if it is not complete."""
+        if not self.head_sent:
+            self.write(b'', last=True)
+        if self.chunked:
+            self.protocol.write_from_thread(b'0\r\n\r\n')
+        return self.no_body or self.length is None or \
+            self.sent == self.length
+
+
+class HttpProtocol(asyncio.Protocol):
+    """One client connection."""
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.buf = bytearray()
+        self.state = _HEAD
+        self.remaining = 0
+        self.input = None
+        self.busy = False
+        self.closed = False
+        self.reading_paused = False
+        self.writable = threading.Event()
+        self.writable.set()
+        self.idle_timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername') or ('', 0)
+        self.sockname = transport.get_extra_info('sockname') or ('', 0)
+        self.server.connections.add(self)
+        self._reset_idle_timer()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.server.connections.discard(self)
+        self.writable.set()
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        if self.input is not None:
+            self.input.feed_disconnect()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def _reset_idle_timer(self):
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        if not self.busy and self.server.client_timeout:
+            self.idle_timer = self.loop.call_later(
+                self.server.client_timeout, self.close)
+
+    def close(self):
+        if self.transport and not self.closed:
+            self.transport.close()
+            self.closed = True
+
+    # called from the app's thread
+
+    def write_from_thread(self, data):
+        # waits while the client is not keeping up
+        while not self.writable.wait(1):
+            pass
+        if self.closed:
+            raise ClientDisconnected('Client disconnected')
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def send_continue(self):
+        self.loop.call_soon_threadsafe(self._write, _CONTINUE)
+
+    def pause_input(self):
+        if not self.reading_paused:
+            self.reading_paused = True
+            self.loop.call_soon_threadsafe(self._set_reading, False)
+
+    def resume_input(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            self.loop.call_soon_threadsafe(self._set_reading, True)
+
+    # event loop side
+
+    def _write(self, data):
+        if not self.closed:
+            self.transport.write(data)
+
+    def _set_reading(self, reading):
+        if self.closed:
+            return
+        if reading and not (self.busy and self.state == _HEAD and
+                            len(self.buf) > MAX_HEADER_SIZE):
+            self.transport.resume_reading()
+        elif not reading:
+            self.transport.pause_reading()
+
+    def data_received(self, data):
+        self.buf += data
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        try:
+            self._parse()
+        except BadRequest as err:
+            self._reject(err)
+
+    def _reject(self, err):
+        self.server.logger.info('Bad request from %s: %s',
+                                self.peer[0], err)
+        if not self.busy:
+            self.transport.write(_STATUS_ONLY.get(err.status) +
+                                 b'Content-Length: 0\r\n'
+                                 b'Connection: close\r\n\r\n')
+        self.close()
+
+    def _parse(self):
+        buf = self.buf
+        while buf and not self.closed:
+            if self.state == _HEAD:
+                if self.busy:
+                    # a pipelined request waits for the one before it
+                    if len(buf) > MAX_HEADER_SIZE:
+                        self.transport.pause_reading()
+                    return
+                end = buf.find(b'\r\n\r\n')
+                if end < 0:
+                    if len(buf) > MAX_HEADER_SIZE:
+                        raise BadRequest(431, 'Headers too large')
+                    return
+                if end > MAX_HEADER_SIZE:
+                    raise BadRequest(431, 'Headers too large')
+                head = bytes(buf[:end])
+                del buf[:end + 4]
+                if not head:
+                    # stray CRLF between requests
+                    continue
+                self._start_request(head)
+            elif self.state == _BODY:
+                data = bytes(buf[:self.remaining])
+                del buf[:len(data)]
+                self.remaining -= len(data)
+                self.input.feed(data)
+                if not self.remaining:
+                    self.input.feed_eof()
+                    self.state = _HEAD
+            elif self.state in (_CHUNK_SIZE, _TRAILERS):
+                end = buf.find(b'\r\n')
+                if end < 0:
+                    if len(buf) > MAX_HEADER_SIZE:
+                        raise BadRequest(400, 'Bad chunk')
+                    return
+                line = bytes(buf[:end])
+                del buf[:end + 2]
+                if self.state == _TRAILERS:
+                    if not line:
+                        self.input.feed_eof()
+                        self.state = _HEAD
+                    continue
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise BadRequest(400, 'Bad chunk size')
+                if size < 0:
+                    raise BadRequest(400, 'Bad chunk size')
+                if size:
+                    self.remaining = size
+                    self.state = _CHUNK_DATA
+                else:
+                    self.state = _TRAILERS
+            elif self.state == _CHUNK_DATA:
+                data = bytes(buf[:self.remaining])
+                del buf[:len(data)]
+                self.remaining -= len(data)
+                self.input.feed(data)
+                if not self.remaining:
+                    self.state = _CHUNK_END
+            elif self.state == _CHUNK_END:
+                if len(buf) < 2:
+                    return
+                if buf[:2] != b'\r\n':
+                    raise BadRequest(400, 'Bad chunk')
+                del buf[:2]
+                self.state = _CHUNK_SIZE
+
+    def _start_request(self, head):
+        method, target, version, headers = parse_head(head)
+        env = self.server.base_env.copy()
+        path, _, query = target.partition('?')
+        if '://' in path:
+            # absolute-form target
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        env['REQUEST_METHOD'] = method
+        env['PATH_INFO'] = unquote(path, encoding='latin-1')
+        env['QUERY_STRING'] = query
+        env['RAW_PATH_INFO'] = path
+        env['SERVER_PROTOCOL'] = version
+        env['REMOTE_ADDR'] = self.peer[0]
+        env['REMOTE_PORT'] = str(self.peer[1])
+        env['SERVER_NAME'] = self.sockname[0]
+        env['SERVER_PORT'] = str(self.sockname[1])
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in env:
+                env[key] += ',' + value
+            else:
+                env[key] = value
+
+        connection = env.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+        if self.server.draining:
+            keep_alive = False
+        chunked = 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower()
+        if chunked:
+            length = None
+            env.pop('CONTENT_LENGTH', None)
+        else:
+            try:
+                length = int(env.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise BadRequest(400, 'Bad Content-Length')
+            if length < 0:
+                raise BadRequest(400, 'Bad Content-Length')
+        expect = env.get('HTTP_EXPECT', '').lower() == '100-continue' and \
+            version == 'HTTP/1.1' and (chunked or length)
+        self.input = _Input(self, length, expect)
+        env['wsgi.input'] = self.input
+        if chunked:
+            self.state = _CHUNK_SIZE
+        elif length:
+            self.state = _BODY
+            self.remaining = length
+        self.busy = True
+        self.server.in_flight += 1
+        response = _Response(self, method, version, keep_alive)
+        future = self.loop.run_in_executor(
+            self.server.executor, self.server.run_app, env, response,
+            monotonic())
+        future.add_done_callback(
+            lambda future, request_input=self.input:
+            self._request_done(future, request_input))
+
+    def _request_done(self, future, request_input):
+        self.server.in_flight -= 1
+        keep_alive = not future.exception() and future.result()
+        if not request_input.complete:
+            # the rest of the body is read and thrown away
+            request_input.drop()
+        self.busy = False
+        if self.closed:
+            pass
+        elif not keep_alive or self.server.draining:
+            self.close()
+        else:
+            if self.reading_paused or len(self.buf) > MAX_HEADER_SIZE:
+                self.reading_paused = False
+                self.transport.resume_reading()
+            try:
+                self._parse()
+            except BadRequest as err:
+                self._reject(err)
+            if not self.busy:
+                self._reset_idle_timer()
+        self.server.request_finished()
+
+
+class AsyncioLoopLag(LoopLagMonitor):
+    """
+    :class:`swift.common.utils.LoopLagMonitor` for this backend: it ticks
+    on the asyncio loop, and also keeps a smoothed time requests wait for
+    an executor thread. Its ``lag`` is the larger of the two, which is
+    about how long a request waits to be run once it has arrived.
+
+    :param backlogged: returns whether any request is waiting for a thread;
+                       each tick it does not counts as a wait of nothing,
+                       so the wait of a burst is forgotten once it is over
+    """
+
+    def __init__(self, loop, backlogged, interval=0.1, decay=0.8):
+        super(AsyncioLoopLag, self).__init__(interval, decay)
+        self.loop = loop
+        self.backlogged = backlogged
+        self.queued = 0.0
+
+    def start(self):
+        # on the loop's thread, as the server starts; filters calling it
+        # from executor threads find it started already
+        if self._thread is None:
+            self.last_tick = monotonic()
+            self._thread = self.loop.call_later(self.interval, self._next)
+
+    def _next(self):
+        self._tick(monotonic())
+        if not self.backlogged():
+            self.waited(0.0)
+        self._thread = self.loop.call_later(self.interval, self._next)
+
+    def waited(self, seconds):
+        """Counts a request that waited ``seconds`` for a thread."""
+        self.queued = self.decay * self.queued + (1 - self.decay) * seconds
+
+    @property
+    def lag(self):
+        return max(super(AsyncioLoopLag, self).lag, self.queued)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.cancel()
+            self._thread = None
+
+
+class AsyncioServer(object):
+    """The state shared by every connection of a worker."""
+
+    def __init__(self, app, loop, logger, conf):
+        self.app = app
+        self.loop = loop
+        self.logger = logger
+        threads = int(conf.get('executor_threads', 64))
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.client_timeout = float(conf.get('client_timeout', 60))
+        self.connections = set()
+        self.in_flight = 0
+        self.draining = False
+        self.loop_lag = AsyncioLoopLag(
+            loop, lambda: self.in_flight > threads,
+            float(conf.get('loop_lag_check_interval', 0.1)))
+        self.base_env = {
+            'SCRIPT_NAME': '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': int(conf.get('workers', 1)) > 1,
+            'wsgi.run_once': False,
+            'swift.loop_lag': self.loop_lag,
+        }
+        self._date = (0, '')
+
+    def date(self):
+        now = int(time.time())
+        if self._date[0] != now:
+            self._date = (now, formatdate(now, usegmt=True))
+        return self._date[1]
+
+    def run_app(self, env, response, queued_at):
+        """
+        Runs one request on an executor thread; returns whether its
+        connection can be kept alive.
+        """
+        self.loop_lag.waited(monotonic() - queued_at)
+        app_iter = None
+        try:
+            app_iter = self.app(env, response.start_response)
+            for chunk in app_iter:
+                response.write(chunk)
+            return response.finish() and response.keep_alive
+        except ClientDisconnected:
+            return False
+        except Exception:
+            self.logger.exception('ERROR in %s %s', env['REQUEST_METHOD'],
+                                  env['PATH_INFO'])
+            if not response.head_sent:
+                response.status = None
+                response.keep_alive = False
+                try:
+                    response.start_response('500 Internal Server Error', [
+                        ('Content-Type', 'text/plain'),
+                        ('Content-Length', '0')])
+                    response.finish()
+                except ClientDisconnected:
+                    pass
+            return False
+        finally:
+            close_if_possible(app_iter)
+
+    def request_finished(self):
+        if self.draining and not self.in_flight:
+            self.loop.stop()
+
+    def drain(self, timeout):
+        """Stops taking requests and stops the loop once the last is done."""
+        self.draining = True
+        for conn in list(self.connections):
+            if not conn.busy:
+                conn.close()
+        if not self.in_flight:
+            self.loop.stop()
+            return
+
+        def abandon_requests():
+            self.logger.warning('%d requests still running after %ss, '
+                                'dropping them', self.in_flight, timeout)
+            for conn in list(self.connections):
+                conn.close()
+            self.loop.stop()
+        self.loop.call_later(timeout, abandon_requests)
+
+
+def run_asyncio_server(conf, logger, sock, global_conf=None,
+                       reload_on_hup=False):
+    """
+    Serves the pipeline from ``conf['__file__']`` on ``sock``, like
+    :func:`swift.common.wsgi.run_server` does with eventlet, until SIGTERM
+    or SIGHUP has stopped it and the requests in flight have finished, or
+    ``graceful_shutdown_timeout`` has passed. With ``reload_on_hup``
+    SIGHUP loads the pipeline again instead.
+    """
+    use_background_threads()
+    app = loadapp(conf['__file__'], global_conf=global_conf)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = AsyncioServer(app, loop, logger, conf)
+    # eventlet.listen() hands back a green socket; asyncio wants the real one
+    sock = getattr(sock, 'fd', sock)
+    sock.setblocking(False)
+    listener = loop.run_until_complete(loop.create_server(
+        lambda: HttpProtocol(server), sock=sock,
+        backlog=int(conf.get('backlog', 4096))))
+    drain_timeout = float(conf.get('graceful_shutdown_timeout', 60))
+    server.loop_lag.start()
+
+    def stop_accepting():
+        loop.remove_signal_handler(signal.SIGTERM)
+        loop.remove_signal_handler(signal.SIGHUP)
+        listener.close()
+        server.drain(drain_timeout)
+
+    def app_reloaded(future):
+        try:
+            server.app = future.result()
+        except Exception as err:
+            logger.error('Reload failed, keeping the running pipeline: %s',
+                         err)
+        else:
+            logger.info('Reloaded %s', conf['__file__'])
+
+    def reload_app():
+        # off the loop, so connections are served while it loads
+        loop.run_in_executor(
+            server.executor, lambda: loadapp(conf['__file__'],
+                                             global_conf=global_conf)
+        ).add_done_callback(app_reloaded)
+
+    def dump_traces():
+        for line in tracer.dump():
+            logger.info('trace: %s', line)
+
+    loop.add_signal_handler(signal.SIGTERM, stop_accepting)
+    loop.add_signal_handler(signal.SIGHUP,
+                            reload_app if reload_on_hup else stop_accepting)
+    loop.add_signal_handler(signal.SIGUSR1, dump_traces)
+    try:
+        loop.run_forever()
+    finally:
+        listener.close()
+        server.executor.shutdown(wait=False)
+        loop.close()
+    worker_exiting()
@@ -0,0 +1,83 @@
+"""
+Pools of keep-alive HTTP connections to backend hosts, shared by the proxy
+and container sync.
+"""
+import socket
+import threading
+
+from eventlet import Timeout
+from eventlet.pools import Pool
+
+try:
+    from eventlet.green.httplib import HTTPConnection, HTTPSConnection
+except ImportError:
+    from eventlet.green.http.client import HTTPConnection, HTTPSConnection
+
+
+class HTTPConnPool(Pool):
+    """
+    Keep-alive connections to one host.
+
+    A connection taken with :meth:`get` goes back with ``put(conn)`` once
+    its response has been read to the end, or ``put(None)`` if it broke or
+    was closed part way, so the pool can make another in its place. When
+    :meth:`get` raises, nothing was taken and nothing goes back.
+
+    :param scheme: ``http`` or ``https``
+    :param netloc: ``host:port`` of the host
+    :param size: most connections kept open to it
+    :param conn_timeout: seconds allowed to connect
+    :param node_timeout: seconds allowed for each read from it
+    """
+
+    def __init__(self, scheme, netloc, size, conn_timeout, node_timeout):
+        Pool.__init__(self, max_size=size)
+        self.conn_class = HTTPSConnection if scheme == 'https' \
+            else HTTPConnection
+        self.netloc = netloc
+        self.conn_timeout = conn_timeout
+        self.node_timeout = node_timeout
+
+    def create(self):
+        conn = self.conn_class(self.netloc, timeout=self.node_timeout)
+        with Timeout(self.conn_timeout):
+            conn.connect()
+        # headers and body go in separate writes; without this the body
+        # waits on the host's delayed ACK of the headers
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def get(self):
+        conn = Pool.get(self)
+        if conn is None:
+            # the last one broke
+            try:
+                conn = self.create()
+            except BaseException:
+                # the slot stays free for the next try
+                self.put(None)
+                raise
+        return conn
+
+
+class PoolsByThread(object):
+    """
+    A pool per key, made by ``make_pool(key)`` when first asked for, and
+    per OS thread. A pool hands connections between green threads, and
+    those cannot wait on one another across OS threads, as they would when
+    the pipeline runs on the executor of the asyncio server backend. Under
+    eventlet there is only the one thread, so one pool per key.
+    """
+
+    def __init__(self, make_pool):
+        self.make_pool = make_pool
+        self.local = threading.local()
+
+    def __getitem__(self, key):
+        pools = getattr(self.local, 'pools', None)
+        if pools is None:
+            pools = self.local.pools = {}
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = self.make_pool(key)
+        return pool
@@ -0,0 +1,129 @@
+"""
+The realms container sync may sync between, read from
+``container-sync-realms.conf``::
+
+    [realm1]
+    key = realm1key
+    key2 = realm1key2
+    cluster_clustername1 = https://host1/v1/
+    cluster_clustername2 = https://host2/v1/
+
+Each request between clusters is signed with the realm's key and the
+container's own ``X-Container-Sync-Key``; ``key2`` lets a realm's key be
+rotated without a window where syncs fail.
+"""
+import errno
+import hashlib
+import hmac
+import os
+import time
+
+try:
+    from ConfigParser import ConfigParser, Error as ConfigParserError
+except ImportError:
+    from configparser import ConfigParser, Error as ConfigParserError
+
+
+class ContainerSyncRealms(object):
+    """
+    The realms of ``conf_path``, parsed once and read again only when the
+    file's mtime has changed, which is looked at most once per
+    ``mtime_check_interval`` seconds.
+    """
+
+    def __init__(self, conf_path, logger, mtime_check_interval=300):
+        self.conf_path = conf_path
+        self.logger = logger
+        self.mtime_check_interval = mtime_check_interval
+        self.next_mtime_check = 0
+        self.conf_path_mtime = 0
+        self.data = {}
+        self.reload()
+
+    def reload(self):
+        """Forces a reload of the conf file."""
+        self.next_mtime_check = 0
+        self.conf_path_mtime = 0
+        self._reload()
+
+    def _reload(self):
+        now = time.time()
+        if now < self.next_mtime_check:
+            return
+        self.next_mtime_check = now + self.mtime_check_interval
+        try:
+            mtime = os.path.getmtime(self.conf_path)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                self.data = {}
+                self.conf_path_mtime = 0
+            else:
+                self.logger.error('Could not load %r: %s',
+                                  self.conf_path, err)
+            return
+        if mtime == self.conf_path_mtime:
+            return
+        conf = ConfigParser()
+        try:
+            conf.read(self.conf_path)
+        except ConfigParserError as err:
+            self.logger.error('Could not load %r: %s', self.conf_path, err)
+            return
+        data = {}
+        for section in conf.sections():
+            options = dict(conf.items(section))
+            realm = {'clusters': {}}
+            for name, value in options.items():
+                if name in ('key', 'key2'):
+                    realm[name] = value
+                elif name.startswith('cluster_'):
+                    realm['clusters'][name[len('cluster_'):].upper()] = \
+                        value
+            data[section.upper()] = realm
+        self.data = data
+        self.conf_path_mtime = mtime
+
+    def realms(self):
+        """Returns a list of realms."""
+        self._reload()
+        return list(self.data.keys())
+
+    def key(self, realm):
+        """Returns the key for the realm."""
+        self._reload()
+        return self.data.get(realm.upper(), {}).get('key')
+
+    def key2(self, realm):
+        """Returns the key2 for the realm."""
+        self._reload()
+        return self.data.get(realm.upper(), {}).get('key2')
+
+    def clusters(self, realm):
+        """Returns a list of clusters for the realm."""
+        self._reload()
+        return list(self.data.get(realm.upper(), {}).get('clusters', {}))
+
+    def endpoint(self, realm, cluster):
+        """Returns the endpoint for the cluster in the realm."""
+        self._reload()
+        return self.data.get(realm.upper(), {}).get(
+            'clusters', {}).get(cluster.upper())
+
+    def get_sig(self, request_method, path, x_timestamp, nonce, realm_key,
+                user_key):
+        """
+        Returns the hexdigest string of the HMAC-SHA1 (RFC 2104) for the
+        information given.
+
+        :param request_method: HTTP method of the request.
+        :param path: The path to the resource.
+        :param x_timestamp: The X-Timestamp header value for the request.
+        :param nonce: A unique value for the request.
+        :param realm_key: Shared secret at the cluster operator level.
+        :param user_key: Shared secret at the user's container level.
+        :returns: hexdigest str of the HMAC-SHA1 for the request.
+        """
+        body = '%s\n%s\n%s\n%s\n%s' % (
+            request_method, path, x_timestamp, nonce, user_key)
+        return hmac.new(realm_key.encode('utf-8'), body.encode('utf-8'),
+                        hashlib.sha1).hexdigest()
@@ -0,0 +1,439 @@
+"""
+Memcache client for the proxy pipeline.
+
+Keys are spread over the servers with a consistent hash ring, so adding or
+removing a server only moves the keys next to it. Each server has a bounded
+pool of persistent connections, ``get_multi``/``set_multi`` send one batched
+request per server, and a small per-worker LRU answers repeated reads of hot
+keys without leaving the process.
+"""
+import bisect
+import json
+import time
+from hashlib import md5
+
+from eventlet.green import socket
+from eventlet.pools import Pool
+from eventlet import Timeout
+
+from swift.common.connection_pool import PoolsByThread
+from swift.common.utils import LRUCache
+
+DEFAULT_MEMCACHED_PORT = 11211
+
+CONN_TIMEOUT = 0.3
+IO_TIMEOUT = 2.0
+JSON_FLAG = 2
+NODE_WEIGHT = 50
+TRY_COUNT = 3
+
+# if ERROR_LIMIT_COUNT errors occur in ERROR_LIMIT_TIME seconds, the server
+# will be considered failed for ERROR_LIMIT_DURATION seconds.
+ERROR_LIMIT_COUNT = 10
+ERROR_LIMIT_TIME = 60
+ERROR_LIMIT_DURATION = 60
+
+
+def md5hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return md5(key).hexdigest().encode('ascii')
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class MemcacheConnectionError(Exception):
+    pass
+
+
+class MemcacheConnPool(Pool):
+    """
+    Connection pool for one memcache server.
+
+    :param server: ``host:port`` of the server
+    :param size: most connections kept open to it
+    """
+
+    def __init__(self, server, size, connect_timeout):
+        Pool.__init__(self, max_size=size)
+        host, _sep, port = server.rpartition(':')
+        if not host:
+            host, port = port, DEFAULT_MEMCACHED_PORT
+        self.addr = (host, int(port))
+        self._connect_timeout = connect_timeout
+
+    def create(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with Timeout(self._connect_timeout):
+            sock.connect(self.addr)
+        return (sock.makefile('rb'), sock)
+
+    def get(self):
+        fp, sock = Pool.get(self)
+        if fp is None:
+            # An error happened previously, so we need a new connection
+            try:
+                fp, sock = self.create()
+            except BaseException:
+                # the slot stays free for the next try
+                self.put((None, None))
+                raise
+        return fp, sock
+
+
+class MemcacheRing(object):
+    """
+    Simple, consistent-hashed memcache client.
+
+    :param servers: list of ``host:port`` strings
+    :param pool_size: connections kept per server
+    :param lru_size: entries in the per-worker LRU, 0 to disable it
+    :param lru_ttl: longest time, in seconds, a value is served from the
+                    LRU without asking memcache again
+    """
+
+    def __init__(self, servers, connect_timeout=CONN_TIMEOUT,
+                 io_timeout=IO_TIMEOUT, tries=TRY_COUNT, pool_size=4,
+                 lru_size=1024, lru_ttl=1.0):
+        self._ring = []
+        self._errors = dict((server, []) for server in servers)
+        self._error_limited = dict((server, 0) for server in servers)
+        for server in sorted(servers):
+            for i in range(NODE_WEIGHT):
+                self._ring.append((md5hash('%s-%s' % (server, i)), server))
+        self._ring.sort()
+        self._ring_keys = [point for point, _server in self._ring]
+        self._tries = min(tries, len(servers))
+        self._pools = PoolsByThread(
+            lambda server: MemcacheConnPool(server, pool_size,
+                                            connect_timeout))
+        self._io_timeout = io_timeout
+        self._lru = LRUCache(lru_size, ttl=lru_ttl) if lru_size else None
+
+    def _remember(self, key, flags, data, time=0):
+        """
+        Keeps a value in the LRU as it was sent to or read from memcache,
+        ``(flags, data)``, so a hit decodes it just as memcache would have
+        it, to a new object of the same type.
+        """
+        if self._lru is not None:
+            # never outlive the memcache entry itself
+            ttl = self._lru.ttl
+            if time and (ttl is None or time < ttl):
+                ttl = time
+            self._lru.set(key, (flags, data), ttl=ttl)
+
+    def _recall(self, key):
+        if self._lru is not None:
+            entry = self._lru.get(key)
+            if entry is not None:
+                return self._decode(*entry)
+        return None
+
+    def _servers_for(self, hashed_key):
+        """Distinct servers clockwise from the key's point on the ring."""
+        seen = set()
+        index = bisect.bisect(self._ring_keys, hashed_key)
+        for offset in range(len(self._ring)):
+            server = self._ring[(index + offset) % len(self._ring)][1]
+            if server not in seen:
+                seen.add(server)
+                yield server
+                if len(seen) >= self._tries:
+                    return
+
+    def _exception_occurred(self, server, err):
+        now = time.time()
+        errors = [t for t in self._errors[server]
+                  if t > now - ERROR_LIMIT_TIME] + [now]
+        self._errors[server] = errors
+        if len(errors) > ERROR_LIMIT_COUNT:
+            self._error_limited[server] = now + ERROR_LIMIT_DURATION
+
+    def _get_conns(self, hashed_key):
+        """
+        Yields (server, fp, sock) for the servers responsible for the key,
+        skipping error-limited ones; the caller must hand the connection
+        back with :meth:`_return_conn`.
+        """
+        for server in self._servers_for(hashed_key):
+            if self._error_limited[server] > time.time():
+                continue
+            try:
+                with Timeout(self._io_timeout):
+                    fp, sock = self._pools[server].get()
+            except (Exception, Timeout) as err:
+                self._exception_occurred(server, err)
+                continue
+            yield server, fp, sock
+
+    def _return_conn(self, server, fp, sock):
+        self._pools[server].put((fp, sock))
+
+    def _discard_conn(self, server, fp, sock, err):
+        # a half-read response would poison the connection for the next user
+        self._exception_occurred(server, err)
+        try:
+            sock.close()
+        except Exception:
+            pass
+        self._pools[server].put((None, None))
+
+    def _call(self, hashed_key, func):
+        """
+        Runs ``func(fp, sock)`` on the first server that answers.
+
+        :raises MemcacheConnectionError: if no server did
+        """
+        for server, fp, sock in self._get_conns(hashed_key):
+            try:
+                with Timeout(self._io_timeout):
+                    result = func(fp, sock)
+            except (Exception, Timeout) as err:
+                self._discard_conn(server, fp, sock, err)
+                continue
+            self._return_conn(server, fp, sock)
+            return result
+        raise MemcacheConnectionError('No memcached connections succeeded.')
+
+    @staticmethod
+    def _encode(value, serialize):
+        if serialize:
+            return JSON_FLAG, json.dumps(value).encode('utf-8')
+        return 0, _to_bytes(value)
+
+    @staticmethod
+    def _decode(flags, data):
+        if int(flags) & JSON_FLAG:
+            return json.loads(data.decode('utf-8'))
+        return data
+
+    @staticmethod
+    def _read_values(fp, values):
+        """
+        Reads VALUE lines up to END into ``values``, as
+        ``{hashed key: (flags, data)}``.
+        """
+        while True:
+            line = fp.readline().strip()
+            if line == b'END':
+                return values
+            if not line.startswith(b'VALUE '):
+                raise MemcacheConnectionError('Unexpected reply %r' % line)
+            _junk, key, flags, size = line.split()
+            data = fp.read(int(size) + 2)[:-2]
+            values[key] = (int(flags), data)
+
+    def set(self, key, value, serialize=True, time=0):
+        """
+        Set a key/value pair in memcache
+
+        :param key: key
+        :param value: value
+        :param serialize: if True, value is serialized with JSON before
+                          sending to memcache
+        :param time: the time to live
+        """
+        hashed_key = md5hash(key)
+        flags, data = self._encode(value, serialize)
+
+        def do_set(fp, sock):
+            sock.sendall(b'set ' + hashed_key + (' %d %d %d\r\n' % (
+                flags, time, len(data))).encode('ascii') + data + b'\r\n')
+            fp.readline()
+
+        self._remember(key, flags, data, time)
+        try:
+            self._call(hashed_key, do_set)
+        except MemcacheConnectionError:
+            pass
+
+    def get(self, key):
+        """
+        Gets the object specified by key.  It will also unserialize the
+        object before returning if it is serialized in memcache with JSON.
+
+        :param key: key
+        :returns: value of the key in memcache, or None
+        """
+        value = self._recall(key)
+        if value is not None:
+            return value
+        hashed_key = md5hash(key)
+
+        def do_get(fp, sock):
+            sock.sendall(b'get ' + hashed_key + b'\r\n')
+            return self._read_values(fp, {}).get(hashed_key)
+
+        try:
+            entry = self._call(hashed_key, do_get)
+        except MemcacheConnectionError:
+            return None
+        if entry is None:
+            return None
+        self._remember(key, *entry)
+        return self._decode(*entry)
+
+    def incr(self, key, delta=1, time=0):
+        """
+        Increments a key which has a numeric value by delta. If the key
+        can't be found, it's added as delta or 0 if delta < 0. If passed a
+        negative number, will use memcached's decr.
+
+        :param key: key
+        :param delta: amount to add to the value of key (or set as the value
+                      if the key is not found) will be cast to an int
+        :param time: the time to live
+        :returns: result of incrementing
+        :raises MemcacheConnectionError:
+        """
+        hashed_key = md5hash(key)
+        command = b'incr'
+        if delta < 0:
+            command = b'decr'
+        delta = str(abs(int(delta))).encode('ascii')
+        if self._lru is not None:
+            self._lru.delete(key)
+
+        def do_incr(fp, sock):
+            sock.sendall(command + b' ' + hashed_key + b' ' + delta + b'\r\n')
+            line = fp.readline().strip()
+            if line != b'NOT_FOUND':
+                return int(line)
+            add_val = delta if command == b'incr' else b'0'
+            sock.sendall(b'add ' + hashed_key + (' 0 %d %d\r\n' % (
+                time, len(add_val))).encode('ascii') + add_val + b'\r\n')
+            line = fp.readline().strip()
+            if line == b'NOT_STORED':
+                # someone else added it in between
+                sock.sendall(command + b' ' + hashed_key + b' ' + delta +
+                             b'\r\n')
+                return int(fp.readline().strip())
+            return int(add_val)
+
+        return self._call(hashed_key, do_incr)
+
+    def decr(self, key, delta=1, time=0):
+        """
+        Decrements a key which has a numeric value by delta. Calls incr with
+        -delta.
+
+        :raises MemcacheConnectionError:
+        """
+        return self.incr(key, delta=-delta, time=time)
+
+    def delete(self, key):
+        """
+        Deletes a key/value pair from memcache.
+
+        :param key: key to be deleted
+        """
+        hashed_key = md5hash(key)
+        if self._lru is not None:
+            self._lru.delete(key)
+
+        def do_delete(fp, sock):
+            sock.sendall(b'delete ' + hashed_key + b'\r\n')
+            fp.readline()
+
+        try:
+            self._call(hashed_key, do_delete)
+        except MemcacheConnectionError:
+            pass
+
+    def _group_by_server(self, keys, server_key):
+        """
+        Maps the first live server for each key (or for server_key, if
+        given) to the keys it holds.
+        """
+        groups = {}
+        for key in keys:
+            hashed_key = md5hash(server_key if server_key else key)
+            for server in self._servers_for(hashed_key):
+                if self._error_limited[server] <= time.time():
+                    groups.setdefault(server, []).append(key)
+                    break
+        return groups
+
+    def _call_server(self, server, func):
+        try:
+            with Timeout(self._io_timeout):
+                fp, sock = self._pools[server].get()
+        except (Exception, Timeout) as err:
+            self._exception_occurred(server, err)
+            return None
+        try:
+            with Timeout(self._io_timeout):
+                result = func(fp, sock)
+        except (Exception, Timeout) as err:
+            self._discard_conn(server, fp, sock, err)
+            return None
+        self._return_conn(server, fp, sock)
+        return result
+
+    def set_multi(self, mapping, server_key=None, serialize=True, time=0):
+        """
+        Sets multiple key/value pairs in memcache, pipelining the commands
+        so each server gets one write and answers in one read.
+
+        :param mapping: dictionary of keys and values to be set in memcache
+        :param server_key: if given, all keys go to the server this key
+                           hashes to
+        :param serialize: if True, value is serialized with JSON before
+                          sending to memcache.
+        :param time: the time to live
+        """
+        for server, keys in self._group_by_server(
+                mapping, server_key).items():
+            commands = []
+            for key in keys:
+                flags, data = self._encode(mapping[key], serialize)
+                commands.append(b'set ' + md5hash(key) + (' %d %d %d\r\n' % (
+                    flags, time, len(data))).encode('ascii') + data + b'\r\n')
+                self._remember(key, flags, data, time)
+
+            def do_set_multi(fp, sock, commands=commands):
+                sock.sendall(b''.join(commands))
+                for _command in commands:
+                    fp.readline()
+
+            self._call_server(server, do_set_multi)
+
+    def get_multi(self, keys, server_key=None):
+        """
+        Gets multiple values from memcache for the given keys, with one
+        request per server.
+
+        :param keys: keys for values to be retrieved from memcache
+        :param server_key: if given, all keys are read from the server this
+                           key hashes to
+        :returns: list of values, None for keys that weren't found
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._recall(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        for server, server_keys in self._group_by_server(
+                missing, server_key).items():
+            hashed = dict((md5hash(key), key) for key in server_keys)
+
+            def do_get_multi(fp, sock, hashed=hashed):
+                sock.sendall(b'get ' + b' '.join(hashed) + b'\r\n')
+                return self._read_values(fp, {})
+
+            for hashed_key, (flags, data) in (
+                    self._call_server(server, do_get_multi) or {}).items():
+                key = hashed.get(hashed_key)
+                if key is not None:
+                    found[key] = self._decode(flags, data)
+                    self._remember(key, flags, data)
+        return [found.get(key) for key in keys]
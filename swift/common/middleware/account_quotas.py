@@ -1,19 +1,106 @@
+"""
+``account_quotas`` is a middleware which blocks write requests (PUT, POST)
+if a given account quota (in bytes) is exceeded while DELETE requests are
+still allowed.
+
+``account_quotas`` uses the ``x-account-meta-quota-bytes`` metadata entry to
+store the quota. Write requests to this metadata entry are only permitted
+for resellers. There is no quota limit if ``x-account-meta-quota-bytes`` is
+not set.
+
+Usage is checked against a per-worker estimate rather than a HEAD of the
+account per write; see :class:`swift.common.request_helpers.UsageTracker`
+and the ``quota_*`` options of the filter.
+"""
+from swift.common.request_helpers import UsageTracker
+from swift.common.utils import split_path
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
 
-class AccountQuotaMiddleware(object):
-    """docstring for AccountQuotaMiddleware"""
-    def __init__(self, app):
+class AccountQuotaMiddleware(Middleware):
+    """
+    Account quota middleware
+
+    See above for a full description.
+
+    The proxy logs created for any subrequests made will have swift.source
+    set to "AQ".
+    """
+    def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
+        self.conf = conf
+        self.usage = UsageTracker(
+            app, float(conf.get('quota_reconcile_interval', 10)),
+            int(conf.get('quota_slack_bytes', 104857600)),
+            # there is no object count quota on accounts
+            float('inf'),
+            int(conf.get('quota_cache_size', 10000)), 'AQ')
+
+    def _error(self, start_response, status, body):
+        body = body.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        method = env['REQUEST_METHOD']
+        if method not in ('PUT', 'POST', 'DELETE'):
+            return self.app(env, start_response)
+        try:
+            vrs, account, container, obj = split_path(
+                env.get('PATH_INFO', ''), 2, 4, True)
+        except ValueError:
+            return self.app(env, start_response)
+
+        if not container:
+            value = env.get('HTTP_X_ACCOUNT_META_QUOTA_BYTES')
+            remove = env.get('HTTP_X_REMOVE_ACCOUNT_META_QUOTA_BYTES')
+            if value is not None or remove is not None:
+                if not env.get('reseller_request'):
+                    return self._error(start_response, '403 Forbidden',
+                                       'Forbidden')
+                if value and not value.isdigit():
+                    return self._error(
+                        start_response, '400 Bad Request',
+                        'Invalid X-Account-Meta-Quota-Bytes')
+                self.usage.forget(account)
+            return self.app(env, start_response)
+
+        if not obj or method == 'POST':
+            return self.app(env, start_response)
+        try:
+            quota = int(
+                self.usage.get(env, account).info['meta']['quota-bytes'])
+        except (KeyError, ValueError):
+            return self.app(env, start_response)
+
+        if method == 'DELETE':
+            # the bytes freed are unknown until the next reconcile
+            nbytes, count = 0, -1
+        else:
+            try:
+                nbytes = int(env.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                nbytes = 0
+            count = 1
+            usage = self.usage.get_for_write(env, account, nbytes=nbytes)
+            if usage.bytes + nbytes > quota:
+                return self._error(start_response,
+                                   '413 Request Entity Too Large',
+                                   'Upload exceeds quota.')
+
+        def count_write(status, headers):
+            if status.startswith('2'):
+                self.usage.add(account, None, nbytes, count)
+            return status, headers
+        return self.app(env, self._rewrite_start_response(
+            start_response, count_write))
 
 
 def filter_factory(global_conf, **local_conf):
@@ -25,5 +112,5 @@ def filter_factory(global_conf, **local_conf):
 
     def account_quota_filter(app):
         pass  # (WIS) print "%s (%s -> %s)" % (__name__, whosdaddy(), whoami())
-        return AccountQuotaMiddleware(app)
+        return AccountQuotaMiddleware(app, conf)
     return account_quota_filter
@@ -1,12 +1,142 @@
+import io
+import json
+import tarfile
+import zlib
+from xml.sax import saxutils
+
+try:
+    from urllib import quote, unquote
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import quote, unquote, parse_qs
+
+import eventlet
+from eventlet import GreenPool
+
+from swift.common.utils import split_path
+from swift.common.wsgi import Middleware, call_subrequest, make_env
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+MAX_PATH_LENGTH = 1024
+ACCEPTABLE_FORMATS = ['text/plain', 'application/json', 'application/xml',
+                      'text/xml']
+
+
+def get_response_body(data_format, data_dict, error_list):
+    """
+    Returns a properly formatted response body according to format.
+    Handles json and xml, otherwise will return text/plain.
+    Note: xml response does not include xml declaration.
+
+    :params data_format: resulting format
+    :params data_dict: generated data about results.
+    :params error_list: list of quoted filenames that failed
+    """
+    if data_format == 'application/json':
+        data_dict['Errors'] = error_list
+        return json.dumps(data_dict)
+    if data_format and data_format.endswith('/xml'):
+        output = '<delete>\n'
+        for key in sorted(data_dict):
+            xml_key = key.replace(' ', '_').lower()
+            output += '<%s>%s</%s>\n' % (xml_key, data_dict[key], xml_key)
+        output += '<errors>\n'
+        output += '\n'.join(
+            ['<object>'
+             '<name>%s</name><status>%s</status>'
+             '</object>' % (saxutils.escape(name), status) for
+             name, status in error_list])
+        output += '</errors>\n</delete>\n'
+        return output
+    output = ''
+    for key in sorted(data_dict):
+        output += '%s: %s\n' % (key, data_dict[key])
+    output += 'Errors:\n'
+    output += '\n'.join(
+        ['%s, %s' % (name, status)
+         for name, status in error_list])
+    return output
+
+
+class CreateContainerError(Exception):
+    def __init__(self, msg, status_int, status):
+        self.status_int = status_int
+        self.status = status
+        super(CreateContainerError, self).__init__(msg)
+
+
+class _Results(object):
+    """
+    Outcome of a bulk request, filled in by the green threads doing it.
+
+    :param count_name: what the response body calls ``count``
+    :param status: status reported if all goes well
+    """
+
+    def __init__(self, count_name, status='201 Created'):
+        self.count_name = count_name
+        self.status = status
+        self.body = ''
+        self.count = 0
+        self.not_found = None
+        self.failed_files = []
+        # status reported if some files failed
+        self.failed_status = '400 Bad Request'
+        self.unauthorized = False
+
+    def resp_dict(self):
+        resp_dict = {'Response Status': self.status,
+                     'Response Body': self.body,
+                     self.count_name: self.count}
+        if self.not_found is not None:
+            resp_dict['Number Not Found'] = self.not_found
+        return resp_dict
+
+
+class Bulk(Middleware):
+    """
+    Middleware that will do many operations on a single request.
+
+    Extract Archive:
+
+    Expand tar files into a swift account. Request must be a PUT with the
+    query parameter ``?extract-archive=format`` specifying the format of
+    archive file. Accepted formats are tar, tar.gz, and tar.bz2.
+
+    The archive is read from ``wsgi.input`` and decompressed as it arrives;
+    nothing is spooled. Each file in it becomes a PUT subrequest to the rest
+    of the pipeline, with up to ``extract_concurrency`` of them in flight.
+    A file no bigger than ``extract_buffer_size`` is read off the stream
+    into memory so the next one can be started while it uploads; a bigger
+    one is uploaded straight from the stream before moving on. Memory stays
+    below ``extract_concurrency * extract_buffer_size`` whatever the size
+    of the archive.
+
+    The response is a 200 sent right away, followed by a space every
+    ``yield_frequency`` seconds to keep the client connection alive while
+    the archive is extracted, and then a body giving the real outcome in
+    its 'Response Status'.
+
+    Bulk Delete:
+
+    Will delete multiple objects or containers from their account with a
+    single request. Responds to POST or DELETE requests with query
+    parameter ``?bulk-delete`` set. The request body is a newline separated
+    list of url encoded objects to delete, as /container/object or
+    /container, and is parsed as it arrives.
 
-class Bulk(object):
-    """docstring for Bulk"""
-    def __init__(self, app, conf, max_containers_per_extraction, max_failed_extractions, max_deletes_per_request, max_failed_deletes, yield_frequency, retry_count, retry_interval):
+    Object DELETEs are sent as soon as their line is read, with up to
+    ``delete_concurrency`` in flight. Containers are deleted once all the
+    objects in the request have been, so each is only tried when it may be
+    empty; a 409 Conflict (the listing not having caught up yet) is retried
+    ``delete_container_retry_count`` times, waiting
+    ``retry_interval ** attempt`` seconds before each try. The response is
+    sent like the one for Extract Archive.
+    """
+    def __init__(self, app, conf, max_containers_per_extraction, max_failed_extractions, max_deletes_per_request, max_failed_deletes, yield_frequency, retry_count, retry_interval, extract_concurrency=8, extract_buffer_size=1048576, delete_concurrency=8):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
@@ -17,11 +147,348 @@ class Bulk(object):
         self.yield_frequency = yield_frequency
         self.retry_count = retry_count
         self.retry_interval = retry_interval
+        self.extract_concurrency = extract_concurrency
+        self.extract_buffer_size = extract_buffer_size
+        self.delete_concurrency = delete_concurrency
+
+    def create_container(self, env, container_path):
+        """
+        Checks if the container exists and if not try to create it.
+
+        :params container_path: an unquoted path to a container to be created
+        :returns: True if created container, False if container exists
+        :raises CreateContainerError: when unable to create container
+        """
+        resp = self._subrequest(env, 'HEAD', container_path, 'EA')
+        if 200 <= resp.status_int < 300:
+            return False
+        if resp.status_int == 404:
+            resp = self._subrequest(env, 'PUT', container_path, 'EA')
+            if 200 <= resp.status_int < 300:
+                return True
+        raise CreateContainerError(
+            "Create Container Failed: " + container_path,
+            resp.status_int, resp.status)
+
+    def _subrequest(self, env, method, path, swift_source, body_file=None,
+                    content_length=None):
+        agent = '%(orig)s BulkExpand' if swift_source == 'EA' \
+            else '%(orig)s BulkDelete'
+        resp = call_subrequest(self.app, make_env(
+            env, method, path, agent=agent, swift_source=swift_source,
+            body_file=body_file, content_length=content_length))
+        try:
+            for _chunk in resp.app_iter:
+                pass
+        finally:
+            if hasattr(resp.app_iter, 'close'):
+                resp.app_iter.close()
+        return resp
+
+    def _keepalive(self, thread, out_content_type, results):
+        """
+        Yields a space every ``yield_frequency`` seconds until ``thread``
+        is done, then the response body. The thread is killed if the client
+        goes away first.
+        """
+        try:
+            while True:
+                try:
+                    with eventlet.Timeout(self.yield_frequency):
+                        thread.wait()
+                    break
+                except eventlet.Timeout:
+                    yield b' '
+        finally:
+            thread.kill()
+        yield get_response_body(
+            out_content_type, results.resp_dict(),
+            results.failed_files).encode('utf-8')
+
+    def handle_extract_iter(self, env, compress_type,
+                            out_content_type='text/plain'):
+        """
+        A generator that can be returned as the app_iter of the response
+        which, when iterated over, will extract and PUT the objects pulled
+        from the request body. Will occasionally yield whitespace while
+        request is being processed. When the request is completed will yield
+        a response body that can be parsed to determine success. See above
+        documentation for details.
+
+        :params env: the request environment
+        :params compress_type: specifying the compression type of the tar.
+            Accepts '', 'gz', or 'bz2'
+        """
+        results = _Results('Number Files Created')
+        thread = eventlet.spawn(self._extract, env, compress_type, results)
+        return self._keepalive(thread, out_content_type, results)
+
+    def _extract(self, env, compress_type, results):
+        try:
+            vrs, account, extract_base = split_path(
+                env['PATH_INFO'], 2, 3, True)
+        except ValueError:
+            results.status = '404 Not Found'
+            return
+        extract_base = (extract_base or '').lstrip('/')
+        existing_containers = set()
+        pool = GreenPool(self.extract_concurrency)
+        try:
+            tar = tarfile.open(mode='r|' + compress_type,
+                               fileobj=env['wsgi.input'])
+            for tar_info in tar:
+                if len(results.failed_files) >= self.max_failed_extractions:
+                    break
+                if results.unauthorized:
+                    break
+                if not tar_info.isfile():
+                    continue
+                obj_path = tar_info.name
+                if obj_path.startswith('./'):
+                    obj_path = obj_path[2:]
+                obj_path = obj_path.lstrip('/')
+                if extract_base:
+                    obj_path = extract_base + '/' + obj_path
+                if '/' not in obj_path:
+                    continue  # ignore base level file
+
+                destination = '/'.join(['', vrs, account, obj_path])
+                container = obj_path.split('/', 1)[0]
+                if len(destination) > MAX_PATH_LENGTH:
+                    results.failed_files.append([
+                        quote(destination[:MAX_PATH_LENGTH]),
+                        '400 Bad Request'])
+                    continue
+                if container not in existing_containers:
+                    try:
+                        self.create_container(
+                            env, '/'.join(['', vrs, account, container]))
+                    except CreateContainerError as err:
+                        # the object PUT may still succeed if acls are set
+                        if err.status_int == 401:
+                            results.unauthorized = True
+                            break
+                    existing_containers.add(container)
+                    if len(existing_containers) > \
+                            self.max_containers_per_extraction:
+                        pool.waitall()
+                        results.status = '400 Bad Request'
+                        results.body = \
+                            'More than %d containers to create from tar.' \
+                            % self.max_containers_per_extraction
+                        return
+
+                member = tar.extractfile(tar_info)
+                if tar_info.size <= self.extract_buffer_size:
+                    pool.spawn_n(self._put_object, env, destination,
+                                 io.BytesIO(member.read()), tar_info.size,
+                                 results)
+                else:
+                    # can't leave it behind in the stream; upload it now
+                    self._put_object(env, destination, member,
+                                     tar_info.size, results)
+            pool.waitall()
+        except (tarfile.TarError, zlib.error, EOFError, IOError) as tar_error:
+            pool.waitall()
+            results.status = '400 Bad Request'
+            results.body = 'Invalid Tar File: %s' % tar_error
+            return
+        except Exception:
+            pool.waitall()
+            results.status = '500 Internal Server Error'
+            return
+
+        if results.unauthorized:
+            results.failed_files.append([quote(env['PATH_INFO']),
+                                         '401 Unauthorized'])
+            results.status = '401 Unauthorized'
+        elif results.failed_files:
+            results.status = results.failed_status
+        elif not results.count:
+            results.status = '400 Bad Request'
+            results.body = 'Invalid Tar File: No Valid Files'
+
+    def _put_object(self, env, destination, body_file, size, results):
+        resp = self._subrequest(env, 'PUT', destination, 'EA',
+                                body_file=body_file, content_length=size)
+        if 200 <= resp.status_int < 300:
+            results.count += 1
+            return
+        if resp.status_int == 401:
+            results.unauthorized = True
+            return
+        if resp.status_int // 100 == 5:
+            results.failed_status = '502 Bad Gateway'
+        results.failed_files.append([quote(destination[:MAX_PATH_LENGTH]),
+                                     resp.status])
+
+    def handle_delete_iter(self, env, out_content_type='text/plain'):
+        """
+        A generator that can be returned as the app_iter of the response
+        which, when iterated over, will delete the objects and containers
+        listed in the request body. Will occasionally yield whitespace while
+        request is being processed. When the request is completed will yield
+        a response body that can be parsed to determine success. See above
+        documentation for details.
+
+        :params env: the request environment
+        """
+        results = _Results('Number Deleted', status='200 OK')
+        results.not_found = 0
+        thread = eventlet.spawn(self._delete, env, results)
+        return self._keepalive(thread, out_content_type, results)
+
+    def _delete_paths(self, wsgi_input):
+        """
+        Yields the unquoted paths listed in a bulk delete body, reading it a
+        line at a time.
+        """
+        while True:
+            line = wsgi_input.readline(MAX_PATH_LENGTH * 2)
+            if not line:
+                return
+            if len(line) >= MAX_PATH_LENGTH * 2 and not line.endswith(b'\n'):
+                raise ValueError('Invalid File Name')
+            name = line.strip()
+            if name:
+                if not isinstance(name, str):
+                    name = name.decode('utf-8')
+                yield unquote(name)
+
+    def _delete(self, env, results):
+        try:
+            vrs, account, _junk = split_path(env['PATH_INFO'], 2, 3, True)
+        except ValueError:
+            results.status = '404 Not Found'
+            return
+        pool = GreenPool(self.delete_concurrency)
+        containers = []
+        seen_containers = set()
+        listed = 0
+        try:
+            for name in self._delete_paths(env['wsgi.input']):
+                listed += 1
+                if listed > self.max_deletes_per_request:
+                    raise OverflowError(
+                        'Maximum Bulk Deletes: %d per request' %
+                        self.max_deletes_per_request)
+                if len(results.failed_files) >= self.max_failed_deletes:
+                    raise ValueError('Max delete failures exceeded')
+                if results.unauthorized:
+                    break
+                delete_path = '/'.join(['', vrs, account, name.lstrip('/')])
+                if len(delete_path) > MAX_PATH_LENGTH:
+                    results.failed_files.append([
+                        quote(delete_path[:MAX_PATH_LENGTH]),
+                        '400 Bad Request'])
+                    continue
+                if '/' in name.strip('/'):
+                    pool.spawn_n(self._delete_object, env, delete_path,
+                                 results)
+                elif delete_path.rstrip('/') not in seen_containers:
+                    # deleted after all the objects, once each
+                    seen_containers.add(delete_path.rstrip('/'))
+                    containers.append(delete_path.rstrip('/'))
+            pool.waitall()
+            if not results.unauthorized:
+                for delete_path in containers:
+                    pool.spawn_n(self._delete_container, env, delete_path,
+                                 results)
+                pool.waitall()
+        except OverflowError as err:
+            pool.waitall()
+            results.status = '413 Request Entity Too Large'
+            results.body = str(err)
+            return
+        except ValueError as err:
+            pool.waitall()
+            results.status = '400 Bad Request'
+            results.body = str(err)
+            return
+        except Exception:
+            pool.waitall()
+            results.status = '500 Internal Server Error'
+            return
+
+        if results.unauthorized:
+            results.failed_files.append([quote(env['PATH_INFO']),
+                                         '401 Unauthorized'])
+            results.status = '401 Unauthorized'
+        elif results.failed_files:
+            results.status = results.failed_status
+        elif not listed:
+            results.status = '400 Bad Request'
+            results.body = 'Invalid bulk delete.'
+
+    def _delete_object(self, env, delete_path, results):
+        self._record_delete(
+            self._subrequest(env, 'DELETE', delete_path, 'BD'),
+            delete_path, results)
+
+    def _delete_container(self, env, delete_path, results):
+        attempt = 0
+        while True:
+            resp = self._subrequest(env, 'DELETE', delete_path, 'BD')
+            if resp.status_int != 409 or attempt >= self.retry_count:
+                break
+            attempt += 1
+            # the listing may still show objects this request just deleted
+            eventlet.sleep(self.retry_interval ** attempt)
+        self._record_delete(resp, delete_path, results)
+
+    def _record_delete(self, resp, delete_path, results):
+        if 200 <= resp.status_int < 300:
+            results.count += 1
+        elif resp.status_int == 404:
+            results.not_found += 1
+        elif resp.status_int == 401:
+            results.unauthorized = True
+        else:
+            if resp.status_int // 100 == 5:
+                results.failed_status = '502 Bad Gateway'
+            results.failed_files.append([quote(delete_path), resp.status])
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        params = parse_qs(env.get('QUERY_STRING', ''),
+                          keep_blank_values=True)
+        if 'bulk-delete' in params and \
+                env['REQUEST_METHOD'] in ('POST', 'DELETE'):
+            out_content_type = self._out_content_type(env)
+            start_response('200 OK', [('Content-Type', out_content_type)])
+            return self.handle_delete_iter(
+                env, out_content_type=out_content_type)
+        extract_type = params.get('extract-archive', [None])[0]
+        if extract_type is None or env['REQUEST_METHOD'] != 'PUT':
+            return self.app(env, start_response)
+
+        extract_type = extract_type.lower().strip('.')
+        if extract_type in ('tar', ''):
+            archive_type = ''
+        elif extract_type in ('tar.gz', 'gz', 'tgz'):
+            archive_type = 'gz'
+        elif extract_type in ('tar.bz2', 'bz2'):
+            archive_type = 'bz2'
+        else:
+            body = b'Unsupported archive format'
+            start_response('400 Bad Request', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(body)))])
+            return [body]
+        out_content_type = self._out_content_type(env)
+        start_response('200 OK', [('Content-Type', out_content_type)])
+        return self.handle_extract_iter(env, archive_type,
+                                        out_content_type=out_content_type)
+
+    @staticmethod
+    def _out_content_type(env):
+        accept = env.get('HTTP_ACCEPT', '')
+        best = None
+        for content_type in ACCEPTABLE_FORMATS:
+            at = accept.find(content_type)
+            if at >= 0 and (best is None or at < best[0]):
+                best = (at, content_type)
+        return best[1] if best else 'text/plain'
 
 
 def filter_factory(global_conf, **local_conf):
@@ -38,6 +505,9 @@ def filter_factory(global_conf, **local_conf):
     yield_frequency = int(conf.get('yield_frequency', 10))
     retry_count = int(conf.get('delete_container_retry_count', 0))
     retry_interval = 1.5
+    extract_concurrency = int(conf.get('extract_concurrency', 8))
+    extract_buffer_size = int(conf.get('extract_buffer_size', 1048576))
+    delete_concurrency = int(conf.get('delete_concurrency', 8))
 
     # register_swift_info(
     #     'bulk_upload',
@@ -58,5 +528,8 @@ def filter_factory(global_conf, **local_conf):
             max_failed_deletes=max_failed_deletes,
             yield_frequency=yield_frequency,
             retry_count=retry_count,
-            retry_interval=retry_interval)
+            retry_interval=retry_interval,
+            extract_concurrency=extract_concurrency,
+            extract_buffer_size=extract_buffer_size,
+            delete_concurrency=delete_concurrency)
     return bulk_filter
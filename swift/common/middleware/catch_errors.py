@@ -1,20 +1,156 @@
+"""
+Middleware that catches any error raised further down the pipeline and
+turns it into a ``500 Internal Server Error``, stamping every request
+with a transaction id on the way.
+
+The transaction id, in ``env['swift.trans_id']`` and the ``X-Trans-Id``
+response header, is a prefix drawn at random once per worker followed by
+a counter, so making one costs no call to the system's random source.
+``trans_id_suffix`` and a client's ``X-Trans-Id-Extra`` are appended.
+
+Errors are caught both while the request is being called down the
+pipeline and while its body is being sent. Until the first byte of the
+body has gone out the response is replaced with a 500; after that, the
+error is raised again for the server, which closes the connection, so
+the client sees a truncated body rather than a complete looking one. The
+body is never buffered to make this possible.
+
+Each error is logged with its transaction id and counted against the
+innermost filter on its traceback, which is the one that raised it unless
+it came from code the filter called. The counts are kept in ``errors``
+and sent to StatsD as ``errors.<filter>`` when ``log_statsd_host`` is
+set.
+"""
+import itertools
+import sys
+import threading
+from uuid import uuid4
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from swift.common.middleware.proxy_logging import StatsdAggregator
+from swift.common.utils import ClosingIterable, get_logger
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+ERROR_BODY = b'An error occurred'
+
+
+def error_source(tb):
+    """
+    Returns the name of the innermost filter, or ``proxy-server``, with a
+    frame on ``tb``, or ``unknown``.
+    """
+    source = 'unknown'
+    while tb is not None:
+        module = tb.tb_frame.f_globals.get('__name__', '')
+        if module == __name__:
+            pass
+        elif module.startswith('swift.common.middleware.'):
+            source = module.rsplit('.', 1)[1]
+        elif module.startswith('swift.proxy.'):
+            source = 'proxy-server'
+        tb = tb.tb_next
+    return source
+
 
-class CatchErrorMiddleware(object):
-    """docstring for CatchErrorMiddleware"""
+class _GuardedBody(ClosingIterable):
+    """Sends a body, dealing with whatever it raises."""
+
+    def __init__(self, app_iter, middleware, env, start_response):
+        super(_GuardedBody, self).__init__(app_iter)
+        self.middleware = middleware
+        self.env = env
+        self.start_response = start_response
+
+    def __iter__(self):
+        started = False
+        try:
+            for chunk in self.app_iter:
+                if chunk:
+                    started = True
+                yield chunk
+        except Exception:
+            self.middleware.handle_error(self.env)
+            if not started:
+                self.middleware.send_error(self.start_response)
+                yield ERROR_BODY
+            else:
+                # too late for a 500; the server closes the connection
+                raise
+
+
+class CatchErrorMiddleware(Middleware):
+    """
+    Middleware that provides high-level error handling and ensures that a
+    transaction id will be set for every request.
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.logger = get_logger(conf, log_route='catch-errors')
+        self.trans_id_suffix = conf.get('trans_id_suffix', '')
+        # built per worker, so every worker has its own
+        self.trans_id_prefix = 'tx%s-' % uuid4().hex[:16]
+        self.counter = itertools.count(1)
+        self.errors = {}
+        self.errors_lock = threading.Lock()
+        self.statsd = None
+        if conf.get('log_statsd_host'):
+            self.statsd = StatsdAggregator(
+                conf['log_statsd_host'],
+                int(conf.get('log_statsd_port', 8125)),
+                prefix=conf.get('log_statsd_metric_prefix', ''),
+                interval=float(conf.get('log_statsd_emit_interval', 10)))
+
+    def generate_trans_id(self, env):
+        trans_id = '%s%010x%s' % (self.trans_id_prefix, next(self.counter),
+                                  self.trans_id_suffix)
+        extra = env.get('HTTP_X_TRANS_ID_EXTRA')
+        if extra:
+            trans_id += '-' + quote(extra[:32])
+        return trans_id
+
+    def handle_error(self, env):
+        """Logs and counts the exception being handled."""
+        source = error_source(sys.exc_info()[2])
+        with self.errors_lock:
+            self.errors[source] = self.errors.get(source, 0) + 1
+        if self.statsd:
+            self.statsd.increment('errors.' + source)
+        self.logger.exception('Error in %s: %s %s (txn: %s)', source,
+                              env.get('REQUEST_METHOD'),
+                              env.get('PATH_INFO'), env.get('swift.trans_id'))
+
+    def send_error(self, start_response):
+        start_response('500 Internal Server Error', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(ERROR_BODY)))], sys.exc_info())
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        trans_id = env.get('swift.trans_id')
+        if trans_id is None:
+            trans_id = env['swift.trans_id'] = self.generate_trans_id(env)
+
+        def add_trans_id(status, headers):
+            return status, headers + [('X-Trans-Id', trans_id)]
+        start_response = self._rewrite_start_response(start_response,
+                                                      add_trans_id)
+        try:
+            app_iter = self.app(env, start_response)
+        except Exception:
+            self.handle_error(env)
+            self.send_error(start_response)
+            return [ERROR_BODY]
+        return _GuardedBody(app_iter, self, env, start_response)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -1,19 +1,125 @@
+"""
+The ``container_quotas`` middleware implements simple quotas that can be
+imposed on swift containers by a user with the ability to set container
+metadata, most likely the account administrator. This can be useful for
+limiting the scope of containers that are delegated to non-admin users,
+exposed to ``formpost`` uploads, or just as a self-imposed sanity check.
+
+Quotas are set by adding meta values to the container, and are validated
+when set:
+
++---------------------------------------------+-------------------------------+
+|Metadata                                     | Use                           |
++=============================================+===============================+
+| X-Container-Meta-Quota-Bytes                | Maximum size of the           |
+|                                             | container, in bytes.          |
++---------------------------------------------+-------------------------------+
+| X-Container-Meta-Quota-Count                | Maximum object count of the   |
+|                                             | container.                    |
++---------------------------------------------+-------------------------------+
+
+Usage is checked against a per-worker estimate rather than a HEAD of the
+container per write; see :class:`swift.common.request_helpers.UsageTracker`
+and the ``quota_*`` options of the filter.
+"""
+from swift.common.request_helpers import UsageTracker
+from swift.common.utils import split_path
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+QUOTA_HEADERS = ('HTTP_X_CONTAINER_META_QUOTA_BYTES',
+                 'HTTP_X_CONTAINER_META_QUOTA_COUNT')
+
+
+def _quota(meta, name):
+    try:
+        return int(meta[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class ContainerQuotaMiddleware(Middleware):
+    """
+    WSGI middleware that enforces the quotas set on containers. See above
+    for a full description.
 
-class ContainerQuotaMiddleware(object):
-    """docstring for ContainerQuotaMiddleware"""
-    def __init__(self, app):
+    The proxy logs created for any subrequests made will have swift.source
+    set to "CQ".
+    """
+    def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
+        self.conf = conf
+        self.usage = UsageTracker(
+            app, float(conf.get('quota_reconcile_interval', 10)),
+            int(conf.get('quota_slack_bytes', 104857600)),
+            int(conf.get('quota_slack_count', 1000)),
+            int(conf.get('quota_cache_size', 10000)), 'CQ')
+
+    def _error(self, start_response, status, body):
+        body = body.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _count_on_success(self, start_response, account, container, nbytes,
+                          count):
+        def count_write(status, headers):
+            if status.startswith('2'):
+                self.usage.add(account, container, nbytes, count)
+            return status, headers
+        return self._rewrite_start_response(start_response, count_write)
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        method = env['REQUEST_METHOD']
+        try:
+            vrs, account, container, obj = split_path(
+                env.get('PATH_INFO', ''), 3, 4, True)
+        except ValueError:
+            return self.app(env, start_response)
+
+        if not obj:
+            if method in ('PUT', 'POST'):
+                for header in QUOTA_HEADERS:
+                    value = env.get(header)
+                    if value and not value.isdigit():
+                        return self._error(
+                            start_response, '400 Bad Request',
+                            'Invalid %s' % header[5:].title().replace(
+                                '_', '-'))
+                # a quota may have been set: look again
+                self.usage.forget(account, container)
+            return self.app(env, start_response)
+
+        if method not in ('PUT', 'DELETE'):
+            return self.app(env, start_response)
+        meta = self.usage.get(env, account, container).info['meta']
+        quota_bytes = _quota(meta, 'quota-bytes')
+        quota_count = _quota(meta, 'quota-count')
+        if quota_bytes is None and quota_count is None:
+            return self.app(env, start_response)
+
+        if method == 'DELETE':
+            # the bytes freed are unknown until the next reconcile
+            return self.app(env, self._count_on_success(
+                start_response, account, container, 0, -1))
+
+        try:
+            nbytes = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            nbytes = 0
+        usage = self.usage.get_for_write(env, account, container, nbytes)
+        if quota_bytes is not None and usage.bytes + nbytes > quota_bytes or \
+                quota_count is not None and usage.count + 1 > quota_count:
+            return self._error(start_response,
+                               '413 Request Entity Too Large',
+                               'Upload exceeds quota.')
+        return self.app(env, self._count_on_success(
+            start_response, account, container, nbytes, 1))
 
 
 def filter_factory(global_conf, **local_conf):
@@ -25,5 +131,5 @@ def filter_factory(global_conf, **local_conf):
 
     def container_quota_filter(app):
         pass  # (WIS) print "%s (%s -> %s)" % (__name__, whosdaddy(), whoami())
-        return ContainerQuotaMiddleware(app)
+        return ContainerQuotaMiddleware(app, conf)
     return container_quota_filter
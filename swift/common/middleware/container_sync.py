@@ -1,20 +1,97 @@
+"""
+Middleware that lets requests made by container sync in a sister cluster
+through.
+
+A sync request carries ``X-Container-Sync-Auth: <realm> <nonce> <sig>``,
+``sig`` being the HMAC of the request made with the realm's key and the
+container's ``X-Container-Sync-Key``; see
+:class:`swift.common.container_sync_realms.ContainerSyncRealms`. A valid
+one skips the usual authorization, as it has none of the user's
+credentials; an invalid one gets a ``401``.
+
+Checking one costs no backend request as long as the realms conf has not
+changed and the container's info is cached: the realm keys are read from
+``container-sync-realms.conf`` only when its mtime changes, and the sync
+key comes from the container info of
+:func:`swift.common.request_helpers.get_container_info`.
+
+The sending side is :class:`swift.container.sync.ContainerSyncWorker`.
+"""
+import os
+import re
+
+from swift.common.container_sync_realms import ContainerSyncRealms
+from swift.common.request_helpers import get_container_info
+from swift.common.utils import get_logger, split_path, streq_const_time
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+# what get_sig gives; anything else could never match
+SIG_RE = re.compile(r'^[0-9a-f]+$')
 
-class ContainerSync(object):
-    """docstring for ContainerSync"""
+
+class ContainerSync(Middleware):
+    """
+    WSGI middleware that validates an incoming container sync request
+    using the container-sync-realms.conf style of container sync.
+
+    The proxy logs created for any subrequests made will have swift.source
+    set to "CS".
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.logger = get_logger(conf, log_route='container_sync')
+        self.realms_conf = ContainerSyncRealms(
+            os.path.join(conf.get('swift_dir', '/etc/swift'),
+                         'container-sync-realms.conf'),
+            self.logger,
+            float(conf.get('mtime_check_interval', 300)))
+
+    def _unauthorized(self, start_response, reason):
+        body = ('X-Container-Sync-Auth header not valid; %s\n'
+                % reason).encode('utf-8')
+        start_response('401 Unauthorized', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body)))])
+        return [body]
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        auth = env.get('HTTP_X_CONTAINER_SYNC_AUTH')
+        if not auth:
+            return self.app(env, start_response)
+        try:
+            realm, nonce, sig = auth.split()
+            split_path(env['PATH_INFO'], 3, 4, True)
+        except ValueError:
+            return self._unauthorized(start_response, 'bad request')
+        if not SIG_RE.match(sig):
+            return self._unauthorized(start_response, 'bad signature')
+        realm_keys = [key for key in (self.realms_conf.key(realm),
+                                      self.realms_conf.key2(realm)) if key]
+        if not realm_keys:
+            return self._unauthorized(start_response, 'unknown realm')
+        user_key = get_container_info(env, self.app,
+                                      swift_source='CS').get('sync_key')
+        if not user_key:
+            return self._unauthorized(start_response, 'no sync key')
+        valid = False
+        for realm_key in realm_keys:
+            expected = self.realms_conf.get_sig(
+                env['REQUEST_METHOD'], env['PATH_INFO'],
+                env.get('HTTP_X_TIMESTAMP', '0'), nonce, realm_key, user_key)
+            valid |= streq_const_time(expected, sig)
+        if not valid:
+            return self._unauthorized(start_response, 'bad signature')
+        env['swift.authorize_override'] = True
+        env['swift.authorize'] = lambda env: None
+        env['swift.container_sync'] = realm
+        return self.app(env, start_response)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -1,20 +1,313 @@
+"""
+Middleware that will provide Dynamic Large Object (DLO) support.
+
+An object with an ``X-Object-Manifest: <container>/<prefix>`` header is a
+DLO manifest; a GET of it returns every object in the container whose name
+starts with the prefix, concatenated in listing order.
+
+The listing is paged through lazily: the first segment starts streaming as
+soon as the first page is in, while the next page is already being
+fetched. Segments are fetched ``prefetch_segments`` ahead, as for static
+large objects. A complete listing is kept per worker for
+``listing_cache_ttl`` seconds, keyed by container and prefix, and dropped
+as soon as a segment's ETag no longer matches it.
+
+With a cached or single-page listing the size and ETag of the whole object
+are known, so they are sent and a Range is served by skipping straight to
+the segments it covers. A listing longer than a page is otherwise sent
+without a Content-Length. A Range with both ends given on one is served
+as soon as the listing reaches its last byte, with a Content-Range whose
+total size is ``*``; a suffix or open-ended Range, or a HEAD, has the
+listing read in full first. Either way the segments before the range are
+never fetched.
+"""
+import itertools
+import json
+from collections import namedtuple
+from hashlib import md5
+
+try:
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import quote, unquote
+
+import eventlet
+
+from swift.common.request_helpers import RANGE_RE, SegmentedIterable, \
+    parse_range, segment_byte_ranges
+from swift.common.utils import LRUCache, close_if_possible, split_path
+from swift.common.wsgi import Middleware, call_subrequest, make_env
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+CONTAINER_LISTING_LIMIT = 10000
+
+# A complete segment listing. ``segments`` are dicts with the ``name`` (as
+# /container/object), ``bytes`` and ``hash`` of each segment, ``starts``
+# their offsets in the large object.
+Listing = namedtuple('Listing', 'segments starts size etag')
+
+
+class ListingError(Exception):
+    pass
+
+
+def make_listing(segments):
+    starts = []
+    size = 0
+    etags = md5()
+    for seg in segments:
+        starts.append(size)
+        size += int(seg['bytes'])
+        etags.update(seg['hash'].encode('ascii'))
+    return Listing(segments, starts, size, etags.hexdigest())
+
+
+def bounded_range(range_header):
+    """
+    Returns the ``(first, last)`` byte positions of a single-range Range
+    header that gives both, or None.
+    """
+    match = RANGE_RE.match(range_header.replace(' ', ''))
+    if not match or not all(match.groups()):
+        return None
+    first, last = int(match.group(1)), int(match.group(2))
+    return (first, last) if first <= last else None
+
 
-class DynamicLargeObject(object):
-    """docstring for DynamicLargeObject"""
+class DynamicLargeObject(Middleware):
+    """
+    DLO Middleware
+
+    See above for a full description.
+
+    The proxy logs created by any subrequests made will have swift.source set
+    to "DLO".
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.listing_limit = int(conf.get('listing_page_size',
+                                          CONTAINER_LISTING_LIMIT))
+        self.prefetch_segments = int(conf.get('prefetch_segments', 4))
+        self.prefetch_window = int(conf.get('prefetch_window', 33554432))
+        self.listings = LRUCache(
+            int(conf.get('listing_cache_size', 1000)),
+            ttl=float(conf.get('listing_cache_ttl', 10)))
+
+    def _get_page(self, env, container_path, prefix, marker):
+        resp = call_subrequest(self.app, make_env(
+            env, 'GET', container_path, agent='%(orig)s DLO MultipartGET',
+            swift_source='DLO', query_string='format=json&%s' % '&'.join(
+                '%s=%s' % (key, quote(value, safe='')) for key, value in (
+                    ('prefix', prefix), ('marker', marker),
+                    ('limit', str(self.listing_limit))))))
+        try:
+            body = b''.join(resp.app_iter)
+        finally:
+            close_if_possible(resp.app_iter)
+        if resp.status_int == 404:
+            return []
+        if not 200 <= resp.status_int < 300:
+            raise ListingError(resp.status)
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise ListingError('invalid listing from %s' % container_path)
+
+    def _listing_pages(self, env, container_path, prefix):
+        """
+        Yields the segment listing a page at a time, fetching the next page
+        while the caller works on this one.
+        """
+        pending = eventlet.spawn(self._get_page, env, container_path,
+                                 prefix, '')
+        try:
+            while pending is not None:
+                page = pending.wait()
+                pending = None
+                if len(page) >= self.listing_limit:
+                    pending = eventlet.spawn(
+                        self._get_page, env, container_path, prefix,
+                        page[-1]['name'])
+                yield page
+        finally:
+            if pending is not None:
+                pending.kill()
+
+    @staticmethod
+    def _segments(container, page):
+        return [{'name': '/%s/%s' % (container, entry['name']),
+                 'bytes': int(entry['bytes']), 'hash': entry['hash']}
+                for entry in page]
+
+    def _lazy_ranges(self, first_page, pages, account_path, container,
+                     cache_key):
+        # caches the listing once it has all gone by
+        segments = []
+        try:
+            for page in itertools.chain([first_page], pages):
+                for seg in self._segments(container, page):
+                    segments.append(seg)
+                    if seg['bytes']:
+                        yield (account_path + seg['name'], 0,
+                               seg['bytes'] - 1, seg['bytes'], seg['hash'])
+            self.listings.set(cache_key, make_listing(segments))
+        finally:
+            pages.close()
+
+    def _segments_through(self, first_page, pages, container, last):
+        """
+        Lists segments until they cover byte ``last`` of the large object.
+
+        :returns: tuple of (segments, complete), complete telling whether
+                  the listing ran out first
+        """
+        segments = self._segments(container, first_page)
+        size = sum(seg['bytes'] for seg in segments)
+        while size <= last:
+            try:
+                page = next(pages)
+            except StopIteration:
+                return segments, True
+            page = self._segments(container, page)
+            segments.extend(page)
+            size += sum(seg['bytes'] for seg in page)
+        pages.close()
+        return segments, False
+
+    def get_or_head_response(self, env, start_response, resp, value):
+        """
+        Responds to a GET or HEAD of a manifest with the large object.
+
+        :param resp: the manifest's own response
+        :param value: its X-Object-Manifest header
+        """
+        close_if_possible(resp.app_iter)
+        vrs, account, _junk = split_path(env['PATH_INFO'], 3, 3, True)
+        account_path = '/'.join(['', vrs, account])
+        container, _junk, prefix = unquote(value).lstrip('/').partition('/')
+        container_path = '/'.join([account_path, container])
+        cache_key = '%s/%s' % (container_path, prefix)
+        headers = [(k, v) for k, v in resp.header_list
+                   if k.lower() not in ('content-length', 'etag',
+                                        'content-range', 'accept-ranges')]
+
+        listing = self.listings.get(cache_key)
+        if listing is None:
+            pages = self._listing_pages(env, container_path, prefix)
+            try:
+                first_page = next(pages)
+            except ListingError as err:
+                pages.close()
+                return self._error(
+                    start_response, '500 Internal Server Error',
+                    'Unable to list segments: %s' % err)
+            byte_range = env['REQUEST_METHOD'] == 'GET' and \
+                bounded_range(env.get('HTTP_RANGE', ''))
+            if byte_range and len(first_page) >= self.listing_limit:
+                # only as much of the listing as the range needs
+                try:
+                    segments, complete = self._segments_through(
+                        first_page, pages, container, byte_range[1])
+                except ListingError as err:
+                    return self._error(
+                        start_response, '500 Internal Server Error',
+                        'Unable to list segments: %s' % err)
+                listing = make_listing(segments)
+                if complete:
+                    self.listings.set(cache_key, listing)
+                else:
+                    first, last = byte_range
+                    headers.extend([
+                        ('Accept-Ranges', 'bytes'),
+                        ('Content-Range', 'bytes %d-%d/*' % (first, last)),
+                        ('Content-Length', str(last - first + 1))])
+                    start_response('206 Partial Content', headers)
+                    return SegmentedIterable(
+                        env, self.app, segment_byte_ranges(
+                            listing.segments, listing.starts, first, last,
+                            account_path),
+                        self.prefetch_segments, self.prefetch_window, 'DLO',
+                        on_error=lambda err: self.listings.delete(cache_key))
+            elif len(first_page) < self.listing_limit or \
+                    env['REQUEST_METHOD'] == 'HEAD' or env.get('HTTP_RANGE'):
+                # the size is known, or needed: finish the listing here
+                segments = self._segments(container, first_page)
+                try:
+                    for page in pages:
+                        segments.extend(self._segments(container, page))
+                except ListingError as err:
+                    return self._error(
+                        start_response, '500 Internal Server Error',
+                        'Unable to list segments: %s' % err)
+                listing = make_listing(segments)
+                self.listings.set(cache_key, listing)
+            else:
+                # stream while the rest of the listing comes in
+                start_response('200 OK', headers)
+                return SegmentedIterable(
+                    env, self.app, self._lazy_ranges(
+                        first_page, pages, account_path, container,
+                        cache_key),
+                    self.prefetch_segments, self.prefetch_window, 'DLO',
+                    on_error=lambda err: self.listings.delete(cache_key))
+
+        headers.append(('Etag', '"%s"' % listing.etag))
+        headers.append(('Accept-Ranges', 'bytes'))
+        first, last = 0, listing.size - 1
+        status = '200 OK'
+        if env.get('HTTP_RANGE'):
+            byte_range = parse_range(env['HTTP_RANGE'], listing.size)
+            if byte_range is False:
+                start_response('416 Requested Range Not Satisfiable', [
+                    ('Content-Range', 'bytes */%d' % listing.size),
+                    ('Content-Length', '0')])
+                return []
+            if byte_range:
+                first, last = byte_range
+                status = '206 Partial Content'
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                    first, last, listing.size)))
+        headers.append(('Content-Length', str(max(0, last - first + 1))))
+        start_response(status, headers)
+        if env['REQUEST_METHOD'] == 'HEAD' or last < first:
+            return []
+        return SegmentedIterable(
+            env, self.app,
+            segment_byte_ranges(listing.segments, listing.starts, first,
+                                last, account_path),
+            self.prefetch_segments, self.prefetch_window, 'DLO',
+            on_error=lambda err: self.listings.delete(cache_key))
+
+    def _error(self, start_response, status, body):
+        body = body.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        if env['REQUEST_METHOD'] not in ('GET', 'HEAD') or \
+                'multipart-manifest=get' in env.get('QUERY_STRING', ''):
+            return self.app(env, start_response)
+        try:
+            split_path(env.get('PATH_INFO', ''), 4, 4, True)
+        except ValueError:
+            return self.app(env, start_response)
+
+        resp = call_subrequest(self.app, env)
+        value = resp.headers.get('x-object-manifest')
+        # the manifest itself is empty, so a Range on it may have got a 416
+        if value and (200 <= resp.status_int < 300 or
+                      resp.status_int == 416):
+            return self.get_or_head_response(env, start_response, resp,
+                                             value)
+        start_response(resp.status, resp.header_list)
+        return resp.app_iter
 
 
 def filter_factory(global_conf, **local_conf):
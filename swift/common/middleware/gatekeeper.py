@@ -1,20 +1,167 @@
+"""
+The ``gatekeeper`` middleware imposes restrictions on the headers that
+may be included with requests and responses. Request headers are filtered
+to remove headers that should never be generated by a client. Similarly,
+response headers are filtered to remove private headers that should
+never be passed to a client.
+
+The ``gatekeeper`` middleware must always be present in the proxy server
+wsgi pipeline. It should be configured close to the start of the pipeline
+specified in ``/etc/swift/proxy-server.conf``, immediately after
+catch_errors and before any other middleware. It is essential that it is
+configured ahead of all middlewares using system metadata in order that
+they function correctly.
+
+If ``gatekeeper`` middleware is not configured in the pipeline then it will
+be automatically inserted close to the start of the pipeline by the proxy
+server.
+
+Being first in line, the gatekeeper is also where a worker sheds load it
+cannot take. It counts the requests in flight in the worker, and watches
+how late the event loop runs (see
+:class:`swift.common.utils.LoopLagMonitor`, or the server's own
+``swift.loop_lag`` when it has one, as the asyncio backend does), which
+is how long a request waits to be run once it has arrived. Past a
+threshold on either, new requests get a ``503`` with ``Retry-After``
+straight away rather than joining an ever slower queue. Requests of
+``priority_methods`` have thresholds of their own, so that reads can be
+kept going while writes and bulk operations are turned away.
+"""
+import threading
+
+from swift.common.utils import ClosingIterable, LoopLagMonitor
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+#: Prefixes of headers that are only for the cluster's own use: they are
+#: removed from requests coming in and responses going out.
+INTERNAL_HEADER_PREFIXES = ('x-account-sysmeta-', 'x-container-sysmeta-',
+                            'x-object-sysmeta-', 'x-backend-')
+
+BULK_QUERIES = ('extract-archive', 'bulk-delete')
+
+
+def _env_prefixes(prefixes):
+    return tuple('HTTP_' + prefix.upper().replace('-', '_')
+                 for prefix in prefixes)
+
+
+class _Admitted(ClosingIterable):
+    """Counts its request out of the worker when the body is done with."""
+
+    def __init__(self, app_iter, gatekeeper):
+        super(_Admitted, self).__init__(app_iter)
+        self.gatekeeper = gatekeeper
 
-class GatekeeperMiddleware(object):
-    """docstring for GatekeeperMiddleware"""
+    def close(self):
+        gatekeeper, self.gatekeeper = self.gatekeeper, None
+        if gatekeeper is not None:
+            gatekeeper.release()
+        super(_Admitted, self).close()
+
+
+class GatekeeperMiddleware(Middleware):
+    """
+    Strips internal headers and sheds load; see above for a full
+    description.
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.inbound_exclusions = _env_prefixes(INTERNAL_HEADER_PREFIXES)
+        self.outbound_exclusions = INTERNAL_HEADER_PREFIXES
+        self.priority_methods = frozenset(
+            conf.get('priority_methods', 'GET HEAD').upper().split())
+        # 0 is no limit; priority requests default to the general limits
+        self.max_in_flight = int(conf.get('max_in_flight', 0))
+        self.max_in_flight_priority = int(conf.get(
+            'max_in_flight_priority', self.max_in_flight))
+        self.max_loop_lag = float(conf.get('max_loop_lag', 0))
+        self.max_loop_lag_priority = float(conf.get(
+            'max_loop_lag_priority', self.max_loop_lag))
+        self.retry_after = conf.get('retry_after', '1')
+        self.loop_lag = LoopLagMonitor(
+            float(conf.get('loop_lag_check_interval', 0.1)))
+        self.in_flight = 0
+        self.shed = 0
+        # the asyncio backend runs requests on several threads
+        self.lock = threading.Lock()
+
+    def _is_priority(self, env):
+        if env['REQUEST_METHOD'] not in self.priority_methods:
+            return False
+        query = env.get('QUERY_STRING')
+        return not (query and any(q in query for q in BULK_QUERIES))
+
+    def _overloaded(self, env):
+        if self._is_priority(env):
+            max_in_flight = self.max_in_flight_priority
+            max_loop_lag = self.max_loop_lag_priority
+        else:
+            max_in_flight = self.max_in_flight
+            max_loop_lag = self.max_loop_lag
+        if max_in_flight and self.in_flight >= max_in_flight:
+            return True
+        if max_loop_lag:
+            loop_lag = env.get('swift.loop_lag')
+            if loop_lag is None:
+                loop_lag = self.loop_lag
+                loop_lag.start()
+            return loop_lag.lag > max_loop_lag
+        return False
+
+    def _admit(self, env):
+        """Counts the request into the worker, unless it is overloaded."""
+        with self.lock:
+            if self._overloaded(env):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _shed(self, start_response):
+        body = b'503 Service Unavailable: server busy, retry later\n'
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', self.retry_after)])
+        return [body]
+
+    def _strip_outbound(self, status, headers):
+        exclusions = self.outbound_exclusions
+        for key, _value in headers:
+            if key.lower().startswith(exclusions):
+                break
+        else:
+            return status, headers
+        return status, [(k, v) for k, v in headers
+                        if not k.lower().startswith(exclusions)]
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        if not self._admit(env):
+            return self._shed(start_response)
+
+        exclusions = self.inbound_exclusions
+        forbidden = [key for key in env if key.startswith(exclusions)]
+        for key in forbidden:
+            del env[key]
+
+        try:
+            app_iter = self.app(env, self._rewrite_start_response(
+                start_response, self._strip_outbound))
+        except BaseException:
+            self.release()
+            raise
+        return _Admitted(app_iter, self)
 
 
 def filter_factory(global_conf, **local_conf):
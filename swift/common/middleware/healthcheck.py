@@ -1,20 +1,98 @@
+"""
+Healthcheck middleware used for monitoring.
+
+A GET or HEAD of ``/healthcheck`` returns ``200 OK`` with a body of
+``OK``. If the ``disable_path`` file exists, it returns ``503 Service
+Unavailable`` with ``DISABLED BY FILE`` instead, so a node can be drained
+from its load balancers by touching a file.
+
+Load balancers probe every few seconds, so the filter is moved in front of
+every other one when the pipeline is built, wherever the config puts it,
+and answers from responses built once. The ``disable_path`` file is looked
+for at most once per ``disable_path_check_interval`` seconds.
+
+Each answer comes from one worker, and says which in ``X-Worker-Pid``. It
+also carries that worker's event loop lag, how late a periodic timer
+fires (or the server's own ``swift.loop_lag``, under the asyncio
+backend), in ``X-Event-Loop-Lag`` (seconds); past ``max_loop_lag`` the worker
+answers ``503`` with ``BUSY``, so that load balancers can steer away from a
+saturated worker.
+"""
+import os
+import time
+
+from swift.common.utils import LoopLagMonitor
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+HEALTHCHECK_PATH = '/healthcheck'
+
+
+def _response(status, body):
+    return status, body, [('Content-Type', 'text/plain'),
+                          ('Content-Length', str(len(body)))]
+
+
+class HealthCheckMiddleware(Middleware):
+    """
+    Healthcheck middleware used for monitoring. See above for a full
+    description.
+    """
+    OK = _response('200 OK', b'OK')
+    DISABLED = _response('503 Service Unavailable', b'DISABLED BY FILE')
+    BUSY = _response('503 Service Unavailable', b'BUSY')
 
-class HealthCheckMiddleware(object):
-    """docstring for HealthCheckMiddleware"""
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.disable_path = conf.get('disable_path', '')
+        self.disable_check_interval = float(
+            conf.get('disable_path_check_interval', 1))
+        self.max_loop_lag = float(conf.get('max_loop_lag', 0))
+        self.loop_lag = LoopLagMonitor(
+            float(conf.get('loop_lag_check_interval', 0.1)))
+        self._pid = None
+        self._disabled = False
+        self._disabled_checked = 0
+
+    def disabled(self):
+        if not self.disable_path:
+            return False
+        now = time.time()
+        if now - self._disabled_checked >= self.disable_check_interval:
+            self._disabled = os.path.exists(self.disable_path)
+            self._disabled_checked = now
+        return self._disabled
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        if env.get('PATH_INFO') != HEALTHCHECK_PATH or \
+                env['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.app(env, start_response)
+
+        loop_lag = env.get('swift.loop_lag')
+        if self._pid is None:
+            # first probe of this worker
+            self._pid = str(os.getpid())
+            if loop_lag is None:
+                self.loop_lag.start()
+        lag = (loop_lag or self.loop_lag).lag
+        if self.disabled():
+            status, body, headers = self.DISABLED
+        elif self.max_loop_lag and lag > self.max_loop_lag:
+            status, body, headers = self.BUSY
+        else:
+            status, body, headers = self.OK
+        start_response(status, headers + [
+            ('X-Worker-Pid', self._pid),
+            ('X-Event-Loop-Lag', '%.4f' % lag)])
+        if env['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
+        return [body]
 
 
 def filter_factory(global_conf, **local_conf):
@@ -26,4 +104,6 @@ def filter_factory(global_conf, **local_conf):
     def healthcheck_filter(app):
         pass  # (WIS) print "%s (%s -> %s)" % (__name__, whosdaddy(), whoami())
         return HealthCheckMiddleware(app, conf)
+    # answer probes before any other filter sees them
+    healthcheck_filter.ahead_of_pipeline = True
     return healthcheck_filter
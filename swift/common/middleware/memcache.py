@@ -1,20 +1,35 @@
+from swift.common.memcached import MemcacheRing
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
 
-class MemcacheMiddleware(object):
-    """docstring for MemcacheMiddleware"""
+class MemcacheMiddleware(Middleware):
+    """
+    Caching middleware that manages caching in swift. Publishes the worker's
+    memcache client to the rest of the pipeline as ``env['swift.cache']``.
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        # built per worker: the connections must not be shared across fork
+        self.memcache = MemcacheRing(
+            [s.strip() for s in
+             conf.get('memcache_servers', '127.0.0.1:11211').split(',')
+             if s.strip()],
+            connect_timeout=float(conf.get('connect_timeout', 0.3)),
+            io_timeout=float(conf.get('io_timeout', 2.0)),
+            pool_size=int(conf.get('memcache_max_connections', 4)),
+            lru_size=int(conf.get('memcache_lru_size', 1024)),
+            lru_ttl=float(conf.get('memcache_lru_ttl', 1.0)))
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        env['swift.cache'] = self.memcache
+        return self.app(env, start_response)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -1,20 +1,419 @@
+"""
+Logging middleware for the Swift proxy.
+
+Every request is logged once, when its response body is finished with, as a
+single access log line::
+
+    client_ip remote_addr datetime method path protocol status_int
+    bytes_recvd bytes_sent trans_id ttfb request_time policy_index
+
+The request path only stores the raw values in a preallocated ring buffer;
+a background task (see :func:`swift.common.utils.spawn_background`) formats
+them and writes them out in batches, and the write itself blocks no
+request and no hub. When the buffer is full records are dropped and
+counted rather than waited on. What is left in it is written as the
+worker exits.
+
+Counts, transfer totals and timing histograms per request type, method,
+status and policy are kept in the worker and sent to StatsD as a few UDP
+packets every ``log_statsd_emit_interval`` seconds, rather than a packet
+per request.
+
+The filter is meant to appear twice in the pipeline, first and next to
+last. The inner one logs what reaches the proxy app; the outer one only
+logs requests the filters between them answered on their own.
+"""
+import socket
+import threading
+import time
+
+import eventlet
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from swift.common.utils import ClosingIterable, Histogram, get_logger, \
+    monotonic, on_worker_exit, run_blocking, spawn_background, split_path
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+LOG_MADE = 'swift.proxy_access_log_made'
+# keeps a multi-metric packet inside one unfragmented datagram
+MAX_PACKET = 1432
+
+
+def _format_record(record):
+    (when, client, remote, method, path, protocol, status, bytes_in,
+     bytes_out, trans_id, ttfb, total, policy) = record
+    return '%s %s %s %s %s %s %s %d %d %s %.4f %.4f %s' % (
+        client or '-', remote or '-',
+        time.strftime('%d/%b/%Y/%H/%M/%S', time.gmtime(when)),
+        method, quote(path), protocol, status, bytes_in, bytes_out,
+        trans_id or '-', ttfb, total,
+        '-' if policy is None else policy)
+
+
+class AccessLogBuffer(object):
+    """
+    Bounded ring of unformatted access log records, drained in batches.
+
+    :param write: called with a list of formatted lines, through
+                  :func:`swift.common.utils.run_blocking`
+    :param size: most records held while waiting for the next flush
+    :param interval: seconds between flushes
+    """
+
+    def __init__(self, write, size=8192, interval=1.0):
+        self.write = write
+        self.size = size
+        self.interval = interval
+        self.slots = [None] * size
+        self.start = 0
+        self.count = 0
+        self.dropped = 0
+        self.started = False
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        with self.lock:
+            if self.count == self.size:
+                self.dropped += 1
+                return
+            self.slots[(self.start + self.count) % self.size] = record
+            self.count += 1
+            start, self.started = not self.started, True
+        if start:
+            # started on first use, so it belongs to the worker
+            spawn_background(self._run)
+            on_worker_exit(self.flush)
+
+    def take(self):
+        """
+        Empties the ring, returning its records oldest first and how many
+        were dropped since the last time.
+        """
+        records = []
+        with self.lock:
+            slots, size = self.slots, self.size
+            for i in range(self.start, self.start + self.count):
+                records.append(slots[i % size])
+                slots[i % size] = None
+            self.start = (self.start + self.count) % size
+            self.count = 0
+            dropped, self.dropped = self.dropped, 0
+        return records, dropped
+
+    def flush(self):
+        records, dropped = self.take()
+        lines = [_format_record(record) for record in records]
+        if dropped:
+            lines.append('dropped %d access log records' % dropped)
+        if lines:
+            # the ring keeps filling (or dropping) while this is out
+            run_blocking(self.write, lines)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                # the log destination failing must not end the flusher
+                pass
+
+
+class _Stat(object):
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timing = Histogram()
+        self.first_byte = Histogram()
+
+
+class StatsdAggregator(object):
+    """
+    Aggregates request metrics in the worker and sends them to StatsD in
+    batches.
+
+    Per metric name it sends a count, the bytes transferred, and the mean,
+    median and 99th percentile of the request and first-byte times. Means
+    go out as timers with a ``1/count`` sample rate, so StatsD still counts
+    every request. Plain counters can be sent too, with :meth:`increment`.
+
+    :param host: StatsD host
+    :param port: StatsD port
+    :param prefix: prepended to every metric name
+    :param interval: seconds between emissions
+    """
+
+    def __init__(self, host, port=8125, prefix='', interval=10.0):
+        self.target = (host, port)
+        self.prefix = prefix + '.' if prefix else ''
+        self.interval = interval
+        self.stats = {}
+        self.counters = {}
+        self.sock = None
+        self.started = False
+        self.send_errors = 0
+        self.lock = threading.Lock()
 
-class ProxyLoggingMiddleware(object):
-    """docstring for ProxyLoggingMiddleware"""
+    def update(self, name, bytes_in, bytes_out, ttfb, total):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = _Stat()
+            stat.count += 1
+            stat.bytes_in += bytes_in
+            stat.bytes_out += bytes_out
+            stat.timing.add(total)
+            stat.first_byte.add(ttfb)
+        self._start()
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        self._start()
+
+    def _start(self):
+        if not self.started:
+            with self.lock:
+                start, self.started = not self.started, True
+            if start:
+                spawn_background(self._run)
+                on_worker_exit(self.emit)
+
+    def lines(self):
+        """Takes the aggregated stats, returning them as StatsD lines."""
+        with self.lock:
+            stats, self.stats = self.stats, {}
+            counters, self.counters = self.counters, {}
+        lines = ['%s%s:%d|c' % (self.prefix, name, count)
+                 for name, count in sorted(counters.items())]
+        for name, stat in sorted(stats.items()):
+            name = self.prefix + name
+            rate = 1.0 / stat.count
+            lines.append('%s.count:%d|c' % (name, stat.count))
+            lines.append('%s.xfer:%d|c' % (name,
+                                           stat.bytes_in + stat.bytes_out))
+            for metric, histogram in (('timing', stat.timing),
+                                      ('first-byte.timing', stat.first_byte)):
+                lines.append('%s.%s:%.3f|ms|@%g' % (
+                    name, metric, histogram.total / stat.count * 1000, rate))
+                for pct in (50, 99):
+                    value = histogram.percentile(pct)
+                    if value != float('inf'):
+                        lines.append('%s.%s.p%d:%g|g' % (
+                            name, metric, pct, value * 1000))
+        return lines
+
+    def emit(self):
+        packet = []
+        length = 0
+        for line in self.lines():
+            if packet and length + len(line) + 1 > MAX_PACKET:
+                self._send('\n'.join(packet))
+                packet, length = [], 0
+            packet.append(line)
+            length += len(line) + 1
+        if packet:
+            self._send('\n'.join(packet))
+
+    def _send(self, payload):
+        if self.sock is None:
+            # resolved once; a lookup per packet would block the hub
+            self.target = (socket.gethostbyname(self.target[0]),
+                           self.target[1])
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        try:
+            self.sock.sendto(payload.encode('utf-8'), self.target)
+        except (IOError, OSError):
+            # a full socket buffer or an unreachable StatsD loses metrics,
+            # never requests
+            self.send_errors += 1
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            self.emit()
+
+
+class _CountingInput(object):
+
+    def __init__(self, wsgi_input):
+        self.wsgi_input = wsgi_input
+        self.bytes_read = 0
+
+    def read(self, *args, **kwargs):
+        chunk = self.wsgi_input.read(*args, **kwargs)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def readline(self, *args, **kwargs):
+        line = self.wsgi_input.readline(*args, **kwargs)
+        self.bytes_read += len(line)
+        return line
+
+
+class _LoggedBody(ClosingIterable):
+
+    def __init__(self, app_iter, logger, env, state, start):
+        super(_LoggedBody, self).__init__(app_iter)
+        self.logger = logger
+        self.env = env
+        self.state = state
+        self.start = start
+        self.ttfb = None
+        self.bytes_out = 0
+        self.logged = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.app_iter:
+                if self.ttfb is None:
+                    self.ttfb = monotonic() - self.start
+                self.bytes_out += len(chunk)
+                yield chunk
+        finally:
+            self._log()
+
+    def close(self):
+        try:
+            super(_LoggedBody, self).close()
+        finally:
+            self._log()
+
+    def _log(self):
+        if self.logged:
+            return
+        self.logged = True
+        total = monotonic() - self.start
+        self.logger.log_request(
+            self.env, self.state, self.bytes_out,
+            total if self.ttfb is None else self.ttfb, total)
+
+
+class ProxyLoggingMiddleware(Middleware):
+    """
+    Middleware that logs Swift proxy requests in the swift log format and
+    aggregates their metrics for StatsD.
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        # access_log_* settings override the log_* ones for this filter
+        access_log_conf = {}
+        for key in ('log_name', 'log_level', 'log_statsd_host',
+                    'log_statsd_port', 'log_statsd_metric_prefix',
+                    'log_statsd_emit_interval'):
+            value = conf.get('access_' + key, conf.get(key))
+            if value is not None:
+                access_log_conf[key] = value
+        log_path = conf.get('access_log_path')
+        if log_path:
+            self.access_file = open(log_path, 'a')
+            write = self._write_file
+        else:
+            self.access_logger = get_logger(
+                access_log_conf, log_route='proxy-access')
+            write = self._write_logger
+        self.access_log = AccessLogBuffer(
+            write, size=int(conf.get('access_log_buffer_size', 8192)),
+            interval=float(conf.get('access_log_flush_interval', 1.0)))
+        statsd_host = access_log_conf.get('log_statsd_host')
+        self.statsd = None
+        if statsd_host:
+            self.statsd = StatsdAggregator(
+                statsd_host,
+                int(access_log_conf.get('log_statsd_port', 8125)),
+                prefix=access_log_conf.get('log_statsd_metric_prefix', ''),
+                interval=float(
+                    access_log_conf.get('log_statsd_emit_interval', 10)))
+
+    def _write_file(self, lines):
+        self.access_file.write('\n'.join(lines) + '\n')
+        self.access_file.flush()
+
+    def _write_logger(self, lines):
+        for line in lines:
+            self.access_logger.info(line)
+
+    def log_request(self, env, state, bytes_out, ttfb, total):
+        """
+        Queues the access log record and updates the metrics for a finished
+        request. Nothing is formatted or written here.
+        """
+        if env.get(LOG_MADE):
+            # an inner copy of this filter already logged it
+            return
+        env[LOG_MADE] = True
+        status, policy = state
+        wsgi_input = env.get('wsgi.input')
+        bytes_in = wsgi_input.bytes_read \
+            if isinstance(wsgi_input, _CountingInput) else 0
+        method = env.get('REQUEST_METHOD', '-')
+        self.access_log.append((
+            time.time(), env.get('HTTP_X_FORWARDED_FOR') or
+            env.get('HTTP_X_CLUSTER_CLIENT_IP') or env.get('REMOTE_ADDR'),
+            env.get('REMOTE_ADDR'), method, env.get('PATH_INFO', ''),
+            env.get('SERVER_PROTOCOL', '-'), status, bytes_in, bytes_out,
+            env.get('swift.trans_id'), ttfb, total, policy))
+        if self.statsd is not None:
+            self.statsd.update(
+                self._metric_name(env, method, status, policy),
+                bytes_in, bytes_out, ttfb, total)
+
+    @staticmethod
+    def _metric_name(env, method, status, policy):
+        try:
+            parts = split_path(env.get('PATH_INFO', ''), 1, 4, True)
+        except ValueError:
+            parts = None
+        if not parts or parts[0] != 'v1' or not parts[1]:
+            stat_type = 'UNKNOWN'
+        elif parts[3]:
+            stat_type = 'object'
+        elif parts[2]:
+            stat_type = 'container'
+        else:
+            stat_type = 'account'
+        if stat_type == 'object' and policy is not None:
+            stat_type = 'object.policy.%s' % policy
+        return '%s.%s.%s' % (stat_type, method, status)
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        start = monotonic()
+        if 'wsgi.input' in env and \
+                not isinstance(env['wsgi.input'], _CountingInput):
+            env['wsgi.input'] = _CountingInput(env['wsgi.input'])
+        # status and policy index, filled in by start_response
+        state = [None, None]
+
+        def note_response(status, headers):
+            state[0] = status.split(' ', 1)[0]
+            for header, value in headers:
+                if header.lower() == 'x-backend-storage-policy-index':
+                    state[1] = value
+            return status, headers
+
+        try:
+            app_iter = self.app(env, self._rewrite_start_response(
+                start_response, note_response))
+        except Exception:
+            state[0] = '500'
+            self.log_request(env, state, 0, monotonic() - start,
+                             monotonic() - start)
+            raise
+        return _LoggedBody(app_iter, self, env, state, start)
 
 
 def filter_factory(global_conf, **local_conf):
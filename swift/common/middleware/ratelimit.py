@@ -1,20 +1,328 @@
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import eventlet
+
+from swift.common.utils import split_path
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+# slot: key hash, tokens left, time of last update
+SLOT = struct.Struct('=Qdd')
+PROBES = 8
+LOCK_STRIPES = 64
+
+
+class MaxSleepTimeHitError(Exception):
+    pass
+
+
+def interpret_conf_limits(conf, name_prefix, info=None):
+    """
+    Parses general parms for rate limits looking for things that
+    start with the provided name_prefix within the provided conf
+    and returns lists for both internal use and for /info
+
+    :param conf: conf dict to parse
+    :param name_prefix: prefix of config parms to look for
+    :param info: set to return extra stuff for /info registration
+    """
+    conf_limits = []
+    for conf_key in conf:
+        if conf_key.startswith(name_prefix):
+            cont_size = int(conf_key[len(name_prefix):])
+            rate = float(conf[conf_key])
+            conf_limits.append((cont_size, rate))
+
+    conf_limits.sort()
+    ratelimits = []
+    conf_limits_info = list(conf_limits)
+    while conf_limits:
+        cur_size, cur_rate = conf_limits.pop(0)
+        if conf_limits:
+            next_size, next_rate = conf_limits[0]
+            slope = (float(next_rate) - float(cur_rate)) \
+                / (next_size - cur_size)
+
+            def new_scope(cur_size, slope, cur_rate):
+                # making new scope for variables
+                return lambda x: (x - cur_size) * slope + cur_rate
+            line_func = new_scope(cur_size, slope, cur_rate)
+        else:
+            line_func = lambda x, cur_rate=cur_rate: cur_rate
+
+        ratelimits.append((cur_size, cur_rate, line_func))
+    if info is None:
+        return ratelimits
+    else:
+        return ratelimits, conf_limits_info
+
+
+def get_maxrate(ratelimits, size):
+    """
+    Returns number of requests allowed per second for given size.
+    """
+    last_func = None
+    if size is not None:
+        size = int(size)
+        for ratesize, rate, func in ratelimits:
+            if size < ratesize:
+                break
+            last_func = func
+        if last_func:
+            return last_func(size)
+    return None
+
+
+class SharedTokenBuckets(object):
+    """
+    Fixed-size table of token buckets in anonymous shared memory.
+
+    Create it before the workers fork and every worker on the node sees the
+    same buckets. A key hashes to a home slot and probes at most
+    ``PROBES`` slots from there; when they are all taken by other keys the
+    one updated longest ago is reused, so the table never grows.
+
+    Updates take one of ``LOCK_STRIPES`` locks, each a byte of the file the
+    table is mapped from locked with ``lockf``: the kernel drops a worker's
+    locks when it dies, so one killed halfway through an update holds up no
+    other. Those locks belong to the whole process, so a thread lock per
+    stripe keeps a worker's threads apart as well.
+
+    :param slots: number of buckets the table holds
+    """
+
+    def __init__(self, slots=65536):
+        # a whole number of stripes, so a key's probes share its lock
+        self.slots = max(1, -(-slots // LOCK_STRIPES)) * LOCK_STRIPES
+        # unlinked, and in memory where there is a tmpfs for it
+        self.file = tempfile.TemporaryFile(
+            dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.file.truncate(self.slots * SLOT.size)
+        self.table = mmap.mmap(self.file.fileno(), self.slots * SLOT.size)
+        self.thread_locks = [threading.Lock()
+                             for _junk in range(LOCK_STRIPES)]
 
-class RateLimitMiddleware(object):
-    """docstring for RateLimitMiddleware"""
-    def __init__(self, app, conf):
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        # 0 marks an empty slot
+        return struct.unpack('=Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+    def _lock(self, stripe, command):
+        while True:
+            try:
+                fcntl.lockf(self.file, command, 1, stripe)
+                return
+            except (IOError, OSError) as err:
+                if err.errno != errno.EINTR:
+                    raise
+
+    def acquire(self, key, rate, burst, max_sleep, now=None):
+        """
+        Takes a token from ``key``'s bucket.
+
+        :param rate: tokens added per second
+        :param burst: most tokens the bucket holds
+        :param max_sleep: longest wait, in seconds, a caller will accept
+        :returns: seconds the caller must wait before going ahead
+        :raises MaxSleepTimeHitError: if that wait would be over max_sleep;
+                                      no token is taken
+        """
+        key_hash = self._hash(key)
+        home = key_hash % self.slots
+        now = time.time() if now is None else now
+        stripe = home % LOCK_STRIPES
+        with self.thread_locks[stripe]:
+            self._lock(stripe, fcntl.LOCK_EX)
+            try:
+                offset = self._find(key_hash, home)
+                slot_hash, tokens, last = SLOT.unpack_from(self.table,
+                                                           offset)
+                if slot_hash != key_hash:
+                    tokens, last = burst, now
+                tokens = min(burst, tokens + max(0.0, now - last) * rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+                if wait > max_sleep:
+                    SLOT.pack_into(self.table, offset, key_hash, tokens, now)
+                    raise MaxSleepTimeHitError(
+                        'Max Sleep Time Exceeded: %.2f' % wait)
+                SLOT.pack_into(self.table, offset, key_hash, tokens - 1, now)
+            finally:
+                self._lock(stripe, fcntl.LOCK_UN)
+        return wait
+
+    def _find(self, key_hash, home):
+        # probes stay within the home slot's lock stripe, so one lock
+        # covers every slot a key can land in
+        oldest = oldest_time = None
+        for probe in range(PROBES):
+            index = (home + probe * LOCK_STRIPES) % self.slots
+            offset = index * SLOT.size
+            slot_hash, _tokens, last = SLOT.unpack_from(self.table, offset)
+            if slot_hash == key_hash or slot_hash == 0:
+                return offset
+            if oldest is None or last < oldest_time:
+                oldest, oldest_time = offset, last
+        return oldest
+
+
+class RateLimitMiddleware(Middleware):
+    """
+    Rate limits container PUTs/DELETEs per account, and object writes and
+    container listings per container, with token buckets shared by all the
+    workers on a node. A request over its limit waits its turn with a
+    cooperative sleep, or gets a 498 if that would take longer than
+    ``max_sleep_time_seconds``.
+
+    With ``ratelimit_backend = memcache`` and a cache in the pipeline the
+    limits are kept in memcache instead and hold across proxy nodes.
+    """
+    def __init__(self, app, conf, buckets=None):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.account_ratelimit = float(conf.get('account_ratelimit', 0))
+        self.max_sleep_time_seconds = \
+            float(conf.get('max_sleep_time_seconds', 60))
+        self.rate_buffer_seconds = int(conf.get('rate_buffer_seconds', 5))
+        self.clock_accuracy = int(conf.get('clock_accuracy', 1000))
+        self.use_memcache = \
+            conf.get('ratelimit_backend', 'shm').lower() == 'memcache'
+        self.container_ratelimits = interpret_conf_limits(
+            conf, 'container_ratelimit_')
+        self.container_listing_ratelimits = interpret_conf_limits(
+            conf, 'container_listing_ratelimit_')
+        self.buckets = buckets or SharedTokenBuckets(
+            int(conf.get('ratelimit_table_size', 65536)))
+
+    def get_ratelimitable_key_tuples(self, env, account_name,
+                                     container_name=None, obj_name=None):
+        """
+        Returns a list of key (used in memcache), ratelimit tuples. Keys
+        should be checked in order.
+        """
+        keys = []
+        method = env['REQUEST_METHOD']
+        if self.account_ratelimit and account_name and container_name and \
+                not obj_name and method in ('PUT', 'DELETE'):
+            keys.append(('ratelimit/%s' % account_name,
+                         self.account_ratelimit))
+
+        if account_name and container_name and obj_name and \
+                method in ('PUT', 'DELETE', 'POST', 'COPY'):
+            container_size = self._container_size(
+                env, account_name, container_name)
+            container_rate = get_maxrate(
+                self.container_ratelimits, container_size)
+            if container_rate:
+                keys.append((
+                    'ratelimit/%s/%s' % (account_name, container_name),
+                    container_rate))
+
+        if account_name and container_name and not obj_name and \
+                method == 'GET':
+            container_size = self._container_size(
+                env, account_name, container_name)
+            container_rate = get_maxrate(
+                self.container_listing_ratelimits, container_size)
+            if container_rate:
+                keys.append((
+                    'ratelimit_listing/%s/%s' % (account_name,
+                                                 container_name),
+                    container_rate))
+        return keys
+
+    def _container_size(self, env, account_name, container_name):
+        # object count from whatever container info the pipeline cached;
+        # an unknown container only matches a container_ratelimit_0
+        memcache_client = env.get('swift.cache')
+        if memcache_client:
+            info = memcache_client.get(
+                'container/%s/%s' % (account_name, container_name))
+            if isinstance(info, dict):
+                return info.get('object_count', 0)
+        return 0
+
+    def _get_sleep_time(self, env, key, max_rate):
+        """
+        Returns the amount of time (a float in seconds) that the app
+        should sleep.
+
+        :param key: a memcache key
+        :param max_rate: maximum rate allowed in requests per second
+        :raises MaxSleepTimeHitError: if max sleep time is exceeded.
+        """
+        memcache_client = env.get('swift.cache')
+        if not (self.use_memcache and memcache_client):
+            return self.buckets.acquire(
+                key, max_rate, max(1.0, max_rate * self.rate_buffer_seconds),
+                self.max_sleep_time_seconds)
+
+        # Running time as a counter in memcache, so every proxy node shares
+        # one schedule.
+        time_per_request_m = int(round(self.clock_accuracy / max_rate))
+        running_time_m = memcache_client.incr(key, delta=time_per_request_m)
+        now_m = int(round(time.time() * self.clock_accuracy))
+        need_to_sleep_m = 0
+        if now_m - running_time_m > \
+                self.rate_buffer_seconds * self.clock_accuracy:
+            next_avail_time = int(now_m + time_per_request_m)
+            memcache_client.set(key, str(next_avail_time), serialize=False)
+        else:
+            need_to_sleep_m = \
+                max(running_time_m - now_m - time_per_request_m, 0)
+
+        max_sleep_m = self.max_sleep_time_seconds * self.clock_accuracy
+        if max_sleep_m - need_to_sleep_m <= self.clock_accuracy * 0.01:
+            # treat as no-op decrement time
+            memcache_client.decr(key, delta=time_per_request_m)
+            raise MaxSleepTimeHitError(
+                'Max Sleep Time Exceeded: %.2f' %
+                (float(need_to_sleep_m) / self.clock_accuracy))
+        return float(need_to_sleep_m) / self.clock_accuracy
+
+    def handle_ratelimit(self, env, account_name, container_name, obj_name):
+        """
+        Performs rate limiting. Sleeps if necessary. Returns True if the
+        request was rate limited.
+        """
+        for key, max_rate in self.get_ratelimitable_key_tuples(
+                env, account_name, container_name=container_name,
+                obj_name=obj_name):
+            try:
+                need_to_sleep = self._get_sleep_time(env, key, max_rate)
+            except MaxSleepTimeHitError:
+                return True
+            if need_to_sleep > 0:
+                eventlet.sleep(need_to_sleep)
+        return False
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        try:
+            version, account, container, obj = split_path(
+                env.get('PATH_INFO', ''), 1, 4, True)
+        except ValueError:
+            return self.app(env, start_response)
+        if self.handle_ratelimit(env, account, container, obj):
+            body = b'Slow down'
+            start_response('498 Rate Limited', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(body)))])
+            return [body]
+        return self.app(env, start_response)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -37,8 +345,11 @@ def filter_factory(global_conf, **local_conf):
     #                     container_ratelimits=cont_limit_info,
     #                     container_listing_ratelimits=cont_list_limit_info)
 
+    # created here, before the workers fork, so they all share it
+    buckets = SharedTokenBuckets(int(conf.get('ratelimit_table_size', 65536)))
+
     def limit_filter(app):
         pass  # (WIS) print "%s (%s -> %s)" % (__name__, whosdaddy(), whoami())
-        return RateLimitMiddleware(app, conf)
+        return RateLimitMiddleware(app, conf, buckets=buckets)
 
     return limit_filter
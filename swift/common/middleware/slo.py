@@ -1,20 +1,303 @@
+"""
+Middleware that will provide Static Large Object (SLO) support.
+
+A static large object is a manifest object listing the segments that make
+it up, uploaded with ``?multipart-manifest=put`` and a JSON body of::
+
+    [{"path": "/cont/object", "etag": "etagoftheobjectsegment",
+      "size_bytes": 10485760}, ...]
+
+Every segment is HEADed, all at once, to check it exists and matches the
+etag and size given; the manifest is only stored if they all do.
+
+A GET of the manifest returns the concatenated segments. The manifest is
+parsed once per version and kept in a per-worker cache, checked against
+the manifest's ETag on every request. A client Range is mapped onto just
+the segments it overlaps. While one segment streams out the next
+``prefetch_segments`` are already being fetched, buffering at most
+``prefetch_window`` bytes between them, so a stream runs at the speed of
+several backends rather than one.
+
+``?multipart-manifest=get`` returns the manifest itself.
+"""
+import io
+import json
+from collections import namedtuple
+from hashlib import md5
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from eventlet import GreenPool
+
+from swift.common.request_helpers import SegmentedIterable, parse_range, \
+    segment_byte_ranges
+from swift.common.utils import LRUCache, close_if_possible, \
+    config_true_value, split_path
+from swift.common.wsgi import Middleware, call_subrequest, make_env
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+DEFAULT_MIN_SEGMENT_SIZE = 1024 * 1024  # 1 MiB
+DEFAULT_MAX_MANIFEST_SEGMENTS = 1000
+DEFAULT_MAX_MANIFEST_SIZE = 1024 * 1024 * 2  # 2 MiB
+
+# what json.loads gives back for a string, on py2 and py3
+STRING_TYPES = (str, type(u''))
+
+SYSMETA_ETAG = 'X-Object-Sysmeta-Slo-Etag'
+SYSMETA_SIZE = 'X-Object-Sysmeta-Slo-Size'
+
+# A parsed manifest. ``starts`` holds each segment's offset in the large
+# object, for bisecting.
+Manifest = namedtuple('Manifest', 'segments starts size etag')
+
+
+def parse_manifest(body):
+    """
+    Returns the :class:`Manifest` stored in a manifest object's body.
+
+    :raises ValueError: if the body is not a valid manifest
+    """
+    segments = json.loads(body)
+    if not isinstance(segments, list):
+        raise ValueError('Manifest must be a list')
+    starts = []
+    size = 0
+    etags = md5()
+    for seg in segments:
+        starts.append(size)
+        size += int(seg['bytes'])
+        etags.update(seg['hash'].encode('ascii'))
+    return Manifest(segments, starts, size, etags.hexdigest())
 
-class StaticLargeObject(object):
-    """docstring for StaticLargeObject"""
-    def __init__(self, app, conf):
+
+class StaticLargeObject(Middleware):
+    """
+    StaticLargeObject Middleware
+
+    See above for a full description.
+
+    The proxy logs created by any subrequests made will have swift.source set
+    to "SLO".
+
+    :param app: The next WSGI filter or app in the paste.deploy chain.
+    :param conf: The configuration dict for the middleware.
+    """
+    def __init__(self, app, conf, max_manifest_segments=DEFAULT_MAX_MANIFEST_SEGMENTS, max_manifest_size=DEFAULT_MAX_MANIFEST_SIZE, min_segment_size=DEFAULT_MIN_SEGMENT_SIZE):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.max_manifest_segments = max_manifest_segments
+        self.max_manifest_size = max_manifest_size
+        self.min_segment_size = min_segment_size
+        self.prefetch_segments = int(conf.get('prefetch_segments', 4))
+        self.prefetch_window = int(conf.get('prefetch_window', 33554432))
+        self.head_concurrency = int(conf.get('manifest_head_concurrency', 10))
+        self.manifests = LRUCache(int(conf.get('manifest_cache_size', 1000)))
+
+    def _error(self, start_response, status, body):
+        body = body.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def handle_multipart_put(self, env, start_response, account):
+        """
+        Will handle the PUT of a SLO manifest. HEADs every segment listed,
+        in parallel, and stores the manifest if they all check out.
+        """
+        try:
+            content_length = int(env.get('CONTENT_LENGTH') or -1)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            return self._error(start_response, '411 Length Required', '')
+        if content_length > self.max_manifest_size:
+            return self._error(start_response,
+                               '413 Request Entity Too Large',
+                               'Manifest File > %d bytes' %
+                               self.max_manifest_size)
+        raw = env['wsgi.input'].read(content_length)
+        try:
+            parsed = json.loads(raw.decode('utf-8'))
+            if not isinstance(parsed, list):
+                raise ValueError()
+            for seg in parsed:
+                if not isinstance(seg, dict) or \
+                        not isinstance(seg.get('path'), STRING_TYPES) or \
+                        '/' not in seg['path'].strip('/'):
+                    raise ValueError()
+                if seg.get('etag') is not None and \
+                        not isinstance(seg['etag'], STRING_TYPES):
+                    raise ValueError()
+                if seg.get('size_bytes') is not None:
+                    seg['size_bytes'] = int(seg['size_bytes'])
+        except (ValueError, TypeError):
+            return self._error(start_response, '400 Bad Request',
+                               'Manifest must be valid json.')
+        if len(parsed) > self.max_manifest_segments:
+            return self._error(start_response,
+                               '413 Request Entity Too Large',
+                               'Number segments must be <= %d' %
+                               self.max_manifest_segments)
+
+        def head_segment(index):
+            seg = parsed[index]
+            path = '/'.join(['', 'v1', account, seg['path'].lstrip('/')])
+            resp = call_subrequest(self.app, make_env(
+                env, 'HEAD', path, agent='%(orig)s SLO MultipartPUT',
+                swift_source='SLO'))
+            close_if_possible(resp.app_iter)
+            return index, seg, resp
+
+        problems = []
+        segments = [None] * len(parsed)
+        total_size = 0
+        pool = GreenPool(self.head_concurrency)
+        for index, seg, resp in pool.imap(head_segment, range(len(parsed))):
+            name = '/' + seg['path'].lstrip('/')
+            if not 200 <= resp.status_int < 300:
+                problems.append([quote(name), resp.status])
+                continue
+            size = int(resp.headers.get('content-length', 0))
+            etag = resp.headers.get('etag', '').strip('"')
+            expected_size = seg.get('size_bytes')
+            if expected_size is not None and expected_size != size:
+                problems.append([quote(name), 'Size Mismatch'])
+            if seg.get('etag') and seg['etag'] != etag:
+                problems.append([quote(name), 'Etag Mismatch'])
+            if size < self.min_segment_size and index < len(parsed) - 1:
+                problems.append([quote(name), 'Too Small; each segment, '
+                                 'except the last, must be at least '
+                                 '%d bytes.' % self.min_segment_size])
+            total_size += size
+            segments[index] = {
+                'name': name, 'bytes': size, 'hash': etag,
+                'content_type': resp.headers.get('content-type'),
+                'last_modified': resp.headers.get('last-modified')}
+        if problems:
+            return self._error(start_response, '400 Bad Request',
+                               'Errors:\n' + '\n'.join(
+                                   '%s, %s' % tuple(problem)
+                                   for problem in problems))
+
+        manifest = parse_manifest(json.dumps(segments))
+        body = json.dumps(segments).encode('utf-8')
+        headers = {'X-Static-Large-Object': 'True',
+                   SYSMETA_ETAG: manifest.etag,
+                   SYSMETA_SIZE: str(total_size)}
+        if env.get('CONTENT_TYPE'):
+            headers['Content-Type'] = env['CONTENT_TYPE']
+        return self.app(make_env(
+            env, 'PUT', agent=None, body_file=io.BytesIO(body),
+            content_length=len(body), headers=headers), start_response)
+
+    def _get_manifest(self, env, resp):
+        """
+        Returns the parsed manifest for a manifest GET response, from the
+        cache when the stored manifest hasn't changed.
+        """
+        path = env['PATH_INFO']
+        etag = resp.headers.get('etag')
+        cached = self.manifests.get(path)
+        if cached and etag and cached[0] == etag:
+            close_if_possible(resp.app_iter)
+            return cached[1]
+        if resp.status_int != 200:
+            # ranged or conditional; fetch the whole manifest
+            close_if_possible(resp.app_iter)
+            resp = call_subrequest(self.app, make_env(
+                env, 'GET', path, agent='%(orig)s SLO MultipartGET',
+                swift_source='SLO', query_string='multipart-manifest=get'))
+            etag = resp.headers.get('etag')
+        try:
+            body = b''.join(resp.app_iter)
+        finally:
+            close_if_possible(resp.app_iter)
+        manifest = parse_manifest(body.decode('utf-8'))
+        if etag:
+            self.manifests.set(path, (etag, manifest))
+        return manifest
+
+    def handle_manifest_get(self, env, start_response, resp):
+        """
+        Responds to a GET or HEAD of a manifest with the large object.
+        """
+        if env['REQUEST_METHOD'] == 'HEAD':
+            close_if_possible(resp.app_iter)
+            size = resp.headers.get(SYSMETA_SIZE.lower())
+            headers = [(k, v) for k, v in resp.header_list
+                       if k.lower() not in ('content-length', 'etag')]
+            if size is not None:
+                headers.append(('Content-Length', size))
+            if resp.headers.get(SYSMETA_ETAG.lower()):
+                headers.append(
+                    ('Etag', '"%s"' % resp.headers[SYSMETA_ETAG.lower()]))
+            start_response('200 OK', headers)
+            return []
+
+        try:
+            manifest = self._get_manifest(env, resp)
+        except (ValueError, KeyError, TypeError):
+            return self._error(start_response, '500 Internal Server Error',
+                               'Unable to load SLO manifest')
+        headers = [(k, v) for k, v in resp.header_list
+                   if k.lower() not in ('content-length', 'etag',
+                                        'content-range', 'accept-ranges')]
+        headers.append(('Etag', '"%s"' % manifest.etag))
+        headers.append(('Accept-Ranges', 'bytes'))
+        first, last = 0, manifest.size - 1
+        status = '200 OK'
+        if env.get('HTTP_RANGE'):
+            byte_range = parse_range(env['HTTP_RANGE'], manifest.size)
+            if byte_range is False:
+                headers = [('Content-Range', 'bytes */%d' % manifest.size),
+                           ('Content-Length', '0')]
+                start_response('416 Requested Range Not Satisfiable',
+                               headers)
+                return []
+            if byte_range:
+                first, last = byte_range
+                status = '206 Partial Content'
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                    first, last, manifest.size)))
+        headers.append(('Content-Length', str(max(0, last - first + 1))))
+        start_response(status, headers)
+        if last < first:
+            return []
+        vrs, account, _junk = split_path(env['PATH_INFO'], 3, 3, True)
+        return SegmentedIterable(
+            env, self.app,
+            segment_byte_ranges(manifest.segments, manifest.starts, first,
+                                last, '/'.join(['', vrs, account])),
+            self.prefetch_segments, self.prefetch_window, 'SLO')
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        try:
+            vrs, account, container, obj = split_path(
+                env.get('PATH_INFO', ''), 4, 4, True)
+        except ValueError:
+            return self.app(env, start_response)
+        query = env.get('QUERY_STRING', '')
+        method = env['REQUEST_METHOD']
+        if 'multipart-manifest=put' in query and method == 'PUT':
+            return self.handle_multipart_put(env, start_response, account)
+        if method not in ('GET', 'HEAD') or 'multipart-manifest=get' in query:
+            return self.app(env, start_response)
+
+        resp = call_subrequest(self.app, env)
+        if config_true_value(
+                resp.headers.get('x-static-large-object', 'false')) and \
+                (200 <= resp.status_int < 300 or resp.status_int == 416):
+            return self.handle_manifest_get(env, start_response, resp)
+        start_response(resp.status, resp.header_list)
+        return resp.app_iter
 
 
 def filter_factory(global_conf, **local_conf):
@@ -22,13 +305,13 @@ def filter_factory(global_conf, **local_conf):
     conf = global_conf.copy()
     conf.update(local_conf)
 
-    # max_manifest_segments = int(conf.get('max_manifest_segments',
-    #                                      DEFAULT_MAX_MANIFEST_SEGMENTS))
-    # max_manifest_size = int(conf.get('max_manifest_size',
-    #                                  DEFAULT_MAX_MANIFEST_SIZE))
-    # min_segment_size = int(conf.get('min_segment_size',
-    #                                 DEFAULT_MIN_SEGMENT_SIZE))
-    #
+    max_manifest_segments = int(conf.get('max_manifest_segments',
+                                         DEFAULT_MAX_MANIFEST_SEGMENTS))
+    max_manifest_size = int(conf.get('max_manifest_size',
+                                     DEFAULT_MAX_MANIFEST_SIZE))
+    min_segment_size = int(conf.get('min_segment_size',
+                                    DEFAULT_MIN_SEGMENT_SIZE))
+
     # register_swift_info('slo',
     #                     max_manifest_segments=max_manifest_segments,
     #                     max_manifest_size=max_manifest_size,
@@ -36,5 +319,9 @@ def filter_factory(global_conf, **local_conf):
 
     def slo_filter(app):
         pass  # (WIS) print "%s (%s -> %s)" % (__name__, whosdaddy(), whoami())
-        return StaticLargeObject(app, conf)
+        return StaticLargeObject(
+            app, conf,
+            max_manifest_segments=max_manifest_segments,
+            max_manifest_size=max_manifest_size,
+            min_segment_size=min_segment_size)
     return slo_filter
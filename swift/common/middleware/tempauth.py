@@ -1,20 +1,238 @@
+"""
+Test authentication and authorization system.
+
+Users are set up in the filter's section of the proxy config, one line
+each::
+
+    user_<account>_<user> = <key> [group] [group] [...] [storage_url]
+
+A user in the ``.admin`` group may do anything in its account, and one in
+``.reseller_admin`` in any account. These lines are read once, when the
+filter is built, into a dict keyed by ``account:user``.
+
+A token is got with a GET of ``<auth_prefix>v1.0`` carrying
+``X-Auth-User: <account>:<user>`` and ``X-Auth-Key: <key>``, and is good
+for ``token_life`` seconds. Tokens are kept in memcache, when the pipeline
+has one, so that any worker of any proxy can validate them; without one
+they are only known to the worker that issued them.
+
+Validating the token of every request must not mean a round trip to
+memcache, so each worker keeps the tokens it has validated in a bounded
+LRU keyed by a hash of the token, each entry expiring with its token. A
+token that could not be validated is remembered as such for
+``negative_cache_ttl`` seconds, so a client retrying a stale or bogus
+token in a tight loop costs one lookup rather than one per request.
+
+The proxy of this tree does not call ``swift.authorize`` itself, so the
+filter applies it on the way in, unless an earlier filter, such as
+tempurl, has set ``swift.authorize_override``.
+"""
+import time
+from hashlib import md5
+from uuid import uuid4
+
+from swift.common.utils import LRUCache, split_path, streq_const_time
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
 
-class TempAuth(object):
-    """docstring for TempAuth"""
+def parse_users(conf, reseller_prefix):
+    """
+    Returns the users of the ``user_*`` conf lines as a dict keyed by
+    ``account:user`` of dicts with their ``key``, ``groups`` (a comma
+    separated string, as it goes in REMOTE_USER) and ``url``, which is None
+    when the storage URL is to be made up from the request.
+    """
+    users = {}
+    for conf_key, value in conf.items():
+        if not conf_key.startswith('user_'):
+            continue
+        account, sep, username = conf_key[len('user_'):].partition('_')
+        if not sep or not account or not username:
+            raise ValueError('%s: expected user_<account>_<user>' % conf_key)
+        values = value.split()
+        if not values:
+            raise ValueError('%s has no key set' % conf_key)
+        key = values.pop(0)
+        url = None
+        if values and '://' in values[-1]:
+            url = values.pop()
+        groups = ['%s:%s' % (account, username), account]
+        for group in values:
+            if group == '.admin':
+                group = reseller_prefix + account
+            if group not in groups:
+                groups.append(group)
+        users['%s:%s' % (account, username)] = {
+            'key': key, 'groups': ','.join(groups), 'url': url,
+            'account_id': reseller_prefix + account}
+    return users
+
+
+class TempAuth(Middleware):
+    """
+    Test authentication and authorization middleware. See above for a full
+    description.
+
+    :param app: The next WSGI app in the pipeline
+    :param conf: The dict of configuration values from the Paste config file
+    """
     def __init__(self, app, conf):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
+        self.reseller_prefix = conf.get('reseller_prefix', 'AUTH').strip()
+        if self.reseller_prefix and self.reseller_prefix[-1] != '_':
+            self.reseller_prefix += '_'
+        self.auth_prefix = conf.get('auth_prefix', '/auth/')
+        if not self.auth_prefix.startswith('/'):
+            self.auth_prefix = '/' + self.auth_prefix
+        if not self.auth_prefix.endswith('/'):
+            self.auth_prefix += '/'
+        self.token_life = int(conf.get('token_life', 86400))
+        self.users = parse_users(conf, self.reseller_prefix)
+        self.tokens = LRUCache(int(conf.get('token_cache_size', 10000)))
+        self.bad_tokens = LRUCache(
+            int(conf.get('negative_cache_size', 10000)),
+            ttl=float(conf.get('negative_cache_ttl', 3)))
+
+    def _cache_key(self, token):
+        return '%s/token/%s' % (
+            self.reseller_prefix,
+            md5(token.encode('utf-8')).hexdigest())
+
+    def get_groups(self, env, token):
+        """
+        Returns the comma separated groups of the user ``token`` was issued
+        to, or None if it is not a valid token.
+        """
+        cache_key = self._cache_key(token)
+        groups = self.tokens.get(cache_key)
+        if groups is not None:
+            return groups
+        if self.bad_tokens.get(cache_key):
+            return None
+        memcache = env.get('swift.cache')
+        cached = memcache.get(cache_key) if memcache else None
+        if cached:
+            expires, groups = cached
+            if expires > time.time():
+                self.tokens.set(cache_key, groups, ttl=expires - time.time())
+                return groups
+        self.bad_tokens.set(cache_key, True)
+        return None
+
+    def authorize(self, env):
+        """
+        Returns None if the request may go ahead, or else a WSGI app that
+        denies it.
+        """
+        try:
+            vrs, account, container, obj = split_path(
+                env['PATH_INFO'], 2, 4, True)
+        except ValueError:
+            return self._deny(env, '404 Not Found')
+        groups = (env.get('REMOTE_USER') or '').split(',')
+        if account in groups or '.reseller_admin' in groups:
+            return None
+        if env.get('REMOTE_USER'):
+            return self._deny(env, '403 Forbidden')
+        return self._deny(env, '401 Unauthorized')
+
+    def _deny(self, env, status):
+        def app(env, start_response):
+            body = status.encode('utf-8')
+            headers = [('Content-Type', 'text/plain'),
+                       ('Content-Length', str(len(body)))]
+            if status.startswith('401'):
+                headers.append(('Www-Authenticate',
+                                'Swift realm="%s"' % self.reseller_prefix))
+            start_response(status, headers)
+            return [body]
+        return app
+
+    def handle_get_token(self, env, start_response):
+        """
+        Issues a token to the user of the X-Auth-User/X-Auth-Key (or
+        X-Storage-User/X-Storage-Pass) headers, reusing the one it already
+        has when that is still good.
+        """
+        user = env.get('HTTP_X_AUTH_USER') or env.get('HTTP_X_STORAGE_USER')
+        key = env.get('HTTP_X_AUTH_KEY') or env.get('HTTP_X_STORAGE_PASS')
+        record = self.users.get(user or '')
+        if record is None or key is None or \
+                not streq_const_time(record['key'], key):
+            return self._deny(env, '401 Unauthorized')(env, start_response)
+
+        memcache = env.get('swift.cache')
+        user_key = '%s/user/%s' % (self.reseller_prefix, user)
+        token = memcache.get(user_key) if memcache else None
+        expires = None
+        if token:
+            cached = memcache.get(self._cache_key(token))
+            if cached and cached[0] > time.time() and \
+                    cached[1] == record['groups']:
+                expires = cached[0]
+        if expires is None:
+            token = '%stk%s' % (self.reseller_prefix, uuid4().hex)
+            expires = time.time() + self.token_life
+            if memcache:
+                memcache.set(self._cache_key(token),
+                             (expires, record['groups']),
+                             time=self.token_life)
+                memcache.set(user_key, token, time=self.token_life)
+        cache_key = self._cache_key(token)
+        self.bad_tokens.delete(cache_key)
+        self.tokens.set(cache_key, record['groups'],
+                        ttl=expires - time.time())
+
+        url = record['url'] or '%s://%s/v1/%s' % (
+            env.get('wsgi.url_scheme', 'http'),
+            env.get('HTTP_HOST') or '%s:%s' % (
+                env.get('SERVER_NAME'), env.get('SERVER_PORT')),
+            record['account_id'])
+        start_response('200 OK', [
+            ('X-Auth-Token', token), ('X-Storage-Token', token),
+            ('X-Auth-Token-Expires', str(int(expires - time.time()))),
+            ('X-Storage-Url', url), ('Content-Length', '0')])
+        return [b'']
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        path = env.get('PATH_INFO', '')
+        if path.startswith(self.auth_prefix):
+            if env['REQUEST_METHOD'] == 'GET' and \
+                    path[len(self.auth_prefix):] in ('v1.0', 'v1', ''):
+                return self.handle_get_token(env, start_response)
+            return self._deny(env, '400 Bad Request')(env, start_response)
+
+        try:
+            vrs, account, _junk = split_path(path, 2, 3, True)
+        except ValueError:
+            return self.app(env, start_response)
+        if not account.startswith(self.reseller_prefix):
+            # someone else's account; leave it to their auth
+            return self.app(env, start_response)
+
+        token = env.get('HTTP_X_AUTH_TOKEN') or \
+            env.get('HTTP_X_STORAGE_TOKEN')
+        if token and token.startswith(self.reseller_prefix):
+            groups = self.get_groups(env, token)
+            if groups is None:
+                return self._deny(env, '401 Unauthorized')(
+                    env, start_response)
+            env['REMOTE_USER'] = groups
+            if '.reseller_admin' in groups.split(','):
+                env['reseller_request'] = True
+        if not env.get('swift.authorize_override'):
+            env['swift.authorize'] = self.authorize
+            denied = self.authorize(env)
+            if denied is not None:
+                return denied(env, start_response)
+        return self.app(env, start_response)
 
 
 def filter_factory(global_conf, **local_conf):
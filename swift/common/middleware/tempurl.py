@@ -1,21 +1,229 @@
+"""
+TempURL Middleware
+
+Allows the creation of URLs to provide temporary access to objects.
+
+For example, a website may wish to provide a link to download a large
+object in Swift, but the Swift account has no public access. The website
+can generate a URL that will provide GET access for a limited time to the
+resource. When the web browser user clicks on the link, the browser will
+download the object directly from Swift, obviating the need for the website
+to act as a proxy for the request.
+
+The signature is an HMAC of ``'%s\\n%s\\n%s' % (method, expires, path)``
+keyed with one of the account's ``X-Account-Meta-Temp-URL-Key`` /
+``-Key-2`` or the container's ``X-Container-Meta-Temp-URL-Key`` /
+``-Key-2``, hex encoded; SHA1, SHA256 and SHA512 are told apart by its
+length. It goes in the ``temp_url_sig`` query parameter, the expiry time in
+``temp_url_expires``.
+
+Validation sits on the hot path of any temp URL heavy workload, so:
+
+* the keys of an account or container are read once per
+  ``key_cache_ttl`` seconds, through memcache when there is one, and for
+  each key an HMAC object is built once and ``copy()``-ed per request
+  rather than rekeyed;
+* a signature that checked out is remembered, for the same method, path
+  and expiry, until it expires, for as long as the keys it was checked
+  against are unchanged;
+* signatures are compared in constant time.
+"""
+import hashlib
+import hmac
+import re
+import time
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+from swift.common.request_helpers import get_info
+from swift.common.utils import LRUCache, split_path, streq_const_time
+from swift.common.wsgi import Middleware
 from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+#: Default headers to remove from incoming requests. Simply a whitespace
+#: delimited list of header names and names can optionally end with '*' to
+#: indicate a prefix match.
+DEFAULT_INCOMING_REMOVE_HEADERS = 'x-timestamp'
+
+# hex signature length -> digest
+DIGESTS = {40: hashlib.sha1, 64: hashlib.sha256, 128: hashlib.sha512}
+# what hexdigest() gives; anything else could never match
+SIG_RE = re.compile(r'^[0-9a-f]+$')
+
+class KeySet(object):
+    """
+    The temp URL keys of an account or container, with an HMAC object
+    already keyed with each one per digest.
+    """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self._hmacs = {}
+
+    def hmacs(self, digest):
+        try:
+            return self._hmacs[digest]
+        except KeyError:
+            prebuilt = self._hmacs[digest] = [
+                hmac.new(key if isinstance(key, bytes)
+                         else key.encode('utf-8'), digestmod=digest)
+                for key in self.keys]
+            return prebuilt
+
 
-class TempURL(object):
-    """docstring for TempURL"""
+def _get_keys(info):
+    meta = info.get('meta', {})
+    return [meta[name] for name in ('temp-url-key', 'temp-url-key-2')
+            if meta.get(name)]
+
+
+class TempURL(Middleware):
+    """
+    WSGI Middleware to grant temporary URLs specific access to Swift
+    resources. See the overview for more information.
+
+    The proxy logs created for any subrequests made will have swift.source set
+    to "TU".
+
+    :param app: The next WSGI filter or app in the paste.deploy
+                chain.
+    :param conf: The configuration dict for the middleware.
+    :param methods: The HTTP methods a temp URL may be made for.
+    """
     def __init__(self, app, conf, methods):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
         self.app = app
         self.conf = conf
         self.methods = methods
+        self.key_cache = LRUCache(
+            int(conf.get('key_cache_size', 10000)),
+            ttl=float(conf.get('key_cache_ttl', 60)))
+        self.valid_sigs = LRUCache(int(conf.get('sig_cache_size', 100000)))
+        headers = conf.get('incoming_remove_headers',
+                           DEFAULT_INCOMING_REMOVE_HEADERS)
+        self.incoming_remove_headers = [
+            'HTTP_' + h.upper().replace('-', '_')
+            for h in headers.split() if not h.endswith('*')]
+        self.incoming_remove_headers_startswith = [
+            'HTTP_' + h[:-1].upper().replace('-', '_')
+            for h in headers.split() if h.endswith('*')]
+
+    def _get_key_sets(self, env, account, container):
+        """
+        Returns the :class:`KeySet` of the account and of the container,
+        loading them through the pipeline's cache when they have expired
+        here.
+        """
+        key_sets = []
+        for cache_key, container_name in (
+                (account, None), ((account, container), container)):
+            key_set = self.key_cache.get(cache_key)
+            if key_set is None:
+                info = get_info(self.app, env, account, container_name,
+                                swift_source='TU')
+                key_set = KeySet(_get_keys(info))
+                if 200 <= info['status'] < 300 or info['status'] == 404:
+                    # not an answer that may be different next time
+                    self.key_cache.set(cache_key, key_set)
+            key_sets.append(key_set)
+        return key_sets
+
+    def _valid(self, method, path, expires, sig, key_sets):
+        """
+        Checks ``sig`` against every key, trying the signatures a HEAD may
+        use too.
+        """
+        digest = DIGESTS.get(len(sig))
+        if digest is None:
+            return False
+        if method == 'HEAD':
+            methods = ('HEAD', 'GET', 'PUT')
+        else:
+            methods = (method,)
+        valid = False
+        for hmac_method in methods:
+            hmac_body = ('%s\n%s\n%s' % (hmac_method, expires, path)).encode(
+                'utf-8')
+            for key_set in key_sets:
+                for prebuilt in key_set.hmacs(digest):
+                    mac = prebuilt.copy()
+                    mac.update(hmac_body)
+                    # no early exit: the time taken says nothing of the match
+                    valid |= streq_const_time(mac.hexdigest(), sig)
+        return valid
+
+    def _invalid(self, env, start_response):
+        body = b'401 Unauthorized: Temp URL invalid\n'
+        start_response('401 Unauthorized', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body))),
+            ('Www-Authenticate', 'Swift realm="%s"' % env['PATH_INFO'])])
+        return [body]
+
+    def _clean_incoming_headers(self, env):
+        for name in self.incoming_remove_headers:
+            env.pop(name, None)
+        for prefix in self.incoming_remove_headers_startswith:
+            for name in [k for k in env if k.startswith(prefix)]:
+                del env[name]
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s\n" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__ + "  ->  " + self.app(env, start_response)
+        query_string = env.get('QUERY_STRING', '')
+        if 'temp_url_sig' not in query_string:
+            return self.app(env, start_response)
+        method = env['REQUEST_METHOD']
+        params = parse_qs(query_string, keep_blank_values=True)
+        sig = params.get('temp_url_sig', [''])[0]
+        expires = params.get('temp_url_expires', [''])[0]
+        if not sig or not expires or not SIG_RE.match(sig):
+            return self._invalid(env, start_response)
+        try:
+            expires_at = int(expires)
+        except ValueError:
+            return self._invalid(env, start_response)
+        now = time.time()
+        if expires_at < now or method not in self.methods:
+            return self._invalid(env, start_response)
+        path = env['PATH_INFO']
+        try:
+            vrs, account, container, obj = split_path(path, 4, 4, True)
+        except ValueError:
+            return self._invalid(env, start_response)
+
+        key_sets = self._get_key_sets(env, account, container)
+        keys = tuple(key_set.keys for key_set in key_sets)
+        sig_key = (method, path, expires, sig)
+        if self.valid_sigs.get(sig_key) != keys:
+            if not self._valid(method, path, expires, sig, key_sets):
+                return self._invalid(env, start_response)
+            # only good while the keys that signed it are
+            self.valid_sigs.set(sig_key, keys, ttl=expires_at - now)
+
+        self._clean_incoming_headers(env)
+        env['swift.authorize'] = lambda req: None
+        env['swift.authorize_override'] = True
+        env['REMOTE_USER'] = '.wsgi.tempurl'
+        if method == 'GET' and 'filename' in params:
+            filename = params['filename'][0].replace('"', '\\"')
+            disposition = 'inline' if 'inline' in params else 'attachment'
+
+            def add_disposition(status, headers):
+                headers = [(k, v) for k, v in headers
+                           if k.lower() != 'content-disposition']
+                headers.append(('Content-Disposition',
+                                '%s; filename="%s"' % (disposition,
+                                                       filename)))
+                return status, headers
+            start_response = self._rewrite_start_response(
+                start_response, add_disposition)
+        return self.app(env, start_response)
 
 
 def filter_factory(global_conf, **local_conf):
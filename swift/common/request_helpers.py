@@ -0,0 +1,482 @@
+"""
+Miscellaneous utility functions for use in generating responses.
+
+Why not swift.common.utils, you ask? Because this module deals with
+subrequests made through the pipeline, and utils shouldn't depend on
+swift.common.wsgi.
+"""
+import bisect
+import re
+import time
+
+import eventlet
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+
+from swift.common.utils import ClosingIterable, LRUCache, \
+    close_if_possible, split_path
+from swift.common.wsgi import call_subrequest, make_env
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# seconds account and container info stays in memcache
+INFO_CACHE_TIME = 60
+INFO_NOT_FOUND_CACHE_TIME = 3
+
+# fetcher -> consumer messages besides (chunk, counted) pairs
+_HANDOVER = object()
+_END = object()
+
+
+class SegmentError(Exception):
+    pass
+
+
+def headers_to_info(server_type, status_int, headers):
+    """
+    Builds the info dict cached for an account or container from the
+    lower-cased headers of a HEAD of it.
+
+    :param server_type: 'account' or 'container'
+    """
+    meta_prefix = 'x-%s-meta-' % server_type
+    sysmeta_prefix = 'x-%s-sysmeta-' % server_type
+    info = {'status': status_int, 'meta': {}, 'sysmeta': {}}
+    for key in ('bytes-used', 'object-count', 'container-count'):
+        value = headers.get('x-%s-%s' % (server_type, key))
+        info[key.replace('-used', '').replace('-', '_')] = \
+            int(value) if value is not None else None
+    for key, value in headers.items():
+        if key.startswith(meta_prefix):
+            info['meta'][key[len(meta_prefix):]] = value
+        elif key.startswith(sysmeta_prefix):
+            info['sysmeta'][key[len(sysmeta_prefix):]] = value
+    if server_type == 'container':
+        info['sync_key'] = headers.get('x-container-sync-key')
+    return info
+
+
+def _info_keys(account, container):
+    if container:
+        return ('container/%s/%s' % (account, container),
+                '/v1/%s/%s' % (account, container))
+    return 'account/%s' % account, '/v1/%s' % account
+
+
+def get_info(app, env, account, container=None, swift_source=None):
+    """
+    Returns the info dict of an account, or of a container if one is
+    given: its ``status``, ``bytes``, ``object_count`` (and
+    ``container_count`` for an account, ``sync_key`` for a container), and
+    its ``meta`` and ``sysmeta`` keyed by lower-cased name without the
+    prefix.
+
+    The info is looked for in the request's ``swift.infocache``, then in
+    the pipeline's memcache, and only then fetched with a HEAD; wherever it
+    came from it is kept in both for the next caller.
+
+    The HEAD is authorized already, as the middleware asking has yet to
+    decide whether the request may go on, and the info is the same
+    whoever asks for it. An answer of 401 or 403 is returned but never
+    cached.
+    """
+    info = _cached_info(env, _info_keys(account, container)[0])
+    if info is None:
+        return fetch_info(app, env, account, container, swift_source)
+    return info
+
+
+def _cached_info(env, cache_key):
+    # from swift.infocache or memcache, kept in the first; None if neither
+    infocache = env.setdefault('swift.infocache', {})
+    info = infocache.get(cache_key)
+    if info is not None:
+        return info
+    memcache = env.get('swift.cache')
+    if memcache:
+        info = memcache.get(cache_key)
+    if not isinstance(info, dict):
+        return None
+    infocache[cache_key] = info
+    return info
+
+
+def fetch_info(app, env, account, container=None, swift_source=None):
+    """
+    Like :func:`get_info`, but always fetches the info with a HEAD, and
+    replaces whatever was cached with it.
+    """
+    cache_key, path = _info_keys(account, container)
+    sub_env = make_env(
+        env, 'HEAD', path, agent='%%(orig)s %s' % (swift_source or ''),
+        swift_source=swift_source)
+    # authorized already (see get_info); without the client's credentials
+    # a bad token cannot get it refused either
+    sub_env.pop('HTTP_X_AUTH_TOKEN', None)
+    sub_env.pop('REMOTE_USER', None)
+    sub_env['swift.authorize_override'] = True
+    sub_env['swift.authorize'] = lambda env: None
+    resp = call_subrequest(app, sub_env)
+    close_if_possible(resp.app_iter)
+    info = headers_to_info('container' if container else 'account',
+                           resp.status_int, resp.headers)
+    if resp.status_int in (401, 403):
+        # says nothing of the account or container, so don't keep it
+        return info
+    memcache = env.get('swift.cache')
+    if memcache:
+        memcache.set(cache_key, info, time=INFO_CACHE_TIME
+                     if 200 <= resp.status_int < 300
+                     else INFO_NOT_FOUND_CACHE_TIME)
+    env.setdefault('swift.infocache', {})[cache_key] = info
+    return info
+
+
+def get_account_info(env, app, swift_source=None):
+    """
+    Returns the info dict of the account in the request path; see
+    :func:`get_info`.
+    """
+    vrs, account, _junk = split_path(env['PATH_INFO'], 2, 3, True)
+    return get_info(app, env, account, swift_source=swift_source)
+
+
+def get_container_info(env, app, swift_source=None):
+    """
+    Returns the info dict of the container in the request path; see
+    :func:`get_info`.
+    """
+    vrs, account, container, _junk = split_path(
+        env['PATH_INFO'], 3, 4, True)
+    return get_info(app, env, account, container, swift_source=swift_source)
+
+
+class Usage(object):
+    """
+    A worker's estimate of what an account or container holds: the
+    ``bytes`` and ``count`` (of objects) of its last reconcile with the
+    backend plus the writes this worker has seen succeed since, which are
+    also counted in ``pending_bytes`` and ``pending_count``.
+
+    :param info: the info dict it was loaded from; see :func:`get_info`
+    :param reconciled_at: when ``info`` came from the backend, 0 if it may
+                          have come from a cache
+    """
+
+    def __init__(self, info, reconciled_at=0):
+        self.info = info
+        self.bytes = info.get('bytes') or 0
+        self.count = info.get('object_count') or 0
+        self.pending_bytes = 0
+        self.pending_count = 0
+        self.reconciled_at = reconciled_at
+
+
+class UsageTracker(object):
+    """
+    Keeps, per worker, a :class:`Usage` of the accounts or containers
+    written to, so that enforcing a quota does not cost a HEAD per write.
+
+    Successful writes are added to the estimate as they complete. It is
+    reconciled with a HEAD of the backend once it is more than
+    ``reconcile_interval`` seconds old, or before a write that would take
+    the bytes or objects this worker has added since past ``slack_bytes``
+    or ``slack_count``. As every worker is held to the same slack, that is
+    about how far a burst spread over them can overshoot a quota.
+
+    :param cache_size: most accounts or containers kept
+    """
+
+    def __init__(self, app, reconcile_interval, slack_bytes, slack_count,
+                 cache_size, swift_source):
+        self.app = app
+        self.reconcile_interval = reconcile_interval
+        self.slack_bytes = slack_bytes
+        self.slack_count = slack_count
+        self.swift_source = swift_source
+        self.usages = LRUCache(cache_size, ttl=reconcile_interval)
+
+    def get(self, env, account, container=None):
+        """
+        Returns the :class:`Usage` of an account, or of a container, loading
+        it as :func:`get_info` would if this worker has none. Info it had to
+        HEAD the backend for counts as reconciled.
+        """
+        cache_key = _info_keys(account, container)[0]
+        usage = self.usages.get(cache_key)
+        if usage is None:
+            info = _cached_info(env, cache_key)
+            if info is None:
+                usage = Usage(fetch_info(self.app, env, account, container,
+                                         swift_source=self.swift_source),
+                              reconciled_at=time.time())
+            else:
+                usage = Usage(info)
+            self.usages.set(cache_key, usage)
+        return usage
+
+    def get_for_write(self, env, account, container=None, nbytes=0,
+                      count=1):
+        """
+        Returns the :class:`Usage` to check a write of ``nbytes`` and
+        ``count`` objects against, reconciled first if it is stale or the
+        write would go beyond the slack.
+        """
+        usage = self.get(env, account, container)
+        if time.time() - usage.reconciled_at > self.reconcile_interval or \
+                usage.pending_bytes + nbytes > self.slack_bytes or \
+                usage.pending_count + count > self.slack_count:
+            usage = self.reconcile(env, account, container)
+        return usage
+
+    def reconcile(self, env, account, container=None):
+        usage = Usage(fetch_info(self.app, env, account, container,
+                                 swift_source=self.swift_source),
+                      reconciled_at=time.time())
+        self.usages.set(_info_keys(account, container)[0], usage)
+        return usage
+
+    def add(self, account, container, nbytes, count):
+        """Counts a write that succeeded; negative for a delete."""
+        usage = self.usages.get(_info_keys(account, container)[0])
+        if usage is not None:
+            usage.bytes += nbytes
+            usage.count += count
+            usage.pending_bytes += max(nbytes, 0)
+            usage.pending_count += max(count, 0)
+
+    def forget(self, account, container=None):
+        self.usages.delete(_info_keys(account, container)[0])
+
+
+def parse_range(range_header, size):
+    """
+    Returns the ``(first, last)`` byte positions a single-range Range header
+    asks for, None if the header should be ignored, or False if the range
+    can't be satisfied.
+    """
+    match = RANGE_RE.match(range_header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None  # multiple or malformed ranges get the whole object
+    first, last = match.groups()
+    if not first:
+        suffix = int(last)
+        if not suffix or not size:
+            return False
+        return max(0, size - suffix), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    last = size - 1 if not last else min(int(last), size - 1)
+    return first, last
+
+
+def segment_byte_ranges(segments, starts, first, last, account_path):
+    """
+    Yields what :class:`SegmentedIterable` needs to fetch the bytes
+    ``first`` to ``last`` of a large object, skipping straight to the first
+    segment they overlap.
+
+    :param segments: dicts with the ``name`` (as /container/object),
+                     ``bytes`` and ``hash`` of each segment, in order
+    :param starts: offset of each segment in the large object
+    :param account_path: /version/account the segment names are under
+    """
+    index = bisect.bisect_right(starts, first) - 1
+    while index < len(segments) and starts[index] <= last:
+        seg = segments[index]
+        seg_start = starts[index]
+        seg_size = int(seg['bytes'])
+        if seg_size:
+            yield (account_path + seg['name'],
+                   max(first, seg_start) - seg_start,
+                   min(last, seg_start + seg_size - 1) - seg_start,
+                   seg_size, seg.get('hash'))
+        index += 1
+
+
+class _ReadAheadWindow(object):
+    """
+    Byte budget shared by the fetchers reading ahead of the segment being
+    sent. The head segment's fetcher never waits on it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.waiters = []
+
+    def acquire(self, fetch, nbytes):
+        """
+        Waits for room for ``nbytes`` unless ``fetch`` becomes the head.
+
+        :returns: True if the bytes were counted against the window
+        """
+        while not fetch.is_head and self.used and \
+                self.used + nbytes > self.size:
+            event = Event()
+            self.waiters.append(event)
+            event.wait()
+        if fetch.is_head:
+            return False
+        self.used += nbytes
+        return True
+
+    def release(self, nbytes):
+        self.used -= nbytes
+        self.wake()
+
+    def wake(self):
+        waiters, self.waiters = self.waiters, []
+        for event in waiters:
+            event.send()
+
+
+class _SegmentFetch(object):
+    """
+    One segment being fetched. Until it reaches the head of the stream its
+    chunks are read into ``queue`` against the window; once it does the
+    fetcher hands ``chunks`` over and the response reads them directly.
+    """
+
+    def __init__(self, env, app, path, first, last, seg_size, etag,
+                 swift_source):
+        self.is_head = False
+        self.queue = LightQueue()
+        self.chunks = None
+        self.resp = None
+        headers = None
+        if first > 0 or last < seg_size - 1:
+            headers = {'Range': 'bytes=%d-%d' % (first, last)}
+            etag = None  # a part of the segment has no etag to check
+        self.expected = last - first + 1
+        self.etag = etag
+        self.env = make_env(
+            env, 'GET', path,
+            agent='%%(orig)s %s MultipartGET' % swift_source,
+            swift_source=swift_source, headers=headers)
+        self.app = app
+        self.path = path
+        self.thread = None
+
+    def start(self, window):
+        self.thread = eventlet.spawn(self._run, window)
+
+    def _run(self, window):
+        try:
+            self.resp = call_subrequest(self.app, self.env)
+            if not 200 <= self.resp.status_int < 300:
+                raise SegmentError(
+                    'ERROR: While processing manifest, got %s while '
+                    'retrieving %s' % (self.resp.status, self.path))
+            length = self.resp.headers.get('content-length')
+            if length is not None and int(length) != self.expected:
+                raise SegmentError(
+                    'ERROR: While processing manifest, %s is %s bytes; '
+                    'expected %d' % (self.path, length, self.expected))
+            etag = self.resp.headers.get('etag', '').strip('"')
+            if self.etag and etag and etag != self.etag:
+                raise SegmentError(
+                    'Object segment no longer valid: %s etag: %s != %s' %
+                    (self.path, etag, self.etag))
+            self.chunks = iter(self.resp.app_iter)
+            while not self.is_head:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    self.queue.put(_END)
+                    return
+                self.queue.put((chunk, window.acquire(self, len(chunk))))
+            self.queue.put(_HANDOVER)
+        except Exception as err:
+            self.queue.put(err)
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.kill()
+        if self.resp is not None:
+            close_if_possible(self.resp.app_iter)
+
+
+class SegmentedIterable(ClosingIterable):
+    """
+    Iterable that returns the body of a large object from its segments,
+    keeping the next ``prefetch`` of them in flight.
+
+    :param segment_ranges: iterator of ``(path, first, last, seg_size,
+                           etag)``, one per segment to send, as made by
+                           :func:`segment_byte_ranges`; it may block, as
+                           long as it does so cooperatively
+    :param window_size: most bytes the segments fetched ahead may buffer
+    :param swift_source: logging tag for the segment GETs
+    :param on_error: called with the :class:`SegmentError` before it is
+                     raised
+    """
+
+    def __init__(self, env, app, segment_ranges, prefetch, window_size,
+                 swift_source, on_error=None):
+        super(SegmentedIterable, self).__init__(None)
+        self.env = env
+        self.app = app
+        self.segment_ranges = segment_ranges
+        self.prefetch = prefetch
+        self.window = _ReadAheadWindow(window_size)
+        self.swift_source = swift_source
+        self.on_error = on_error
+        self.fetches = []
+
+    def __iter__(self):
+        ranges = self.segment_ranges
+        pending = self.fetches
+
+        def fill():
+            while len(pending) < self.prefetch + 1:
+                try:
+                    path, first, last, seg_size, etag = next(ranges)
+                except StopIteration:
+                    return
+                fetch = _SegmentFetch(self.env, self.app, path, first, last,
+                                      seg_size, etag, self.swift_source)
+                fetch.is_head = not pending
+                pending.append(fetch)
+                fetch.start(self.window)
+
+        try:
+            fill()
+            while pending:
+                fetch = pending[0]
+                fetch.is_head = True
+                self.window.wake()
+                for chunk in self._drain(fetch):
+                    yield chunk
+                pending.pop(0).close()
+                fill()
+        except SegmentError as err:
+            if self.on_error:
+                self.on_error(err)
+            raise
+        finally:
+            self.close()
+
+    def _drain(self, fetch):
+        while True:
+            item = fetch.queue.get()
+            if item is _END:
+                return
+            if item is _HANDOVER:
+                for chunk in fetch.chunks:
+                    yield chunk
+                return
+            if isinstance(item, Exception):
+                raise item
+            chunk, counted = item
+            if counted:
+                self.window.release(len(chunk))
+            yield chunk
+
+    def close(self):
+        while self.fetches:
+            self.fetches.pop().close()
+        close_if_possible(self.segment_ranges)
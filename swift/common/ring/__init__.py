@@ -0,0 +1,9 @@
+from swift.common.ring.ring import RingData, Ring, hash_path
+from swift.common.ring.builder import build_ring
+
+__all__ = [
+    'RingData',
+    'Ring',
+    'hash_path',
+    'build_ring',
+]
@@ -0,0 +1,109 @@
+"""
+Builds a ring's table from its devices.
+
+Partitions are dealt to devices in rounds, a round being the ``replicas``
+devices of one partition: each round takes the devices furthest behind
+their share of the weight, in as many different zones as it can. The rows
+repeat the rounds dealt, as the hash spreads paths over partitions evenly
+anyway. Only as many are dealt as give the lightest device a
+partition-replica of its own and the average one ``DEALT_PER_DEVICE``:
+``ROUNDS`` at least, and no more than there are partitions. So the time a
+build takes goes with the devices rather than the partitions: a ring of
+millions of partitions over hundreds of devices builds in a fraction of a
+second, one over 65535 devices in seconds. A device whose weight is less
+than one partition-replica's worth of the whole gets none.
+"""
+import heapq
+import random
+from array import array
+
+from swift.common.ring.ring import RingData
+
+ROUNDS = 4096
+# partition-replicas dealt to the average device at least, so the rows
+# repeating the rounds keep to the weights within about one in this many
+DEALT_PER_DEVICE = 64
+MAX_DEVICES = 65535
+
+
+def _deal(devs, weights, replicas, rounds):
+    """Returns the device indexes chosen in each of ``rounds`` rounds."""
+    total = sum(weights)
+    shares = [replicas * weight / total for weight in weights]
+    given = [0] * len(devs)
+    # (the round a device is due its next partition-replica by, index)
+    heap = [(1 / share, index) for index, share in enumerate(shares)
+            if share > 0]
+    heapq.heapify(heap)
+    want_zones = min(replicas, len(set(devs[index].get('zone')
+                                       for _due, index in heap)))
+    dealt = []
+    for _ in range(rounds):
+        chosen = []
+        zones = set()
+        passed = []
+        # different zones first
+        while heap and len(zones) < want_zones:
+            due, index = heapq.heappop(heap)
+            if devs[index].get('zone') in zones:
+                passed.append((due, index))
+            else:
+                zones.add(devs[index].get('zone'))
+                chosen.append(index)
+        # then different devices
+        while len(chosen) < replicas and (passed or heap):
+            if passed and (not heap or passed[0] < heap[0]):
+                chosen.append(passed.pop(0)[1])
+            else:
+                chosen.append(heapq.heappop(heap)[1])
+        for entry in passed:
+            heapq.heappush(heap, entry)
+        for index in chosen:
+            given[index] += 1
+            heapq.heappush(heap, ((given[index] + 1) / shares[index], index))
+        unique = len(chosen)
+        while len(chosen) < replicas:
+            # fewer devices than replicas
+            chosen.append(chosen[len(chosen) % unique])
+        dealt.append(chosen)
+    return dealt
+
+
+def build_ring(devs, part_power, replicas):
+    """
+    Returns the :class:`RingData` of ``devs`` with ``2 ** part_power``
+    partitions of ``replicas`` replicas.
+
+    :param devs: device dicts with ``ip``, ``port``, ``device``, ``zone``
+                 and ``weight``; each gets its index as its ``id``
+    """
+    if not devs:
+        raise ValueError('A ring needs devices')
+    if len(devs) > MAX_DEVICES:
+        raise ValueError('A ring holds at most %d devices' % MAX_DEVICES)
+    if not 0 <= part_power <= 32:
+        raise ValueError('part_power must be from 0 to 32')
+    devs = [dict(dev, id=index) for index, dev in enumerate(devs)]
+    weights = [float(dev.get('weight', 1)) for dev in devs]
+    if min(weights) < 0:
+        raise ValueError('Device weights cannot be negative')
+    total = sum(weights)
+    if total <= 0:
+        raise ValueError('A ring needs weight')
+    parts = 2 ** part_power
+    weighted = [weight for weight in weights if weight > 0]
+    rounds = ROUNDS
+    while rounds < parts and (
+            rounds * replicas * min(weighted) < total or
+            rounds * replicas < DEALT_PER_DEVICE * len(weighted)):
+        rounds *= 2
+    rounds = min(parts, rounds)
+    dealt = _deal(devs, weights, replicas, rounds)
+    # they are dealt in a pattern that a walk through the partitions, as
+    # the ring's handoff search is, could fall into step with
+    random.Random(part_power).shuffle(dealt)
+    rows = []
+    for replica in range(replicas):
+        row = array('H', [chosen[replica] for chosen in dealt])
+        rows.append(row * (parts // rounds))
+    return RingData(rows, devs, 32 - part_power)
@@ -0,0 +1,250 @@
+"""
+The ring: which storage nodes hold an account, container or object.
+
+A path is hashed with MD5 and the top ``part_power`` bits of the hash are
+its partition. The ring's table has a row per replica, each an
+``array('H')`` of device ids indexed by partition. So finding a path's
+nodes is a hash, a shift and one index per replica.
+
+A ring is saved as a small JSON header, with the devices and the shift,
+followed by the rows as raw native-order shorts, page aligned. Loading one
+maps the file rather than reading it, so every worker on a host shares
+the one copy in the page cache, however many partitions there are; a
+rebalanced ring is written to a new file and renamed into place, so a
+worker still using the old one is never disturbed. A :class:`Ring` looks
+at the file's mtime at most once every ``reload_time`` seconds and loads
+it again only when that has changed.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from hashlib import md5
+
+MAGIC = b'SWRG'
+VERSION = 1
+# magic, version, length of the JSON that follows
+HEADER = struct.Struct('!4sHI')
+PAGE_SIZE = mmap.PAGESIZE
+# handoffs come from partitions this many apart, at most, from any one
+HANDOFF_STRIDE_PARTS = 65536
+_PART = struct.Struct('>I')
+
+
+def hash_path(account, container=None, obj=None):
+    """Returns the MD5 digest of ``/account[/container[/obj]]``."""
+    path = '/' + '/'.join(p for p in (account, container, obj) if p)
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return md5(path).digest()
+
+
+def _unpack_part(digest, part_shift):
+    return _PART.unpack_from(digest)[0] >> part_shift
+
+
+class RingData(object):
+    """
+    A ring's devices and table.
+
+    :param replica2part2dev_id: a row per replica of the device id of each
+                                partition, as ``array('H')`` (or anything
+                                indexable the same way)
+    :param devs: device dicts, each at the index of its ``id``
+    :param part_shift: 32 minus the partition power
+    """
+
+    def __init__(self, replica2part2dev_id, devs, part_shift):
+        self._replica2part2dev_id = replica2part2dev_id
+        self.devs = devs
+        self._part_shift = part_shift
+
+    @property
+    def replica_count(self):
+        return len(self._replica2part2dev_id)
+
+    @property
+    def partition_count(self):
+        return len(self._replica2part2dev_id[0]) \
+            if self._replica2part2dev_id else 0
+
+    def save(self, path):
+        """Writes the ring to ``path``, replacing any there atomically."""
+        meta = json.dumps({
+            'devs': self.devs, 'part_shift': self._part_shift,
+            'replica_count': self.replica_count,
+            'partition_count': self.partition_count,
+            'byteorder': sys.byteorder}).encode('utf-8')
+        head = HEADER.pack(MAGIC, VERSION, len(meta)) + meta
+        head += b'\0' * (-len(head) % PAGE_SIZE)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(head)
+                for row in self._replica2part2dev_id:
+                    if not isinstance(row, array):
+                        row = array('H', row)
+                    row.tofile(fp)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a ring, its rows mapped from the file where the interpreter
+        allows it, and read into arrays where it does not.
+
+        :raises ValueError: if it is not a ring file
+        """
+        with open(path, 'rb') as fp:
+            head = fp.read(HEADER.size)
+            if len(head) < HEADER.size:
+                raise ValueError('%s is not a ring file' % path)
+            magic, version, meta_len = HEADER.unpack(head)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a ring file' % path)
+            meta = json.loads(fp.read(meta_len).decode('utf-8'))
+            offset = HEADER.size + meta_len
+            offset += -offset % PAGE_SIZE
+            row_size = meta['partition_count'] * 2
+            if meta['replica_count'] and row_size:
+                rows = cls._map_rows(fp, offset, row_size,
+                                     meta['replica_count'],
+                                     meta['byteorder'])
+            else:
+                rows = []
+        return cls(rows, meta['devs'], meta['part_shift'])
+
+    @staticmethod
+    def _map_rows(fp, offset, row_size, replica_count, byteorder):
+        if byteorder == sys.byteorder and \
+                hasattr(memoryview, 'cast'):
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            return [view[offset + r * row_size:
+                         offset + (r + 1) * row_size].cast('H')
+                    for r in range(replica_count)]
+        rows = []
+        fp.seek(offset)
+        for _ in range(replica_count):
+            row = array('H')
+            row.fromfile(fp, row_size // 2)
+            if byteorder != sys.byteorder:
+                row.byteswap()
+            rows.append(row)
+        return rows
+
+
+class Ring(object):
+    """
+    The ring of ``<swift_dir>/<ring_name>.ring``, loaded again when the
+    file changes; see above.
+
+    :param swift_dir: where the ring file is
+    :param ring_name: ``account``, ``container`` or ``object``
+    :param reload_time: seconds between looks at the file's mtime
+    """
+
+    def __init__(self, swift_dir, ring_name='object', reload_time=15):
+        self.serialized_path = os.path.join(swift_dir, ring_name + '.ring')
+        self.reload_time = reload_time
+        self._mtime = None
+        self._reload(force=True)
+
+    def _reload(self, force=False):
+        self._rtime = time.time() + self.reload_time
+        mtime = os.path.getmtime(self.serialized_path)
+        if force or mtime != self._mtime:
+            ring_data = RingData.load(self.serialized_path)
+            self._devs = ring_data.devs
+            self._replica2part2dev_id = ring_data._replica2part2dev_id
+            self._part_shift = ring_data._part_shift
+            self._zone_count = len(set(dev.get('zone') for dev in
+                                       self._devs if dev))
+            self._dev_count = len([dev for dev in self._devs if dev])
+            # with fewer devices than replicas a device is listed twice
+            self._dedupe = self._dev_count < len(self._replica2part2dev_id)
+            self._mtime = mtime
+
+    def has_changed(self):
+        return os.path.getmtime(self.serialized_path) != self._mtime
+
+    @property
+    def replica_count(self):
+        return len(self._replica2part2dev_id)
+
+    @property
+    def partition_count(self):
+        return len(self._replica2part2dev_id[0])
+
+    @property
+    def devs(self):
+        if time.time() > self._rtime:
+            self._reload()
+        return self._devs
+
+    def get_part(self, account, container=None, obj=None):
+        """Returns the partition of a path."""
+        if time.time() > self._rtime:
+            self._reload()
+        return _unpack_part(hash_path(account, container, obj),
+                            self._part_shift)
+
+    def get_part_nodes(self, part):
+        """Returns the primary nodes of a partition."""
+        if time.time() > self._rtime:
+            self._reload()
+        devs = self._devs
+        nodes = [devs[row[part]] for row in self._replica2part2dev_id]
+        if self._dedupe:
+            seen = set()
+            nodes = [node for node in nodes
+                     if node['id'] not in seen and not seen.add(node['id'])]
+        return nodes
+
+    def get_nodes(self, account, container=None, obj=None):
+        """Returns ``(partition, primary nodes)`` of a path."""
+        part = self.get_part(account, container, obj)
+        return part, self.get_part_nodes(part)
+
+    def get_more_nodes(self, part):
+        """
+        Yields the handoff nodes of a partition, as they are asked for:
+        first those in zones none of its primaries are in, taken from
+        partitions spread around the ring, then every other device.
+        """
+        primary_nodes = self.get_part_nodes(part)
+        used = set(node['id'] for node in primary_nodes)
+        used_zones = set(node.get('zone') for node in primary_nodes)
+        devs = self._devs
+        dev_count = self._dev_count
+        rows = self._replica2part2dev_id
+        parts = len(rows[0])
+        start = _unpack_part(md5(str(part).encode('ascii')).digest(),
+                             self._part_shift)
+        inc = max(1, parts // HANDOFF_STRIDE_PARTS)
+        offset = 0
+        # a while loop, so py2 makes no list of the partitions to look at
+        while offset < parts and len(used_zones) < self._zone_count:
+            handoff_part = (start + offset) % parts
+            offset += inc
+            for row in rows:
+                dev = devs[row[handoff_part]]
+                if dev['id'] not in used and \
+                        dev.get('zone') not in used_zones:
+                    yield dev
+                    used.add(dev['id'])
+                    used_zones.add(dev.get('zone'))
+        for index in range(len(devs)):
+            if len(used) >= dev_count:
+                return
+            dev = devs[(start + index) % len(devs)]
+            if dev and dev['id'] not in used:
+                yield dev
+                used.add(dev['id'])
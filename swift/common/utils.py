@@ -1,10 +1,370 @@
+import bisect
+import hmac
+import logging
 import os
 import sys
+import threading
+import time
+from collections import OrderedDict
 from optparse import OptionParser
 
+import eventlet
+from eventlet import tpool
+
 from swift import gettext_ as _
 
 
+TRUE_VALUES = set(('true', '1', 'yes', 'on', 't', 'y'))
+
+# clock for measuring intervals; wall clock on interpreters without one
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def config_true_value(value):
+    """
+    Returns True if the value is either True or a string in TRUE_VALUES.
+    Returns False otherwise.
+    """
+    return value is True or \
+        (isinstance(value, str) and value.lower() in TRUE_VALUES)
+
+
+def split_path(path, minsegs=1, maxsegs=None, rest_with_last=False):
+    """
+    Validate and split the given HTTP request path.
+
+    **Examples**::
+
+        ['a'] = split_path('/a')
+        ['a', None] = split_path('/a', 1, 2)
+        ['a', 'c'] = split_path('/a/c', 1, 2)
+        ['a', 'c', 'o/r'] = split_path('/a/c/o/r', 1, 3, True)
+
+    :param path: HTTP Request path to be split
+    :param minsegs: Minimum number of segments to be extracted
+    :param maxsegs: Maximum number of segments to be extracted
+    :param rest_with_last: If True, trailing data will be returned as part
+                           of last segment.  If False, and there is
+                           trailing data, raises ValueError.
+    :returns: list of segments with a length of maxsegs (non-existent
+              segments will return as None)
+    :raises ValueError: if given an invalid path
+    """
+    if not maxsegs:
+        maxsegs = minsegs
+    if minsegs > maxsegs:
+        raise ValueError('minsegs > maxsegs: %d > %d' % (minsegs, maxsegs))
+    if rest_with_last:
+        segs = path.split('/', maxsegs)
+        minsegs += 1
+        maxsegs += 1
+        count = len(segs)
+        if (segs[0] or count < minsegs or count > maxsegs or
+                '' in segs[1:minsegs]):
+            raise ValueError('Invalid path: %s' % path)
+    else:
+        minsegs += 1
+        maxsegs += 1
+        segs = path.split('/', maxsegs)
+        count = len(segs)
+        if (segs[0] or count < minsegs or count > maxsegs + 1 or
+                '' in segs[1:minsegs] or
+                (count == maxsegs + 1 and segs[maxsegs])):
+            raise ValueError('Invalid path: %s' % path)
+    segs = segs[1:maxsegs]
+    segs.extend([None] * (maxsegs - 1 - len(segs)))
+    return segs
+
+
+def streq_const_time(s1, s2):
+    """Constant-time string comparison."""
+    compare_digest = getattr(hmac, 'compare_digest', None)
+    if compare_digest is not None:
+        return compare_digest(s1, s2)
+    if len(s1) != len(s2):
+        return False
+    result = 0
+    for (a, b) in zip(s1, s2):
+        result |= ord(a) ^ ord(b)
+    return result == 0
+
+
+# how this worker runs work apart from requests; see use_background_threads
+_background = {'threads': False, 'exit_hooks': []}
+
+
+def use_background_threads():
+    """
+    Has :func:`spawn_background` start a daemon thread for each task
+    instead of a green thread. The asyncio backend calls it as a worker
+    starts: its executor threads' hubs only run while a request waits in
+    them, so a green thread one of them started would stop with the
+    request.
+    """
+    _background['threads'] = True
+
+
+def spawn_background(func, *args):
+    """
+    Runs ``func(*args)`` apart from any request, for as long as the worker
+    does. It can sleep and wait through eventlet either way; a daemon
+    thread has a hub of its own.
+    """
+    if _background['threads']:
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+    else:
+        eventlet.spawn_n(func, *args)
+
+
+def run_blocking(func, *args):
+    """
+    Calls ``func(*args)``, which may block on a disk or the like: in a
+    native thread from a green one, directly from a background thread of
+    its own, where blocking stalls nothing else.
+    """
+    if _background['threads']:
+        return func(*args)
+    return tpool.execute(func, *args)
+
+
+def on_worker_exit(func):
+    """Has ``func()`` called once the worker has finished serving."""
+    _background['exit_hooks'].append(func)
+
+
+def worker_exiting():
+    """Calls the :func:`on_worker_exit` hooks; a server calls this."""
+    hooks, _background['exit_hooks'] = _background['exit_hooks'], []
+    for func in hooks:
+        try:
+            func()
+        except Exception:
+            # one failing must not keep the others from running
+            pass
+
+
+def close_if_possible(maybe_closable):
+    """
+    Calls ``close()`` on a WSGI body iterable if it has one, as PEP 333
+    requires of whoever consumes it.
+    """
+    close_method = getattr(maybe_closable, 'close', None)
+    if callable(close_method):
+        return close_method()
+
+
+class ClosingIterable(object):
+    """
+    Base for filters that have to look at a response body on its way out.
+
+    Filters hand the inner app's iterable up the pipeline untouched whenever
+    they can; when one needs to observe the body it wraps it in a subclass
+    of this instead of joining it, so chunks are still pulled one at a time
+    and ``close()`` still reaches the innermost app. Subclasses override
+    :meth:`__iter__` and keep yielding from ``self.app_iter``.
+
+    :param app_iter: the iterable returned by the wrapped app
+    """
+
+    def __init__(self, app_iter):
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        close_if_possible(self.app_iter)
+
+
+class LRUCache(object):
+    """
+    Bounded least-recently-used map whose entries can also expire. It may
+    be used from several threads at once.
+
+    :param maxsize: most entries kept; the least recently used go first
+    :param ttl: default seconds an entry lives, None for no expiry
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: seconds this entry lives, overriding the default
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value,
+                               None if ttl is None else time.time() + ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Histogram(object):
+    """
+    Fixed-bucket latency histogram. Adding a sample is a bisect and two
+    increments; nothing is allocated per sample.
+
+    :param bounds: ascending upper bounds of the buckets, in seconds; a last
+                   bucket catches everything above them
+    """
+
+    DEFAULT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                      0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct):
+        """
+        Upper bound of the bucket holding the ``pct`` percentile, or None
+        when there are no samples. Samples beyond the last bound report
+        ``float('inf')``.
+        """
+        if not self.count:
+            return None
+        wanted = self.count * pct / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                break
+        return self.bounds[i] if i < len(self.bounds) else float('inf')
+
+    def summary(self):
+        if not self.count:
+            return 'n=0'
+        return 'n=%d avg=%.3fms p50<=%sms p99<=%sms' % (
+            self.count, self.total / self.count * 1000,
+            _format_ms(self.percentile(50)), _format_ms(self.percentile(99)))
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the eventlet hub wakes a green thread that sleeps
+    ``interval`` seconds at a time. Whatever is ready to run waits about as
+    long, so it is the time a request that has arrived waits in the worker
+    before it gets to run.
+
+    The ticker is started by the first call to :meth:`start`, which is
+    expected to be made in the worker process.
+
+    :param decay: weight the smoothed lag gives to its previous value
+    """
+
+    def __init__(self, interval=0.1, decay=0.8):
+        self.interval = interval
+        self.decay = decay
+        self.smoothed = 0.0
+        self.last_lag = 0.0
+        self.last_tick = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.last_tick = monotonic()
+            self._thread = eventlet.spawn(self._run)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            self._tick(monotonic())
+
+    def _tick(self, now):
+        self.last_lag = max(0.0, now - self.last_tick - self.interval)
+        self.last_tick = now
+        self.smoothed = self.decay * self.smoothed + \
+            (1 - self.decay) * self.last_lag
+
+    @property
+    def lag(self):
+        """
+        The smoothed lag, or how overdue the next tick already is if that
+        is more.
+        """
+        if self.last_tick is None:
+            return 0.0
+        return max(self.smoothed,
+                   monotonic() - self.last_tick - self.interval)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+
+
+def _format_ms(seconds):
+    if seconds == float('inf'):
+        return 'inf'
+    return '%g' % (seconds * 1000)
+
+
+def get_logger(conf, name=None, log_route=None):
+    """
+    Get the current system logger using config settings.
+
+    **Log config and defaults**::
+
+        log_name = swift
+        log_level = INFO
+
+    :param conf: Configuration dict to read settings from
+    :param name: Name of the logger, defaults to conf's log_name
+    :param log_route: Route for the logging, appended to the logger name
+    """
+    if not conf:
+        conf = {}
+    if name is None:
+        name = conf.get('log_name', 'swift')
+    if log_route:
+        name = '%s.%s' % (name, log_route)
+    logger = logging.getLogger(name)
+    logger.setLevel(
+        getattr(logging, conf.get('log_level', 'INFO').upper(), logging.INFO))
+    if not logging.getLogger().handlers and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(name)s[%(process)d]: %(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
 def parse_options(parser=None, once=False, test_args=None):
     """
     Parse standard swift server/daemon options with optparse.OptionParser.
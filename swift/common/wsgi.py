@@ -1,5 +1,27 @@
-from paste.deploy import loadwsgi
-from eventlet import wsgi, listen
+import errno
+import hashlib
+import heapq
+import io
+import os
+import signal
+import time
+from collections import namedtuple
+
+import eventlet
+from eventlet import wsgi, listen, GreenPool
+from greenlet import GreenletExit
+from paste.deploy import loadwsgi, appconfig
+
+from swift.common.utils import config_true_value, get_logger, \
+    monotonic, spawn_background, worker_exiting, ClosingIterable, Histogram
+from swift.ipvl.inspect_custom import tracer, TracedCall
+
+
+SERVER_BACKENDS = ('eventlet', 'asyncio')
+# seconds before respawning a worker that died starting up, doubled for each
+# one that dies the same way in a row
+RESPAWN_BACKOFF = 1
+MAX_RESPAWN_BACKOFF = 60
 
 
 class NamedConfigLoader(loadwsgi.ConfigLoader):
@@ -18,6 +40,105 @@ class NamedConfigLoader(loadwsgi.ConfigLoader):
 loadwsgi.ConfigLoader = NamedConfigLoader
 
 
+class PipelineOrderError(ValueError):
+    pass
+
+
+def order_filters(present, required):
+    """
+    Works out where the required filters go in a pipeline.
+
+    The filters already in the pipeline keep their relative order; each
+    required filter declares which entry points it must come ``after``
+    and/or ``before``, and missing ones are placed as early as those
+    constraints allow. The constraints are checked against the filters that
+    are already present too, so a misordered pipeline fails here rather than
+    while serving.
+
+    :param present: entry point names of the pipeline's filters, in order
+    :param required: list of dicts with a ``name`` and optional ``after``
+                     and ``before`` lists of entry point names
+    :returns: the new order as a list whose items are either an index into
+              ``present`` or the name of a required filter to insert
+    :raises PipelineOrderError: if the constraints contradict each other or
+                                the existing order
+    """
+    position = {}
+    for i, name in enumerate(present):
+        position.setdefault(name, i)
+    missing = [spec['name'] for spec in required
+               if spec['name'] not in position]
+    missing_rank = dict((name, rank) for rank, name in enumerate(missing))
+
+    def node(name):
+        if name in position:
+            return position[name]
+        if name in missing_rank:
+            return name
+        return None  # neither present nor required; nothing to order
+
+    edges = dict((n, set()) for n in range(len(present)))
+    edges.update((name, set()) for name in missing)
+    for i in range(1, len(present)):
+        edges[i - 1].add(i)
+    for spec in required:
+        this = node(spec['name'])
+        for after in spec.get('after', ()):
+            if node(after) is not None and node(after) != this:
+                edges[node(after)].add(this)
+        for before in spec.get('before', ()):
+            if node(before) is not None and node(before) != this:
+                edges[this].add(node(before))
+
+    incoming = dict((n, 0) for n in edges)
+    for targets in edges.values():
+        for target in targets:
+            incoming[target] += 1
+
+    def priority(n):
+        # missing filters go in as early as they can, in declaration order
+        if n in missing_rank:
+            return (0, missing_rank[n])
+        return (1, n)
+
+    ready = [priority(n) for n, count in incoming.items() if not count]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        kind, key = heapq.heappop(ready)
+        n = missing[key] if kind == 0 else key
+        order.append(n)
+        for target in edges[n]:
+            incoming[target] -= 1
+            if not incoming[target]:
+                heapq.heappush(ready, priority(target))
+
+    if len(order) != len(edges):
+        raise PipelineOrderError(
+            'Pipeline ordering constraints form a cycle: %s' % ' -> '.join(
+                present[n] if isinstance(n, int) else n
+                for n in _find_cycle(edges, incoming)))
+    return order
+
+
+def _find_cycle(edges, incoming):
+    # every node still holding incoming edges after the sort sits on or
+    # behind a cycle; follow those edges until one repeats
+    stuck = set(n for n, count in incoming.items() if count)
+    predecessors = dict((n, [m for m in stuck if n in edges[m]])
+                        for n in stuck)
+    path = [next(iter(stuck))]
+    seen = {path[0]: 0}
+    while True:
+        step = predecessors[path[-1]][0]
+        if step in seen:
+            cycle = path[seen[step]:] + [step]
+            cycle.reverse()
+            return cycle
+        seen[step] = len(path)
+        path.append(step)
+
+
 class PipelineWrapper(object):
     """
     This class provides a number of utility methods for
@@ -26,13 +147,17 @@ class PipelineWrapper(object):
 
     def __init__(self, context):
         self.context = context
+        self._positions = None
 
     def __contains__(self, entry_point_name):
-        try:
-            self.index(entry_point_name)
-            return True
-        except ValueError:
-            return False
+        return entry_point_name in self._index()
+
+    def _index(self):
+        if self._positions is None:
+            self._positions = {}
+            for i, ctx in enumerate(self.context.filter_contexts):
+                self._positions.setdefault(ctx.entry_point_name, i)
+        return self._positions
 
     def startswith(self, entry_point_name):
         """
@@ -84,10 +209,10 @@ class PipelineWrapper(object):
 
         Raises ValueError if the given module is not in the pipeline.
         """
-        for i, ctx in enumerate(self.context.filter_contexts):
-            if ctx.entry_point_name == entry_point_name:
-                return i
-        raise ValueError("%s is not in pipeline" % (entry_point_name,))
+        try:
+            return self._index()[entry_point_name]
+        except KeyError:
+            raise ValueError("%s is not in pipeline" % (entry_point_name,))
 
     def insert_filter(self, ctx, index=0):
         """
@@ -99,6 +224,148 @@ class PipelineWrapper(object):
                       is 0, which means the start of the pipeline.
         """
         self.context.filter_contexts.insert(index, ctx)
+        self._positions = None
+
+    def add_required_filters(self, required):
+        """
+        Inserts the required filters that are missing from the pipeline, in
+        the positions :func:`order_filters` gives them.
+
+        :param required: list of filter specs, see :func:`order_filters`
+        :returns: list of the entry point names that were inserted
+        :raises PipelineOrderError: if the requirements can't be satisfied
+        """
+        contexts = self.context.filter_contexts
+        order = order_filters([ctx.entry_point_name for ctx in contexts],
+                              required)
+        inserted = [n for n in order if not isinstance(n, int)]
+        if inserted:
+            self.context.filter_contexts = [
+                contexts[n] if isinstance(n, int) else self.create_filter(n)
+                for n in order]
+            self._positions = None
+        return inserted
+
+
+class Middleware(object):
+    """
+    Base class for the filters in a pipeline.
+
+    Only the innermost app calls ``start_response``. A filter passes the
+    server's callable straight down, so the status and headers the app sets
+    reach the client without being rebuilt at every layer. A filter that
+    needs to see or change them wraps the callable with
+    :meth:`_rewrite_start_response` on just the requests it cares about;
+    every other request costs nothing extra.
+    """
+
+    def __init__(self, app, conf=None):
+        self.app = app
+        self.conf = conf
+
+    def __call__(self, env, start_response):
+        return self.app(env, start_response)
+
+    @staticmethod
+    def _rewrite_start_response(start_response, rewrite):
+        """
+        Returns a ``start_response`` that passes the app's status and headers
+        through ``rewrite(status, headers)`` before handing them on.
+
+        :param start_response: the callable the filter was called with
+        :param rewrite: callable returning a new ``(status, headers)`` pair;
+                        it may modify ``headers`` in place and return it
+        """
+        def _start_response(status, headers, exc_info=None):
+            status, headers = rewrite(status, headers)
+            return start_response(status, headers, exc_info)
+        return _start_response
+
+
+# request context a subrequest inherits from the request that made it
+_SUBREQUEST_KEYS = (
+    'HTTP_USER_AGENT', 'HTTP_HOST', 'HTTP_X_AUTH_TOKEN', 'REMOTE_USER',
+    'REMOTE_ADDR', 'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT',
+    'SERVER_PROTOCOL', 'wsgi.url_scheme', 'wsgi.errors', 'wsgi.version',
+    'swift.cache', 'swift.infocache', 'swift.trans_id', 'swift.authorize',
+    'swift.authorize_override')
+
+SubResponse = namedtuple('SubResponse',
+                         'status_int status headers app_iter header_list')
+
+
+def make_env(env, method=None, path=None, agent='Swift', query_string='',
+             swift_source=None, body_file=None, content_length=None,
+             headers=None):
+    """
+    Returns a new WSGI environment for a subrequest, carrying over the
+    parts of ``env`` that identify the client and its authorization.
+
+    :param env: the WSGI environment of the request making the subrequest
+    :param method: HTTP method; defaults to the original one
+    :param path: unquoted path; defaults to the original one
+    :param agent: User-Agent, with '%(orig)s' replaced by the original one
+    :param swift_source: short tag naming the middleware, for logging
+    :param body_file: file-like object the subrequest body is read from
+    :param content_length: length of that body
+    :param headers: dict of extra request headers
+    """
+    newenv = dict((key, env[key]) for key in _SUBREQUEST_KEYS if key in env)
+    newenv['REQUEST_METHOD'] = method or env['REQUEST_METHOD']
+    newenv['PATH_INFO'] = path if path is not None else env['PATH_INFO']
+    newenv['QUERY_STRING'] = query_string
+    if agent:
+        newenv['HTTP_USER_AGENT'] = agent % {
+            'orig': env.get('HTTP_USER_AGENT', '')}
+    if swift_source:
+        newenv['swift.source'] = swift_source
+    newenv['wsgi.input'] = body_file if body_file is not None \
+        else io.BytesIO()
+    newenv['CONTENT_LENGTH'] = str(content_length or 0)
+    for name, value in (headers or {}).items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        newenv[key] = value
+    return newenv
+
+
+def call_subrequest(app, env):
+    """
+    Calls ``app`` with a subrequest environment.
+
+    :returns: a :class:`SubResponse`; ``headers`` is a dict keyed by
+              lower-cased header name, ``header_list`` the headers as the
+              app gave them, and the caller must iterate or close
+              ``app_iter``
+    """
+    captured = []
+
+    def start_response(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+
+    app_iter = app(env, start_response)
+    if not captured:
+        # the app only calls start_response once its body is started
+        app_iter = _StartedBody(app_iter)
+    status, headers = captured
+    return SubResponse(int(status.split(' ', 1)[0]), status,
+                       dict((k.lower(), v) for k, v in headers), app_iter,
+                       headers)
+
+
+class _StartedBody(ClosingIterable):
+
+    def __init__(self, app_iter):
+        super(_StartedBody, self).__init__(app_iter)
+        self.chunks = iter(app_iter)
+        self.first = next(self.chunks, None)
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+        for chunk in self.chunks:
+            yield chunk
 
 
 def loadcontext(object_type, uri, name=None, relative_to=None,
@@ -108,42 +375,644 @@ def loadcontext(object_type, uri, name=None, relative_to=None,
     return loadwsgi.loadcontext(loadwsgi.APP, 'config:'+conf_file, name=name, relative_to=relative_to, global_conf=global_conf)
 
 
-def loadapp(conf_file, global_conf=None, allow_modify_pipeline=True):
+# One step of a compiled pipeline. ``make`` is ``filter(app) -> app`` for a
+# filter, whose factory has already read its conf, and a no-argument
+# constructor for the app at the end. ``conf`` is the section's conf merged
+# over [DEFAULT].
+PipelineEntry = namedtuple('PipelineEntry', 'name make conf')
+
+# path, global_conf -> (mtime, content hash, plan)
+_pipeline_cache = {}
+
+
+def _content_hash(path):
+    with open(path, 'rb') as conf_fp:
+        return hashlib.sha1(conf_fp.read()).hexdigest()
+
+
+def load_pipeline_context(conf_file, global_conf=None,
+                          allow_modify_pipeline=True):
     """
     Loads a context from a config file, and if the context is a pipeline
     then presents the app with the opportunity to modify the pipeline.
+    Nothing is instantiated.
     """
-    global_conf = global_conf or {}
-    ctx = loadcontext(loadwsgi.APP, conf_file, global_conf=global_conf)
+    ctx = loadcontext(loadwsgi.APP, conf_file, global_conf=global_conf or {})
     if ctx.object_type.name == 'pipeline':
         # give app the opportunity to modify the pipeline context
-        app = ctx.app_context.create()
-        func = getattr(app, 'modify_wsgi_pipeline', None)
+        func = getattr(ctx.app_context.object, 'modify_wsgi_pipeline', None)
         if func and allow_modify_pipeline:
             func(PipelineWrapper(ctx))
-    return ctx.create()
+    return ctx
+
+
+def describe_pipeline(conf_file, global_conf=None):
+    """
+    Dry run: returns the pipeline the proxy would serve, required filters
+    included, without running any factory.
+
+    :raises PipelineOrderError: if the pipeline can't be ordered
+    """
+    ctx = load_pipeline_context(conf_file, global_conf=global_conf)
+    if ctx.object_type.name != 'pipeline':
+        return getattr(ctx, 'name', None) or '<unknown>'
+    return str(PipelineWrapper(ctx))
+
+
+def compile_pipeline(conf_file, global_conf=None, allow_modify_pipeline=True):
+    """
+    Parses ``conf_file`` once, gives the app the opportunity to modify the
+    pipeline and runs each filter's factory, producing a plan that
+    :func:`build_pipeline` can instantiate without touching the config
+    again.
+
+    Plans are cached on the file's mtime and content hash, so a parent that
+    compiles before forking leaves nothing for its workers to parse.
+
+    A filter whose factory sets ``ahead_of_pipeline`` on the filter it
+    returns, as healthcheck does, is moved in front of every other filter,
+    wherever the config puts it.
+
+    :returns: tuple of (plan, cached) where plan is a tuple of
+              :class:`PipelineEntry`, outermost filter first and the app
+              last, and cached tells whether it came from the cache
+    """
+    global_conf = global_conf or {}
+    path = os.path.abspath(conf_file)
+    key = (path, tuple(sorted(global_conf.items())), allow_modify_pipeline)
+    mtime = os.path.getmtime(path)
+    cached = _pipeline_cache.get(key)
+    if cached:
+        if cached[0] == mtime:
+            return cached[2], True
+        content_hash = _content_hash(path)
+        if cached[1] == content_hash:
+            _pipeline_cache[key] = (mtime, content_hash, cached[2])
+            return cached[2], True
+    else:
+        content_hash = _content_hash(path)
+
+    ctx = load_pipeline_context(conf_file, global_conf=global_conf,
+                                allow_modify_pipeline=allow_modify_pipeline)
+    if ctx.object_type.name == 'pipeline':
+        filter_contexts = ctx.filter_contexts
+        app_context = ctx.app_context
+    else:
+        filter_contexts = []
+        app_context = ctx
+    filters = [PipelineEntry(getattr(fctx, 'name', None), fctx.create(),
+                             _merged_conf(fctx))
+               for fctx in filter_contexts]
+    filters.sort(key=lambda entry: not getattr(
+        entry.make, 'ahead_of_pipeline', False))
+    plan = tuple(filters + [PipelineEntry(
+        getattr(app_context, 'name', None), app_context.create,
+        _merged_conf(app_context))])
+    _pipeline_cache[key] = (mtime, content_hash, plan)
+    return plan, False
+
+
+def _merged_conf(ctx):
+    conf = dict(ctx.global_conf)
+    conf.update(ctx.local_conf)
+    return conf
+
+
+def build_pipeline(plan, wrap=None):
+    """
+    Instantiates a plan from :func:`compile_pipeline`, creating the app and
+    each filter exactly once.
+
+    :param wrap: optional ``wrap(app, index)`` called on the app and on each
+                 filter as it is created, ``index`` being its position in
+                 ``plan``; whatever it returns is what the next filter out
+                 wraps. Used for instrumentation that costs nothing when it
+                 is not configured.
+    """
+    app = plan[-1].make()
+    if wrap:
+        app = wrap(app, len(plan) - 1)
+    for index in range(len(plan) - 2, -1, -1):
+        app = plan[index].make(app)
+        if wrap:
+            app = wrap(app, index)
+    return app
+
+
+def _trace_wrapper(plan, conf):
+    """
+    Returns a build_pipeline ``wrap`` that puts a trace point in front of
+    every layer, or None if ``trace_calls`` is off.
+
+    **Tracing config and defaults**::
+
+        trace_calls = false
+        # filters (section names) traced from the start, or "all"
+        trace_filters =
+        trace_buffer_size = 1000
+
+    With ``trace_calls`` on, a request with an ``X-Trace-Calls`` header is
+    traced through every layer whatever ``trace_filters`` says. SIGUSR1 logs
+    the buffer.
+    """
+    if not config_true_value(conf.get('trace_calls', 'false')):
+        return None
+    tracer.configure(conf.get('trace_filters', '').split(),
+                     size=int(conf.get('trace_buffer_size', 1000)))
+
+    def wrap(app, index):
+        caller = plan[index - 1].name if index else 'client'
+        return TracedCall(app, plan[index].name, caller)
+    return wrap
+
+
+def loadapp(conf_file, global_conf=None, allow_modify_pipeline=True):
+    """
+    Loads a context from a config file, and if the context is a pipeline
+    then presents the app with the opportunity to modify the pipeline.
+    """
+    start = time.time()
+    plan, cached = compile_pipeline(
+        conf_file, global_conf=global_conf,
+        allow_modify_pipeline=allow_modify_pipeline)
+    compiled = time.time()
+    wrappers = [wrapper for wrapper in (
+        _trace_wrapper(plan, plan[-1].conf),
+        _timing_wrapper(plan, plan[-1].conf)) if wrapper]
+
+    def wrap(app, index):
+        for wrapper in wrappers:
+            app = wrapper(app, index)
+        return app
+    app = build_pipeline(plan, wrap=wrap if wrappers else None)
+    get_logger(None, log_route='wsgi').info(
+        'Loaded pipeline "%s" in %.1fms (%s plan %.1fms, build %.1fms)',
+        ' '.join(str(entry.name) for entry in plan),
+        (time.time() - start) * 1000, 'cached' if cached else 'compiled',
+        (compiled - start) * 1000, (time.time() - compiled) * 1000)
+    return app
+
+
+class FilterTimings(object):
+    """
+    Latency histograms for every layer of one worker's pipeline: time spent
+    in the layer's own ``__call__`` (excluding the layers below it), time to
+    its first body chunk, and time spent iterating its body.
+    """
+
+    def __init__(self, names):
+        self.layers = [(name, Histogram(), Histogram(), Histogram())
+                       for name in names]
+
+    def report(self):
+        lines = ['filter timings for worker %d' % os.getpid()]
+        for name, call, first_byte, body in self.layers:
+            lines.append('%s: call(self) %s; first byte %s; body %s' % (
+                name, call.summary(), first_byte.summary(), body.summary()))
+        return lines
+
+
+LOCAL_ADDRS = ('127.0.0.1', '::1')
+
+
+def _is_local_request(env):
+    """
+    Whether a request came from this host itself, rather than through a
+    proxy or load balancer that says whom it is forwarding for.
+    """
+    return env.get('REMOTE_ADDR') in LOCAL_ADDRS and not (
+        env.get('HTTP_X_FORWARDED_FOR') or
+        env.get('HTTP_X_CLUSTER_CLIENT_IP'))
+
+
+class TimedCall(object):
+    """
+    Timer the pipeline builder puts in front of a layer when
+    ``filter_timing`` is on. The outermost one also answers
+    ``filter_timing_path`` with the worker's report, to clients on this
+    host only; from anywhere else the path goes down the pipeline like any
+    other.
+    """
+
+    def __init__(self, app, layer, timings, report_path=None):
+        self.app = app
+        self.call, self.first_byte, self.body = layer[1:]
+        self.timings = timings
+        self.report_path = report_path
+
+    def __call__(self, env, start_response):
+        if self.report_path and env.get('PATH_INFO') == self.report_path \
+                and _is_local_request(env):
+            body = ('\n'.join(self.timings.report()) + '\n').encode('utf-8')
+            start_response('200 OK', [('Content-Type', 'text/plain'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        # inclusive time of the layers below accumulates in the top slot
+        children = env.setdefault('swift.filter_timing', [])
+        children.append(0.0)
+        start = monotonic()
+        try:
+            app_iter = self.app(env, start_response)
+        finally:
+            elapsed = monotonic() - start
+            self.call.add(elapsed - children.pop())
+            if children:
+                children[-1] += elapsed
+        return _TimedBody(app_iter, self, start)
+
+
+class _TimedBody(ClosingIterable):
+
+    def __init__(self, app_iter, timer, start):
+        super(_TimedBody, self).__init__(app_iter)
+        self.timer = timer
+        self.start = start
+
+    def __iter__(self):
+        iterating = 0.0
+        first = True
+        try:
+            chunks = iter(self.app_iter)
+            while True:
+                before = monotonic()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    iterating += monotonic() - before
+                if first:
+                    self.timer.first_byte.add(monotonic() - self.start)
+                    first = False
+                yield chunk
+        finally:
+            self.timer.body.add(iterating)
+
+
+def _timing_wrapper(plan, conf):
+    """
+    Returns a build_pipeline ``wrap`` that times every layer, or None if
+    ``filter_timing`` is off, in which case nothing is inserted.
+
+    **Timing config and defaults**::
+
+        filter_timing = false
+        # path the outermost timer answers with this worker's histograms,
+        # to clients on this host only; empty to only log them
+        filter_timing_path = /filter-timing
+        # seconds between reports in the log; 0 disables them
+        filter_timing_dump_interval = 300
+    """
+    if not config_true_value(conf.get('filter_timing', 'false')):
+        return None
+    timings = FilterTimings([entry.name for entry in plan])
+    report_path = conf.get('filter_timing_path', '/filter-timing').strip()
+    interval = float(conf.get('filter_timing_dump_interval', 300))
+    if interval > 0:
+        logger = get_logger(conf, log_route='filter-timing')
+
+        def dump_periodically():
+            while True:
+                eventlet.sleep(interval)
+                for line in timings.report():
+                    logger.info(line)
+        spawn_background(dump_periodically)
+
+    def wrap(app, index):
+        return TimedCall(app, timings.layers[index], timings,
+                         report_path=report_path if index == 0 else None)
+    return wrap
+
+
+def get_socket(conf):
+    """
+    Bind socket to bind ip:port in conf.
+
+    :param conf: Configuration dict to read settings from
 
+    :returns: a listening eventlet socket
+    """
+    bind_addr = (conf.get('bind_ip', '0.0.0.0'),
+                 int(conf.get('bind_port', 8080)))
+    backlog = int(conf.get('backlog', 4096))
+    reuse_port = config_true_value(conf.get('reuse_port', 'false'))
+    bind_timeout = int(conf.get('bind_timeout', 30))
+    sock = None
+    retry_until = time.time() + bind_timeout
+    while not sock and time.time() < retry_until:
+        try:
+            sock = listen(bind_addr, backlog=backlog, reuse_port=reuse_port)
+        except IOError as err:
+            if err.errno != errno.EADDRINUSE:
+                raise
+            time.sleep(0.1)
+    if not sock:
+        raise Exception('Could not bind to %s:%s after trying for %s seconds'
+                        % (bind_addr[0], bind_addr[1], bind_timeout))
+    return sock
+
+
+def get_server_backend(conf):
+    """
+    Returns the ``server_backend`` of ``conf``, ``eventlet`` or ``asyncio``.
+
+    :raises ValueError: if it is neither, or asyncio is not available
+    """
+    backend = conf.get('server_backend', 'eventlet').strip().lower()
+    if backend not in SERVER_BACKENDS:
+        raise ValueError('Unknown server_backend %r, expected one of %s'
+                         % (backend, ', '.join(SERVER_BACKENDS)))
+    if backend == 'asyncio':
+        try:
+            import asyncio  # noqa
+        except ImportError:
+            raise ValueError('server_backend asyncio needs Python 3')
+    return backend
+
+
+def run_server(conf, logger, sock, global_conf=None, reload_on_hup=False):
+    """
+    Serves the pipeline from ``conf['__file__']`` on ``sock`` until told to
+    stop. SIGTERM or SIGHUP stops accepting new connections and lets the
+    requests already in flight finish, for up to
+    ``graceful_shutdown_timeout`` seconds, before returning.
+
+    With ``reload_on_hup``, as when there are no workers to replace, SIGHUP
+    loads the pipeline again instead: new requests go to the new one, those
+    in flight finish on the old one, and a config that fails to load
+    leaves the old one serving.
+
+    ``server_backend = asyncio`` serves it with
+    :mod:`swift.common.asyncio_server` instead of eventlet's server.
+    """
+    if get_server_backend(conf) == 'asyncio':
+        from swift.common.asyncio_server import run_asyncio_server
+        return run_asyncio_server(conf, logger, sock, global_conf=global_conf,
+                                  reload_on_hup=reload_on_hup)
+    apps = [loadapp(conf['__file__'], global_conf=global_conf)]
+
+    def app(env, start_response):
+        return apps[0](env, start_response)
+
+    pool = GreenPool(size=int(conf.get('max_clients', 1024)))
+    # debug=False: a traceback goes to the log, never to the client
+    server = eventlet.spawn(wsgi.server, sock, app, custom_pool=pool,
+                            log=logger, debug=False)
+    drain_timeout = float(conf.get('graceful_shutdown_timeout', 60))
+
+    def abandon_requests():
+        logger.warning('%d requests still running after %ss, dropping them',
+                       pool.running(), drain_timeout)
+        for greenthread in list(pool.coroutines_running):
+            greenthread.kill()
+
+    def stop_accepting(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server.kill()
+        eventlet.spawn_after(drain_timeout, abandon_requests)
+
+    def reload_app():
+        try:
+            apps[0] = loadapp(conf['__file__'], global_conf=global_conf)
+        except Exception as err:
+            logger.error('Reload failed, keeping the running pipeline: %s',
+                         err)
+        else:
+            logger.info('Reloaded %s', conf['__file__'])
+
+    def reload_on_signal(signum, frame):
+        # not from inside the handler; loading takes a while
+        eventlet.spawn_n(reload_app)
+
+    def dump_traces(signum, frame):
+        for line in tracer.dump():
+            logger.info('trace: %s', line)
+
+    signal.signal(signal.SIGTERM, stop_accepting)
+    signal.signal(signal.SIGHUP,
+                  reload_on_signal if reload_on_hup else stop_accepting)
+    signal.signal(signal.SIGUSR1, dump_traces)
+    try:
+        server.wait()
+    except GreenletExit:
+        pass
+    worker_exiting()
 
-def run_server(conf, logger, sock, global_conf=None):
-    app = loadapp(conf['__file__'], global_conf=global_conf)
-    wsgi.server(sock=sock, site=app)
+
+def _read_server_conf(conf_path, app_section):
+    conf = dict(appconfig('config:' + os.path.abspath(conf_path),
+                          name=app_section))
+    conf['__file__'] = conf_path
+    return conf
+
+
+def run_workers(conf, logger, sock, global_conf=None, app_section=None):
+    """
+    Pre-forks ``workers`` processes that all serve ``sock``, respawns the ones
+    that die and forwards SIGTERM to them on shutdown.
+
+    On SIGHUP the config is read again and the pipeline built; if that
+    works a new set of workers is started on the same socket and the old
+    ones are told to drain and exit. If it fails the old workers carry on.
+    SIGUSR1 is passed on to the workers.
+
+    When ``sock`` is None every worker binds its own socket, which only works
+    with ``reuse_port = true``.
+
+    A worker that dies within ``worker_startup_time`` seconds of being
+    started is taken to have died starting up. It is respawned after a
+    backoff that doubles for each such death in a row, and after
+    ``max_startup_failures`` of them the workers are stopped.
+
+    :returns: 0, or 1 if the workers kept dying as they started
+    """
+    children = set()
+    draining = set()
+    signals = []
+    # pid -> when it was forked
+    started = {}
+    startup_time = float(conf.get('worker_startup_time', 10))
+    max_startup_failures = int(conf.get('max_startup_failures', 6))
+    startup_failures = 0
+    respawn_at = 0
+
+    def on_signal(signum, frame):
+        signals.append(signum)
+
+    def signal_children(pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+
+    def reload_conf():
+        try:
+            new_conf = _read_server_conf(conf['__file__'], app_section)
+            build_pipeline(compile_pipeline(new_conf['__file__'],
+                                            global_conf=global_conf)[0])
+        except Exception as err:
+            logger.error('Reload failed, keeping the running workers: %s',
+                         err)
+            return conf
+        logger.info('Reloaded %s, replacing %d workers',
+                    conf['__file__'], len(children))
+        signal_children(children, signal.SIGHUP)
+        draining.update(children)
+        children.clear()
+        return new_conf
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGHUP, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGUSR1, on_signal)
+    running = True
+    failed = False
+    while running or children or draining:
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and running:
+                conf = reload_conf()
+            elif signum == signal.SIGUSR1:
+                signal_children(children, signal.SIGUSR1)
+            elif signum in (signal.SIGTERM, signal.SIGINT) and running:
+                running = False
+                logger.info('Signal %s received, stopping %d workers',
+                            signum, len(children) + len(draining))
+                signal_children(children | draining, signal.SIGTERM)
+        while running and len(children) < int(conf.get('workers', 1)) and \
+                time.time() >= respawn_at:
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                eventlet.hubs.use_hub()
+                try:
+                    run_server(conf, logger, sock or get_socket(conf),
+                               global_conf=global_conf)
+                except Exception:
+                    logger.exception('Worker %s failed', os.getpid())
+                    os._exit(1)
+                os._exit(0)
+            logger.info('Started child %s', pid)
+            children.add(pid)
+            started[pid] = time.time()
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno != errno.ECHILD:
+                raise
+            if not running:
+                break
+            # every worker is dead, waiting to be respawned
+            pid = 0
+        if not pid:
+            # signals interrupt the nap, so they are still seen promptly
+            time.sleep(0.1)
+            continue
+        lived = time.time() - started.pop(pid, 0)
+        if pid in children:
+            children.discard(pid)
+            if not running:
+                continue
+            logger.error('Removing dead child %s (status %s)', pid, status)
+            if lived >= startup_time:
+                startup_failures = 0
+                continue
+            startup_failures += 1
+            if startup_failures >= max_startup_failures:
+                logger.error('%d workers in a row died within %ss of '
+                             'starting, stopping', startup_failures,
+                             startup_time)
+                running, failed = False, True
+                signal_children(children | draining, signal.SIGTERM)
+                continue
+            backoff = min(RESPAWN_BACKOFF * 2 ** (startup_failures - 1),
+                          MAX_RESPAWN_BACKOFF)
+            respawn_at = time.time() + backoff
+            logger.error('Child %s died %.1fs after starting, respawning '
+                         'in %ss', pid, lived, backoff)
+        elif pid in draining:
+            draining.discard(pid)
+            logger.info('Old child %s finished draining', pid)
+    logger.info('Exited')
+    return 1 if failed else 0
 
 
 def run_wsgi(conf_path, app_section, *args, **kwargs):
     """
     Runs the server using the specified number of workers.
 
+    **Server config and defaults** (read from ``[DEFAULT]`` and the app
+    section)::
+
+        bind_ip = 0.0.0.0
+        bind_port = 8080
+        backlog = 4096
+        workers = 1
+        worker_startup_time = 10
+        max_startup_failures = 6
+        reuse_port = false
+        graceful_shutdown_timeout = 60
+        server_backend = eventlet
+        max_clients = 1024
+        executor_threads = 64
+        client_timeout = 60
+
+    ``server_backend`` is ``eventlet`` or ``asyncio``; ``max_clients`` only
+    applies to the first, ``executor_threads`` (the most requests the
+    pipeline runs at once) and ``client_timeout`` (how long an idle
+    keep-alive connection is kept) to the second.
+
+    Workers that die within ``worker_startup_time`` seconds of starting are
+    respawned with a backoff, and after ``max_startup_failures`` such deaths
+    in a row the server gives up; see :func:`run_workers`.
+
+    ``workers = 0`` serves everything from the calling process, which is
+    handy for debugging; SIGHUP then reloads the pipeline in that process.
+
     :param conf_path: Path to paste.deploy style configuration file/directory
     :param app_section: App name from conf file to load config from
     :returns: 0 if successful, nonzero otherwise
     """
-    conf = {
-        '__file__': conf_path
-    }
+    conf = _read_server_conf(conf_path, app_section)
+    logger = get_logger(conf, log_route='wsgi')
+
+    try:
+        get_server_backend(conf)
+    except ValueError as err:
+        logger.error('%s', err)
+        return 1
+
+    reuse_port = config_true_value(conf.get('reuse_port', 'false'))
+    worker_count = int(conf.get('workers', 1))
+    try:
+        # with SO_REUSEPORT each worker binds its own socket and the kernel
+        # spreads new connections across them
+        sock = None if reuse_port and worker_count else get_socket(conf)
+    except Exception as err:
+        logger.error('Unable to bind: %s', err)
+        return 1
 
-    logger = None
-    sock = listen(('127.0.0.1', 8080))
-    # sock2 = listener.dup()
     global_conf = None
-    run_server(conf, logger, sock, global_conf=global_conf)
-    return 0
+    try:
+        # parse and build the pipeline once, before any worker needs it: a
+        # config it can't be built from, such as one without its rings, is
+        # reported here rather than by every worker forked to serve it
+        build_pipeline(compile_pipeline(conf_path,
+                                        global_conf=global_conf)[0])
+    except Exception as err:
+        logger.error('Unable to load pipeline from %s: %s', conf_path, err)
+        return 1
+
+    if worker_count == 0:
+        run_server(conf, logger, sock, global_conf=global_conf,
+                   reload_on_hup=True)
+        return 0
+    return run_workers(conf, logger, sock, global_conf=global_conf,
+                       app_section=app_section)
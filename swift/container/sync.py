@@ -0,0 +1,251 @@
+"""
+Container sync: pushes the object PUTs and DELETEs of a container to its
+sister container in another cluster.
+
+A container's changes are read as rows, ``batch_size`` at a time, from a
+:class:`RowSource`; the next batch is read while the current one is being
+pushed. Within a batch only the last row of each object name is sent. The
+requests go to their destination over a pool of keep-alive connections,
+``conns_per_destination`` of them at most, shared by every container
+syncing to the same host. So a large container is synced at the rate the
+destination can take it, not one round trip per object.
+
+A container's sync point is moved only once a batch is done with, and
+only as far as the rows before its first failure; those are tried again
+on the next pass.
+
+Requests are signed for the destination's
+:class:`swift.common.middleware.container_sync.ContainerSync` with the
+realm key from ``container-sync-realms.conf`` and the container's
+``X-Container-Sync-Key``.
+"""
+from uuid import uuid4
+
+try:
+    from urllib import quote
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import quote, urlparse
+
+import eventlet
+from eventlet import GreenPile, GreenPool, Timeout
+
+from swift.common.connection_pool import HTTPConnPool
+from swift.common.utils import close_if_possible
+
+
+class RowSource(object):
+    """
+    Where the rows and objects of a container being synced come from.
+
+    Rows are dicts with the ``ROWID``, ``name``, ``created_at`` (the
+    X-Timestamp to send) and ``deleted`` of each change to the container,
+    in ROWID order. This tree has no container server to read them from, so
+    whatever keeps them implements this.
+    """
+
+    def get_sync_point(self):
+        """Returns the ROWID synced up to, -1 for none."""
+        raise NotImplementedError()
+
+    def set_sync_point(self, rowid):
+        raise NotImplementedError()
+
+    def get_items_since(self, rowid, count):
+        """Returns at most ``count`` rows after ``rowid``."""
+        raise NotImplementedError()
+
+    def get_object(self, name):
+        """
+        Returns ``(headers, body)`` for the object to PUT, or None if it
+        has gone since. ``headers`` must have its Content-Length, and
+        should have its ETag, Content-Type and metadata; ``body`` is an
+        iterable of byte strings.
+        """
+        raise NotImplementedError()
+
+
+class _Destination(object):
+
+    def __init__(self, scheme, netloc, size, conn_timeout, node_timeout):
+        self.conns = HTTPConnPool(scheme, netloc, size, conn_timeout,
+                                  node_timeout)
+        self.pool = GreenPool(size)
+
+
+class ContainerSyncWorker(object):
+    """
+    Syncs containers to their destinations; see above.
+
+    :param realms_conf: a
+                        :class:`swift.common.container_sync_realms.ContainerSyncRealms`
+    :param batch_size: rows read from a :class:`RowSource` at a time
+    :param conns_per_destination: most requests in flight to one host
+    """
+
+    def __init__(self, realms_conf, logger, batch_size=1000,
+                 conns_per_destination=8, conn_timeout=5, node_timeout=10):
+        self.realms_conf = realms_conf
+        self.logger = logger
+        self.batch_size = batch_size
+        self.conns_per_destination = conns_per_destination
+        self.conn_timeout = conn_timeout
+        self.node_timeout = node_timeout
+        self.destinations = {}
+        self.stats = {'puts': 0, 'deletes': 0, 'skips': 0, 'failures': 0}
+
+    def resolve(self, sync_to):
+        """
+        Turns an ``X-Container-Sync-To`` of ``//realm/cluster/account/
+        container`` into ``(realm, url)``.
+
+        :raises ValueError: if it is malformed or names an unknown cluster
+        """
+        parts = sync_to.split('/')
+        if len(parts) != 6 or parts[0] or parts[1] or \
+                not all(parts[2:]):
+            raise ValueError('Invalid X-Container-Sync-To %r' % sync_to)
+        realm, cluster, account, container = parts[2:]
+        endpoint = self.realms_conf.endpoint(realm, cluster)
+        if not endpoint:
+            raise ValueError('No cluster endpoint for %r %r'
+                             % (realm, cluster))
+        return realm, '%s/%s/%s' % (endpoint.rstrip('/'), account, container)
+
+    def _destination(self, scheme, netloc):
+        key = (scheme, netloc)
+        dest = self.destinations.get(key)
+        if dest is None:
+            dest = self.destinations[key] = _Destination(
+                scheme, netloc, self.conns_per_destination,
+                self.conn_timeout, self.node_timeout)
+        return dest
+
+    def sync(self, containers, concurrency=16):
+        """
+        Syncs containers side by side.
+
+        :param containers: ``(source, sync_to, user_key)`` of each
+        :returns: how many were synced through without a failure
+        """
+        pool = GreenPool(concurrency)
+        return sum(1 for ok in pool.imap(
+            lambda args: self.sync_container(*args), containers) if ok)
+
+    def sync_container(self, source, sync_to, user_key):
+        """
+        Pushes everything after the container's sync point.
+
+        :returns: True if it is all through
+        """
+        try:
+            realm, url = self.resolve(sync_to)
+        except ValueError as err:
+            self.logger.error('%s', err)
+            return False
+        realm_key = self.realms_conf.key(realm)
+        parsed = urlparse(url)
+        dest = self._destination(parsed.scheme, parsed.netloc)
+        point = source.get_sync_point()
+        batch = source.get_items_since(point, self.batch_size)
+        while batch:
+            next_batch = eventlet.spawn(
+                source.get_items_since, batch[-1]['ROWID'], self.batch_size)
+            done = self._push_batch(source, dest, parsed.path, realm,
+                                    realm_key, user_key, batch)
+            if done is not None and done > point:
+                source.set_sync_point(done)
+                point = done
+            if done != batch[-1]['ROWID']:
+                next_batch.kill()
+                return False
+            batch = next_batch.wait()
+        return True
+
+    def _push_batch(self, source, dest, path, realm, realm_key, user_key,
+                    batch):
+        """
+        Sends the batch, returning the ROWID every row up to has been
+        synced, or None if not even the first one was.
+        """
+        last_row = {}
+        for row in batch:
+            last_row[row['name']] = row
+        pile = GreenPile(dest.pool)
+        for row in batch:
+            if last_row[row['name']] is row:
+                pile.spawn(self._push_row, source, dest, path, realm,
+                           realm_key, user_key, row)
+            else:
+                # superseded later in the batch
+                self.stats['skips'] += 1
+                pile.spawn(lambda: True)
+        done = None
+        for row, ok in zip(batch, pile):
+            if not ok:
+                break
+            done = row['ROWID']
+        return done
+
+    def _push_row(self, source, dest, path, realm, realm_key, user_key,
+                  row):
+        obj_path = '%s/%s' % (path, row['name'])
+        timestamp = str(row['created_at'])
+        method = 'DELETE' if row['deleted'] else 'PUT'
+        headers, body = {}, None
+        try:
+            if method == 'PUT':
+                got = source.get_object(row['name'])
+                if got is None:
+                    self.stats['skips'] += 1
+                    return True
+                headers, body = dict(got[0]), got[1]
+            nonce = uuid4().hex
+            headers['X-Timestamp'] = timestamp
+            headers['X-Container-Sync-Auth'] = '%s %s %s' % (
+                realm, nonce, self.realms_conf.get_sig(
+                    method, obj_path, timestamp, nonce, realm_key, user_key))
+            status = self._request(dest.conns, method, quote(obj_path),
+                                   headers, body)
+        except (Exception, Timeout) as err:
+            self.stats['failures'] += 1
+            self.logger.error('ERROR Syncing %s %s: %s', method, obj_path,
+                              err)
+            return False
+        finally:
+            close_if_possible(body)
+        if 200 <= status < 300 or method == 'DELETE' and status == 404:
+            self.stats['deletes' if method == 'DELETE' else 'puts'] += 1
+            return True
+        self.stats['failures'] += 1
+        self.logger.error('ERROR Syncing %s %s: status %s', method,
+                          obj_path, status)
+        return False
+
+    def _request(self, conns, method, path, headers, body):
+        # waiting for a free connection counts as waiting on the node
+        with Timeout(conns.node_timeout):
+            conn = conns.get()
+        try:
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            if body is None:
+                conn.putheader('Content-Length', '0')
+            conn.endheaders()
+            if body is not None:
+                for chunk in body:
+                    conn.send(chunk)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except BaseException:
+            conn.close()
+            conns.put(None)
+            raise
+        if resp.getheader('connection', '').lower() == 'close':
+            conn.close()
+            conns.put(None)
+        else:
+            conns.put(conn)
+        return status
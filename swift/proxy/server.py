@@ -1,66 +1,677 @@
-from swift.ipvl.inspect_custom import  whoami, whosdaddy
+"""
+The proxy server app, at the end of the pipeline, which sends account,
+container and object requests on to the storage nodes that hold them.
+
+Reads go to one node at a time, starting with the first replica. A node
+that answers with an error, or with a 404 (it may just not have the data
+yet), is passed over for the next one straight away. With
+``concurrent_gets`` on, a node that has not answered within
+``concurrency_timeout`` seconds does not hold the request up either: the
+next node is asked as well, and whichever answers first is used.
+
+Writes go to every replica at once. An object's body is streamed to all of
+them as it arrives. The write is answered as soon as a quorum, a majority
+of the replicas, have agreed; the others get ``post_quorum_timeout`` more
+seconds before the answer goes out without them.
+
+Each node has a pool of keep-alive connections, ``max_conns_per_node`` at
+most. Connecting may take ``conn_timeout`` seconds and each read from a
+node ``node_timeout`` seconds. A node with more than
+``error_suppression_limit`` errors, none of them more than
+``error_suppression_interval`` seconds apart, is skipped until that long
+passes without another; a ``507`` skips it straight away.
+
+The nodes come from the account, container and object rings in
+``swift_dir`` (see :mod:`swift.common.ring`), each file looked at for
+changes every ``ring_check_interval`` seconds. Handoffs are used in place
+of primaries that are error-limited or fail, ``request_node_count`` nodes
+in all at most. Without rings, the nodes can be listed in
+``backend_nodes`` as ``ip:port/device``: the first ``replicas`` of them
+hold everything, and the rest are handoffs.
+"""
+import itertools
+import time
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+import eventlet
+from eventlet import GreenPile, Timeout
+from eventlet.queue import Empty, Queue
+
+from swift.common.connection_pool import HTTPConnPool, PoolsByThread
+from swift.common.ring import Ring
+from swift.common.utils import config_true_value, get_logger, split_path
+from swift.ipvl.inspect_custom import whoami, whosdaddy
 
 
 pass  # (WIS) print __name__
 
+# Filters the proxy can't run without. Each one is placed after every entry
+# point named in 'after' and before every one named in 'before' that is in
+# the pipeline; see swift.common.wsgi.order_filters.
 required_filters = [
     {'name': 'catch_errors'},
-    {'name': 'gatekeeper',
-     'after_fn': lambda pipe: (['catch_errors']
-                               if pipe.startswith('catch_errors')
-                               else [])},
-    {'name': 'dlo', 'after_fn': lambda _junk: [
+    {'name': 'gatekeeper', 'after': ['catch_errors']},
+    {'name': 'dlo', 'after': [
         'staticweb', 'tempauth', 'keystoneauth',
         'catch_errors', 'gatekeeper', 'proxy_logging']}]
 
+# client headers not passed on to the storage nodes
+NOT_FORWARDED = frozenset((
+    'HTTP_CONNECTION', 'HTTP_HOST', 'HTTP_KEEP_ALIVE', 'HTTP_TE',
+    'HTTP_TRANSFER_ENCODING', 'HTTP_UPGRADE', 'HTTP_EXPECT',
+    'HTTP_X_AUTH_TOKEN', 'HTTP_X_STORAGE_TOKEN'))
+# backend response headers not passed on to the client
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'transfer-encoding',
+                        'te', 'trailer', 'upgrade'))
+# reason phrases for the statuses a write can be answered with
+REASONS = {
+    200: 'OK', 201: 'Created', 202: 'Accepted', 204: 'No Content',
+    400: 'Bad Request', 404: 'Not Found', 409: 'Conflict',
+    412: 'Precondition Failed', 413: 'Request Entity Too Large',
+    422: 'Unprocessable Entity', 503: 'Service Unavailable'}
+# error bodies up to this size are read so the connection can be reused
+DRAIN_LIMIT = 65536
+
+
+def normalize_timestamp(timestamp):
+    return '%016.05f' % float(timestamp)
+
+
+def quorum_size(n):
+    return n // 2 + 1
+
+
+def parse_backend_nodes(value):
+    """
+    Parses a list of ``ip:port/device`` into node dicts.
+
+    :raises ValueError: if one is malformed
+    """
+    nodes = []
+    for entry in value.replace(',', ' ').split():
+        addr, _, device = entry.partition('/')
+        ip, _, port = addr.rpartition(':')
+        if not ip or not port.isdigit() or not device:
+            raise ValueError('Invalid backend node %r, expected '
+                             'ip:port/device' % entry)
+        nodes.append({'id': len(nodes), 'ip': ip.strip('[]'),
+                      'port': int(port), 'device': device})
+    return nodes
+
+
+class StaticRing(object):
+    """
+    A fixed list of nodes in place of a ring: the first ``replicas`` hold
+    every path, in partition 0, and the rest are its handoffs.
+    """
+
+    def __init__(self, nodes, replicas):
+        self.devs = nodes
+        self.replica_count = min(replicas, len(nodes))
+
+    def get_nodes(self, account, container=None, obj=None):
+        return 0, self.devs[:self.replica_count]
+
+    def get_part_nodes(self, part):
+        return self.devs[:self.replica_count]
+
+    def get_more_nodes(self, part):
+        return iter(self.devs[self.replica_count:])
+
+
+def best_response(statuses, quorum):
+    """
+    Returns the status a quorum of ``statuses`` agree on the class of,
+    the first of that class, or 503 if there is none.
+    """
+    for hundred in (200, 300, 400, 500):
+        matching = [s for s in statuses if hundred <= s < hundred + 100]
+        if len(matching) >= quorum:
+            return matching[0]
+    return 503
+
+
+class BackendResponse(object):
+    """
+    A response from a storage node, its headers read. Iterating over it
+    streams the body; once that is read to the end, or :meth:`finish` has
+    drained a small one, the connection goes back to the node's pool.
+    """
+
+    def __init__(self, app, node, pool, conn, resp):
+        self.app = app
+        self.node = node
+        self.pool = pool
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = [(name.title(), value)
+                        for name, value in resp.getheaders()
+                        if name.lower() not in HOP_BY_HOP]
+
+    def _release(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.pool.put(self.conn)
+        else:
+            self.conn.close()
+            self.pool.put(None)
+        self.conn = None
+
+    def finish(self):
+        """Done with the response; reads its body if that is cheap."""
+        if self.conn is not None and self.resp.length is not None and \
+                self.resp.length <= DRAIN_LIMIT:
+            try:
+                with Timeout(self.app.node_timeout):
+                    self.resp.read()
+            except (Exception, Timeout):
+                pass
+        self._release()
+
+    def __iter__(self):
+        try:
+            while True:
+                with Timeout(self.app.node_timeout):
+                    chunk = self.resp.read(self.app.client_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        except (Exception, Timeout) as err:
+            self.app.error_occurred(self.node, 'Trying to read: %s' % err)
+            self.close()
+            raise IOError('Error reading from %s: %s'
+                          % (self.app.node_key(self.node), err))
+        self._release()
+
+    def close(self):
+        if self.conn is not None:
+            # part of the body is still unread
+            self.conn.close()
+            self.pool.put(None)
+            self.conn = None
+
+
+class _PutConnection(object):
+    """One replica an object's body is being streamed to."""
+
+    def __init__(self, node, pool, conn):
+        self.node = node
+        self.pool = pool
+        self.conn = conn
+        self.failed = False
+        self.queue = Queue(10)
+
 
 class Application(object):
-    """docstring for Application"""
-    def __init__(self, arg=None):
+    """WSGI app that sends requests on to the storage nodes; see above."""
+
+    def __init__(self, conf=None, logger=None):
         pass  # (WIS) print "%s %s (%s -> %s)" % (__name__, self.__class__.__name__, whosdaddy(), whoami())
-        self.arg = arg
+        conf = conf or {}
+        self.conf = conf
+        self.logger = logger or get_logger(conf, log_route='proxy-server')
+        self.conn_timeout = float(conf.get('conn_timeout', 0.5))
+        self.node_timeout = float(conf.get('node_timeout', 10))
+        self.client_timeout = float(conf.get('client_timeout', 60))
+        self.post_quorum_timeout = float(conf.get('post_quorum_timeout',
+                                                  0.5))
+        self.concurrent_gets = config_true_value(
+            conf.get('concurrent_gets', 'true'))
+        self.concurrency_timeout = float(conf.get('concurrency_timeout',
+                                                  self.conn_timeout))
+        self.error_suppression_interval = float(
+            conf.get('error_suppression_interval', 60))
+        self.error_suppression_limit = int(
+            conf.get('error_suppression_limit', 10))
+        self.max_conns_per_node = int(conf.get('max_conns_per_node', 16))
+        self.client_chunk_size = int(conf.get('client_chunk_size', 65536))
+        self.allow_account_management = config_true_value(
+            conf.get('allow_account_management', 'false'))
+        if conf.get('backend_nodes'):
+            ring = StaticRing(parse_backend_nodes(conf['backend_nodes']),
+                              int(conf.get('replicas', 3)))
+            self.rings = {'account': ring, 'container': ring,
+                          'object': ring}
+        else:
+            swift_dir = conf.get('swift_dir', '/etc/swift')
+            reload_time = float(conf.get('ring_check_interval', 15))
+            self.rings = {}
+            for name in ('account', 'container', 'object'):
+                try:
+                    self.rings[name] = Ring(swift_dir, ring_name=name,
+                                            reload_time=reload_time)
+                except (IOError, OSError, ValueError) as err:
+                    raise ValueError(
+                        'Unable to load the %s ring (%s); build the rings '
+                        'in swift_dir or list the nodes in backend_nodes'
+                        % (name, err))
+        value = conf.get('request_node_count', '2 * replicas').lower().split()
+        if len(value) == 1:
+            self.request_node_count = lambda replicas: int(value[0])
+        elif len(value) == 3 and value[1] == '*' and value[2] == 'replicas':
+            self.request_node_count = \
+                lambda replicas: int(value[0]) * replicas
+        else:
+            raise ValueError('Invalid request_node_count value: %r'
+                             % conf['request_node_count'])
+        self.conn_pools = PoolsByThread(lambda netloc: HTTPConnPool(
+            'http', netloc, self.max_conns_per_node, self.conn_timeout,
+            self.node_timeout))
+        # node key -> (errors, time of the last one)
+        self.node_errors = {}
+
+    @staticmethod
+    def node_key(node):
+        return '%(ip)s:%(port)s/%(device)s' % node
+
+    def error_limited(self, node):
+        errors = self.node_errors.get(self.node_key(node))
+        if errors is None:
+            return False
+        count, last_error = errors
+        if time.time() - last_error > self.error_suppression_interval:
+            del self.node_errors[self.node_key(node)]
+            return False
+        return count > self.error_suppression_limit
+
+    def error_occurred(self, node, msg):
+        key = self.node_key(node)
+        count, _last = self.node_errors.get(key, (0, 0))
+        self.node_errors[key] = (count + 1, time.time())
+        self.logger.error('ERROR with node %s: %s', key, msg)
+
+    def error_limit(self, node, msg):
+        """Skips the node until error_suppression_interval has passed."""
+        key = self.node_key(node)
+        self.node_errors[key] = (self.error_suppression_limit + 1,
+                                 time.time())
+        self.logger.error('Node error limited %s: %s', key, msg)
+
+    def iter_nodes(self, ring, part):
+        """
+        Yields the partition's primary nodes, then its handoffs, passing
+        over error-limited ones, until ``request_node_count`` have been.
+        """
+        limit = self.request_node_count(ring.replica_count)
+        count = 0
+        for node in itertools.chain(ring.get_part_nodes(part),
+                                    ring.get_more_nodes(part)):
+            if count >= limit:
+                return
+            if not self.error_limited(node):
+                count += 1
+                yield node
+
+    def _pool(self, node):
+        return self.conn_pools['%(ip)s:%(port)s' % node]
+
+    def _connect(self, node, part, method, path, headers):
+        """
+        Sends a request line and headers to a node.
+
+        :returns: ``(pool, conn)``, or None if it could not be reached
+        """
+        pool = self._pool(node)
+        try:
+            # waiting for a free connection counts as waiting on the node
+            with Timeout(self.node_timeout):
+                conn = pool.get()
+        except (Exception, Timeout) as err:
+            # nothing was taken from the pool, so nothing goes back
+            self.error_occurred(node, 'Trying to %s %s: %s'
+                                % (method, path, err))
+            return None
+        try:
+            with Timeout(self.node_timeout):
+                conn.putrequest(method, '/%s/%s%s' % (
+                    node['device'], part, quote(path)),
+                    skip_accept_encoding=True)
+                for name, value in headers.items():
+                    conn.putheader(name, value)
+                conn.endheaders()
+        except (Exception, Timeout) as err:
+            conn.close()
+            pool.put(None)
+            self.error_occurred(node, 'Trying to %s %s: %s'
+                                % (method, path, err))
+            return None
+        return pool, conn
+
+    def _get_response(self, node, pool, conn, method, path):
+        """
+        Reads a node's response headers.
+
+        :returns: a :class:`BackendResponse`, or None if there was none
+        """
+        try:
+            with Timeout(self.node_timeout):
+                resp = conn.getresponse()
+        except (Exception, Timeout) as err:
+            conn.close()
+            pool.put(None)
+            self.error_occurred(node, 'Trying to get response to %s %s: %s'
+                                % (method, path, err))
+            return None
+        resp = BackendResponse(self, node, pool, conn, resp)
+        if resp.status == 507:
+            self.error_limit(node, 'Insufficient Storage')
+        elif resp.status >= 500:
+            self.error_occurred(node, '%s %s returned %s'
+                                % (method, path, resp.status))
+        return resp
+
+    def _request(self, node, part, method, path, headers):
+        """Makes a bodiless request of a node; see _get_response."""
+        connected = self._connect(node, part, method, path, headers)
+        if connected is None:
+            return None
+        return self._get_response(node, connected[0], connected[1], method,
+                                  path)
+
+    def backend_headers(self, env):
+        headers = {'X-Trans-Id': env.get('swift.trans_id', '-')}
+        for key, value in env.items():
+            if key.startswith('HTTP_') and key not in NOT_FORWARDED:
+                headers[key[5:].replace('_', '-').title()] = value
+        if env.get('CONTENT_TYPE'):
+            headers['Content-Type'] = env['CONTENT_TYPE']
+        return headers
+
+    @staticmethod
+    def _respond(start_response, status, headers=()):
+        start_response(status, list(headers) + [('Content-Length', '0')])
+        return [b'']
 
     def __call__(self, env, start_response):
         pass  # (WIS) print "%s %s" % (self.__class__.__name__, env)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return self.__class__.__name__
+        try:
+            version, account, container, obj = split_path(
+                env['PATH_INFO'], 2, 4, True)
+        except ValueError:
+            return self._respond(start_response, '404 Not Found')
+        if version != 'v1':
+            return self._respond(start_response, '404 Not Found')
+        if obj:
+            server_type = 'object'
+        elif container:
+            server_type = 'container'
+        else:
+            server_type = 'account'
+        path = '/' + '/'.join(p for p in (account, container, obj) if p)
+        method = env['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD', 'PUT', 'POST', 'DELETE') or \
+                server_type == 'account' and method in ('PUT', 'DELETE') \
+                and not self.allow_account_management:
+            allow = 'GET, HEAD, POST' if server_type == 'account' and \
+                not self.allow_account_management else \
+                'GET, HEAD, PUT, POST, DELETE'
+            return self._respond(start_response, '405 Method Not Allowed',
+                                 [('Allow', allow)])
+        ring = self.rings[server_type]
+        part, _nodes = ring.get_nodes(account, container, obj)
+        if method in ('GET', 'HEAD'):
+            return self.get_or_head(env, start_response, ring, part, path)
+        return self.write(env, start_response, server_type, ring, part,
+                          path)
+
+    def get_or_head(self, env, start_response, ring, part, path):
+        """
+        Answers with the first node to give a good response, hedging to
+        the next node whenever one is slow; see above.
+        """
+        method = env['REQUEST_METHOD']
+        headers = self.backend_headers(env)
+        nodes = self.iter_nodes(ring, part)
+        results = Queue()
+
+        def attempt(node):
+            results.put(self._request(node, part, method, path, headers))
 
-    def modify_wsgi_pipeline(self, pipe):
+        def ask_next():
+            for node in nodes:
+                eventlet.spawn_n(attempt, node)
+                return 1
+            return 0
+
+        hedge_after = self.concurrency_timeout if self.concurrent_gets \
+            else None
+        in_flight = ask_next()
+        statuses = []
+        winner = None
+        while in_flight:
+            try:
+                resp = results.get(timeout=hedge_after)
+            except Empty:
+                in_flight += ask_next()
+                continue
+            in_flight -= 1
+            if resp is None:
+                statuses.append(503)
+            elif resp.status < 500 and resp.status != 404:
+                winner = resp
+                break
+            else:
+                statuses.append(resp.status)
+                resp.finish()
+            in_flight += ask_next()
+        if in_flight:
+            eventlet.spawn_n(self._discard_responses, results, in_flight)
+        if winner is None:
+            return self._respond(start_response,
+                                 '404 Not Found' if 404 in statuses
+                                 else '503 Service Unavailable')
+        start_response('%d %s' % (winner.status, winner.reason),
+                       winner.headers)
+        if method == 'HEAD':
+            winner.finish()
+            return [b'']
+        return winner
+
+    @staticmethod
+    def _discard_responses(results, count):
+        """Closes the responses of hedged requests that lost the race."""
+        for _ in range(count):
+            resp = results.get()
+            if resp is not None:
+                resp.close()
+
+    def write(self, env, start_response, server_type, ring, part, path):
+        """
+        Sends a PUT, POST or DELETE to every replica and answers once a
+        quorum of them agree; see above.
+        """
+        method = env['REQUEST_METHOD']
+        headers = self.backend_headers(env)
+        headers['X-Timestamp'] = normalize_timestamp(time.time())
+        quorum = quorum_size(ring.replica_count)
+        # what is left of it stands in for nodes that cannot be reached
+        more_nodes = self.iter_nodes(ring, part)
+        nodes = []
+        for node in more_nodes:
+            nodes.append(node)
+            if len(nodes) >= ring.replica_count:
+                break
+        if len(nodes) < quorum:
+            return self._respond(start_response, '503 Service Unavailable')
+        results = Queue()
+        if server_type == 'object' and method == 'PUT' and \
+                env.get('CONTENT_LENGTH') != '0':
+            sent, error = self._stream_object(env, part, path, headers,
+                                              nodes, more_nodes, quorum,
+                                              results)
+            if error:
+                return self._respond(start_response, error)
+        else:
+            headers['Content-Length'] = '0'
+
+            def attempt(node):
+                resp = self._request(node, part, method, path, headers)
+                while resp is None:
+                    node = next(more_nodes, None)
+                    if node is None:
+                        break
+                    resp = self._request(node, part, method, path, headers)
+                if resp is not None:
+                    resp.finish()
+                results.put(resp)
+            for node in nodes:
+                eventlet.spawn_n(attempt, node)
+            sent = len(nodes)
+
+        statuses = []
+        etag = None
+        deadline = None
+        while len(statuses) < sent:
+            timeout = None if deadline is None else \
+                max(0, deadline - time.time())
+            try:
+                resp = results.get(timeout=timeout)
+            except Empty:
+                break
+            statuses.append(503 if resp is None else resp.status)
+            if resp is not None and 200 <= resp.status < 300:
+                etag = etag or dict(
+                    (k.lower(), v) for k, v in resp.headers).get('etag')
+            if deadline is None and \
+                    len([s for s in statuses if 200 <= s < 300]) >= quorum:
+                deadline = time.time() + self.post_quorum_timeout
+        status = best_response(statuses, quorum)
+        resp_headers = [('Etag', etag)] if etag and status < 300 else []
+        return self._respond(start_response, '%d %s' % (
+            status, REASONS.get(status, '')), resp_headers)
+
+    def _stream_object(self, env, part, path, headers, nodes, more_nodes,
+                       quorum, results):
+        """
+        Streams the request body to ``nodes``, or to ``more_nodes`` in
+        place of those that cannot be reached, then has their responses put
+        to ``results`` as they come.
+
+        :returns: ``(responses, error)``: how many responses will come,
+                  or the status to answer with if the body could not be
+                  sent
+        """
+        chunked = 'CONTENT_LENGTH' not in env
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            headers['Content-Length'] = env['CONTENT_LENGTH']
+        pile = GreenPile(len(nodes))
+        for node in nodes:
+            pile.spawn(self._connect, node, part, 'PUT', path, headers)
+        puts = [_PutConnection(node, conn[0], conn[1])
+                for node, conn in zip(nodes, pile) if conn]
+        for node in more_nodes:
+            if len(puts) >= len(nodes):
+                break
+            conn = self._connect(node, part, 'PUT', path, headers)
+            if conn:
+                puts.append(_PutConnection(node, conn[0], conn[1]))
+        if len(puts) < quorum:
+            for put in puts:
+                put.conn.close()
+                put.pool.put(None)
+            return 0, '503 Service Unavailable'
+        for put in puts:
+            eventlet.spawn_n(self._send_body, put, path)
+
+        def abort(status):
+            for put in puts:
+                put.failed = True
+                put.queue.put(None)
+            for put in puts:
+                put.queue.join()
+                put.conn.close()
+                put.pool.put(None)
+            return 0, status
+
+        read = env['wsgi.input'].read
+        received = 0
+        while True:
+            try:
+                with Timeout(self.client_timeout):
+                    chunk = read(self.client_chunk_size)
+            except (Exception, Timeout) as err:
+                self.logger.warning('ERROR reading PUT body of %s: %s',
+                                    path, err)
+                return abort('408 Request Timeout'
+                             if isinstance(err, Timeout)
+                             else '499 Client Disconnect')
+            if not chunk:
+                break
+            received += len(chunk)
+            if chunked:
+                chunk = b'%x\r\n%s\r\n' % (len(chunk), chunk)
+            for put in puts:
+                if not put.failed:
+                    put.queue.put(chunk)
+            if len([put for put in puts if not put.failed]) < quorum:
+                return abort('503 Service Unavailable')
+        if not chunked and received < int(env['CONTENT_LENGTH']):
+            return abort('499 Client Disconnect')
+        for put in puts:
+            if chunked:
+                put.queue.put(b'0\r\n\r\n')
+            put.queue.put(None)
+
+        def respond(put):
+            put.queue.join()
+            if put.failed:
+                put.conn.close()
+                put.pool.put(None)
+                results.put(None)
+                return
+            resp = self._get_response(put.node, put.pool, put.conn, 'PUT',
+                                      path)
+            if resp is not None:
+                resp.finish()
+            results.put(resp)
+        for put in puts:
+            eventlet.spawn_n(respond, put)
+        return len(puts), None
+
+    def _send_body(self, put, path):
+        """Writes what is queued for a replica until a None comes."""
+        while True:
+            chunk = put.queue.get()
+            try:
+                if chunk is None:
+                    return
+                if put.failed:
+                    continue
+                try:
+                    with Timeout(self.node_timeout):
+                        put.conn.send(chunk)
+                except (Exception, Timeout) as err:
+                    put.failed = True
+                    self.error_occurred(put.node, 'Trying to write to %s: %s'
+                                        % (path, err))
+            finally:
+                put.queue.task_done()
+
+    @classmethod
+    def modify_wsgi_pipeline(cls, pipe):
         """
         Called during WSGI pipeline creation. Modifies the WSGI pipeline
         context to ensure that mandatory middleware is present in the pipeline.
 
         :param pipe: A PipelineWrapper object
         """
-        pipeline_was_modified = False
-        print 'pipe: %s ' % pipe
-        for filter_spec in reversed(required_filters):
-            filter_name = filter_spec['name']
-            print 'filter name : %s ' % filter_name
-            if filter_name not in pipe:
-                afters = filter_spec.get('after_fn', lambda _junk: [])(pipe)
-                print '%s after : %s ' % (filter_name, afters)
-                insert_at = 0
-                for after in afters:
-                    try:
-                        insert_at = max(insert_at, pipe.index(after) + 1)
-                    except ValueError:  # not in pipeline; ignore it
-                        pass
-                # self.logger.info(
-                #     'Adding required filter %s to pipeline at position %d' %
-                #     (filter_name, insert_at))
-                print 'Adding required filter %s to pipeline at position %d' % (filter_name, insert_at)
-                ctx = pipe.create_filter(filter_name)
-                pipe.insert_filter(ctx, index=insert_at)
-                pipeline_was_modified = True
-
-        if pipeline_was_modified:
-            # self.logger.info("Pipeline was modified. New pipeline is \"%s\".",
-            #                  pipe)
-            print "Pipeline was modified. New pipeline is \"%s\".", pipe
+        logger = get_logger(pipe.context.global_conf,
+                            log_route='proxy-server')
+        inserted = pipe.add_required_filters(required_filters)
+        if inserted:
+            logger.info('Added required filters %s. New pipeline is "%s".',
+                        ', '.join(inserted), pipe)
         else:
-            # self.logger.debug("Pipeline is \"%s\"", pipe)
-            print "Pipeline is \"%s\"", pipe
+            logger.debug('Pipeline is "%s"', pipe)
 
 
 def app_factory(global_conf, **local_conf):
@@ -71,3 +682,7 @@ def app_factory(global_conf, **local_conf):
     app = Application(conf)
     # app.check_config()
     return app
+
+
+# lets loadapp modify the pipeline without building an Application first
+app_factory.modify_wsgi_pipeline = Application.modify_wsgi_pipeline
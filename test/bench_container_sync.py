@@ -0,0 +1,125 @@
+"""
+Measures how many objects per second container sync pushes to a sister
+cluster.
+
+The destination is a stand-in cluster on localhost: an eventlet WSGI server
+running :class:`swift.common.middleware.container_sync.ContainerSync` and
+tempauth in front of an in-memory object store, which takes ``latency``
+seconds to answer each request, as a real cluster's backend would. The
+same rows are synced one request at a time, as a serial sync would, and
+then by :class:`swift.container.sync.ContainerSyncWorker` with its
+defaults. Every object is checked to have arrived.
+
+Usage: python test/bench_container_sync.py [objects] [latency]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import eventlet
+from eventlet import wsgi
+
+from swift.common.container_sync_realms import ContainerSyncRealms
+from swift.common.middleware.container_sync import ContainerSync
+from swift.common.middleware.tempauth import TempAuth
+from swift.container.sync import ContainerSyncWorker, RowSource
+
+SYNC_KEY = 'containerkey'
+BODY = b'x' * 4096
+
+
+class MemoryRowSource(RowSource):
+
+    def __init__(self, objects):
+        self.rows = [{'ROWID': i, 'name': 'o%d' % i,
+                      'created_at': '%.5f' % (1000000000 + i),
+                      'deleted': 0}
+                     for i in range(objects)]
+        self.sync_point = -1
+
+    def get_sync_point(self):
+        return self.sync_point
+
+    def set_sync_point(self, rowid):
+        self.sync_point = rowid
+
+    def get_items_since(self, rowid, count):
+        return self.rows[rowid + 1:rowid + 1 + count]
+
+    def get_object(self, name):
+        return {'Content-Length': str(len(BODY)),
+                'Content-Type': 'application/octet-stream'}, [BODY]
+
+
+class StandInCluster(object):
+    """Object store behind the destination's container sync filter."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.objects = {}
+
+    def __call__(self, env, start_response):
+        path = env['PATH_INFO']
+        method = env['REQUEST_METHOD']
+        eventlet.sleep(self.latency)
+        if method == 'HEAD' and path.count('/') == 3:
+            start_response('204 No Content', [
+                ('X-Container-Sync-Key', SYNC_KEY)])
+        elif method == 'PUT':
+            self.objects[path] = env['wsgi.input'].read()
+            start_response('201 Created', [('Content-Length', '0')])
+        elif method == 'DELETE':
+            self.objects.pop(path, None)
+            start_response('204 No Content', [('Content-Length', '0')])
+        else:
+            start_response('405 Method Not Allowed',
+                           [('Content-Length', '0')])
+        return [b'']
+
+
+def run(name, worker, source, cluster, objects):
+    cluster.objects.clear()
+    start = time.time()
+    done = worker.sync_container(source, '//realm/dest/AUTH_b/c', SYNC_KEY)
+    elapsed = time.time() - start
+    if not done or len(cluster.objects) != objects or \
+            source.sync_point != objects - 1:
+        raise AssertionError('%s: %d of %d objects synced' % (
+            name, len(cluster.objects), objects))
+    print('%-10s %8.3fs  %9.0f objects/s' % (name, elapsed,
+                                            objects / elapsed))
+
+
+def main(objects, latency):
+    swift_dir = tempfile.mkdtemp()
+    logger = logging.getLogger('bench')
+    try:
+        cluster = StandInCluster(latency)
+        sock = eventlet.listen(('127.0.0.1', 0))
+        app = ContainerSync(TempAuth(cluster, {}), {'swift_dir': swift_dir})
+        eventlet.spawn(wsgi.server, sock, app, log=open(os.devnull, 'w'))
+        with open(os.path.join(swift_dir, 'container-sync-realms.conf'),
+                  'w') as fp:
+            fp.write('[realm]\nkey = realmkey\ncluster_dest = '
+                     'http://127.0.0.1:%d/v1/\n' % sock.getsockname()[1])
+        app.realms_conf.reload()
+        realms = ContainerSyncRealms(
+            os.path.join(swift_dir, 'container-sync-realms.conf'), logger)
+
+        print('%d objects of %d bytes, %gms per request at the destination'
+              % (objects, len(BODY), latency * 1000))
+        run('serial', ContainerSyncWorker(
+            realms, logger, batch_size=1, conns_per_destination=1),
+            MemoryRowSource(objects), cluster, objects)
+        run('pipelined', ContainerSyncWorker(realms, logger),
+            MemoryRowSource(objects), cluster, objects)
+    finally:
+        shutil.rmtree(swift_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.005)
@@ -0,0 +1,90 @@
+"""
+Measures what each filter in a pipeline adds to a request.
+
+Builds a chain of 15 filters around a trivial app three ways and reports the
+per-filter cost of each:
+
+* ``old``: every filter calls start_response itself and concatenates its
+  name onto the inner body, as the filters used to
+* ``pass-through``: :class:`swift.common.wsgi.Middleware` filters that hand
+  start_response and the body straight through
+* ``rewrite``: the same, but every filter rewrites the headers through
+  ``_rewrite_start_response``
+
+Usage: python test/bench_filter_overhead.py [requests]
+"""
+import sys
+import time
+
+from swift.common.wsgi import Middleware
+
+FILTERS = 15
+
+
+def app(env, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['Application']
+
+
+def string_app(env, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return 'Application'
+
+
+class OldFilter(object):
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, env, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return self.__class__.__name__ + "  ->  " + \
+            self.app(env, start_response)
+
+
+class RewritingFilter(Middleware):
+    def __call__(self, env, start_response):
+        return self.app(env, self._rewrite_start_response(
+            start_response, self._add_header))
+
+    @staticmethod
+    def _add_header(status, headers):
+        headers.append(('X-Filter', 'yes'))
+        return status, headers
+
+
+def build(filter_class, inner=app):
+    pipeline = inner
+    for _junk in range(FILTERS):
+        pipeline = filter_class(pipeline)
+    return pipeline
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def timed(pipeline, requests):
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/a/c/o'}
+    start = time.time()
+    for _junk in range(requests):
+        for _chunk in pipeline(env, start_response):
+            pass
+    return time.time() - start
+
+
+def main(requests):
+    bare = timed(app, requests)
+    print('%d requests through %d filters' % (requests, FILTERS))
+    for name, pipeline, inner_time in (
+            ('old', build(OldFilter, string_app),
+             timed(string_app, requests)),
+            ('pass-through', build(Middleware), bare),
+            ('rewrite', build(RewritingFilter), bare)):
+        elapsed = timed(pipeline, requests)
+        per_filter = (elapsed - inner_time) / requests / FILTERS * 1e9
+        print('%-14s %8.3fs  %7.1f ns/filter/request'
+              % (name, elapsed, per_filter))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,94 @@
+"""
+Measures what hedged reads and quorum writes do for the proxy's tail
+latency when one storage node is slow now and then.
+
+Three stand-in storage nodes (see stand_in_storage.py) answer in
+``latency`` seconds; the first replica's takes ``stall`` seconds every
+``stall_every`` requests instead. Object GETs are timed with
+``concurrent_gets`` off and then on, and PUTs waiting for every replica
+and then only for a quorum of them.
+
+Usage: python test/bench_proxy_backends.py [requests] [latency] [stall]
+"""
+import io
+import logging
+import os
+import sys
+import time
+
+import eventlet
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stand_in_storage import StandInStorage, serve  # noqa
+from swift.proxy.server import Application  # noqa
+
+BODY = b'x' * 4096
+CONCURRENCY = 8
+
+
+def call(app, method, path, body=b''):
+    env = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+           'SCRIPT_NAME': '', 'QUERY_STRING': '',
+           'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    status = []
+    app_iter = app(env, lambda s, h, exc_info=None: status.append(s))
+    for _chunk in app_iter:
+        pass
+    getattr(app_iter, 'close', lambda: None)()
+    return int(status[0][:3])
+
+
+def timed(name, app, method, requests, expect):
+    latencies = []
+
+    def one(i):
+        start = time.time()
+        status = call(app, method, '/v1/a/c/o%d' % (i % 100),
+                      BODY if method == 'PUT' else b'')
+        latencies.append(time.time() - start)
+        if status != expect:
+            raise AssertionError('%s: %d' % (name, status))
+    pool = eventlet.GreenPool(CONCURRENCY)
+    start = time.time()
+    for i in range(requests):
+        pool.spawn_n(one, i)
+    pool.waitall()
+    elapsed = time.time() - start
+    latencies.sort()
+    print('%-24s %7.0f req/s  p50 %7.2fms  p99 %7.2fms' % (
+        name, requests / elapsed, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def main(requests, latency, stall):
+    logging.basicConfig(level=logging.CRITICAL)
+    nodes = [StandInStorage(latency) for _ in range(3)]
+    backend_nodes = ','.join('127.0.0.1:%d/sda' % serve(node)
+                             for node in nodes)
+
+    def proxy(**conf):
+        conf.update(backend_nodes=backend_nodes, replicas='3')
+        return Application(dict((k, str(v)) for k, v in conf.items()))
+
+    setup = proxy()
+    for i in range(100):
+        call(setup, 'PUT', '/v1/a/c/o%d' % i, BODY)
+    nodes[0].stall_every = 20
+    nodes[0].stall = stall
+    print('%d requests, %d at a time; nodes answer in %gms, the first '
+          'replica in %gms one time in 20' % (requests, CONCURRENCY,
+                                              latency * 1000, stall * 1000))
+    timed('GET', proxy(concurrent_gets=False), 'GET', requests, 200)
+    timed('GET, hedged', proxy(concurrency_timeout=latency * 5), 'GET',
+          requests, 200)
+    timed('PUT, every replica', proxy(post_quorum_timeout=stall * 2),
+          'PUT', requests, 201)
+    timed('PUT, quorum', proxy(post_quorum_timeout=0), 'PUT', requests,
+          201)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.002,
+         float(sys.argv[3]) if len(sys.argv) > 3 else 0.1)
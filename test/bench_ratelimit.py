@@ -0,0 +1,50 @@
+"""
+Measures how many rate limit decisions one worker can make per second.
+
+Times SharedTokenBuckets.acquire() directly and through
+RateLimitMiddleware on a container PUT, spreading the requests over
+a number of distinct containers.
+
+Usage: python test/bench_ratelimit.py [decisions] [containers]
+"""
+import sys
+import time
+
+from swift.common.middleware.ratelimit import RateLimitMiddleware, \
+    SharedTokenBuckets
+
+
+def app(env, start_response):
+    start_response('201 Created', [('Content-Length', '0')])
+    return []
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def main(decisions, containers):
+    keys = ['ratelimit/AUTH_test/c%d' % i for i in range(containers)]
+    buckets = SharedTokenBuckets()
+    start = time.time()
+    for i in range(decisions):
+        # a rate high enough that no caller is ever asked to wait
+        buckets.acquire(keys[i % containers], 1e9, 1e9, 60)
+    elapsed = time.time() - start
+    print('acquire():       %10.0f decisions/s' % (decisions / elapsed))
+
+    middleware = RateLimitMiddleware(
+        app, {'container_ratelimit_0': '1000000000'}, buckets=buckets)
+    envs = [{'REQUEST_METHOD': 'PUT',
+             'PATH_INFO': '/v1/AUTH_test/c%d/o' % i}
+            for i in range(containers)]
+    start = time.time()
+    for i in range(decisions):
+        middleware(envs[i % containers], start_response)
+    elapsed = time.time() - start
+    print('middleware PUT:  %10.0f decisions/s' % (decisions / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
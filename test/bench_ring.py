@@ -0,0 +1,83 @@
+"""
+Measures ring loads and lookups for rings of millions of partitions.
+
+A ring of ``devices`` devices in 8 zones is built for each partition
+power, saved and loaded back: mapped, as the proxy loads it, and read into
+arrays, as it is where mapping is not possible. Then these are timed:
+
+* path lookups (``get_nodes``: hash, shift, an index per replica)
+* partition lookups (``get_part_nodes``)
+* taking the first two handoffs of a partition (``get_more_nodes``)
+
+Usage: python test/bench_ring.py [devices] [lookups]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from itertools import islice
+
+from swift.common.ring import Ring, build_ring
+
+
+def timed(name, count, func):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print('  %-26s %10.0f /s' % (name, count / elapsed))
+
+
+def main(devices, lookups):
+    swift_dir = tempfile.mkdtemp()
+    devs = [{'ip': '10.0.%d.%d' % (i % 8, i), 'port': 6200,
+             'device': 'sd%d' % i, 'zone': i % 8, 'weight': 100}
+            for i in range(devices)]
+    paths = [('AUTH_%d' % random.randint(0, 999), 'c%d' % i, 'o%d' % i)
+             for i in range(lookups)]
+    try:
+        for part_power in (20, 22):
+            start = time.time()
+            build_ring(devs, part_power, 3).save(
+                os.path.join(swift_dir, 'object.ring'))
+            built = time.time() - start
+            size = os.path.getsize(os.path.join(swift_dir, 'object.ring'))
+            start = time.time()
+            ring = Ring(swift_dir, 'object')
+            mapped = time.time() - start
+            start = time.time()
+            with open(ring.serialized_path, 'rb') as fp:
+                fp.seek(size - ring.replica_count * ring.partition_count * 2)
+                for _ in range(ring.replica_count):
+                    array('H').fromfile(fp, ring.partition_count)
+            copied = time.time() - start
+            print('%d partitions, 3 replicas, %d devices: built in %.2fs, '
+                  '%.1f MiB; loaded in %.1fms mapped, %.1fms copied' % (
+                      ring.partition_count, devices, built,
+                      size / 1048576.0, mapped * 1000, copied * 1000))
+
+            parts = [ring.get_part(*path) for path in paths]
+
+            def get_nodes():
+                for path in paths:
+                    ring.get_nodes(*path)
+
+            def get_part_nodes():
+                for part in parts:
+                    ring.get_part_nodes(part)
+
+            def get_handoffs():
+                for part in parts:
+                    list(islice(ring.get_more_nodes(part), 2))
+            timed('get_nodes', lookups, get_nodes)
+            timed('get_part_nodes', lookups, get_part_nodes)
+            timed('2 handoffs', lookups, get_handoffs)
+    finally:
+        shutil.rmtree(swift_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
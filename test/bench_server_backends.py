@@ -0,0 +1,171 @@
+"""
+Compares the eventlet and asyncio server backends on the example pipeline.
+
+Each backend serves etc/proxy-server.conf, with the pipeline commented in
+it and a test user, from one worker process, in front of one stand-in
+storage node (see stand_in_storage.py). Clients on keep-alive
+connections then GET an object as fast as it is answered; requests per
+second and the 50th and 99th percentile latencies are reported. The
+clients are eventlet green threads in this process, so the server and
+they have a core each.
+
+Usage: python test/bench_server_backends.py [requests] [concurrency]
+"""
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import eventlet
+from eventlet.green import socket as green_socket
+
+CONF = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'etc', 'proxy-server.conf')
+SERVE = ("import sys; from swift.common.wsgi import run_wsgi; "
+         "sys.exit(run_wsgi(sys.argv[1], 'proxy-server'))")
+STORAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'stand_in_storage.py')
+PATH = '/v1/AUTH_test/c/o'
+
+
+def write_conf(swift_dir, port, backend, storage_port):
+    with open(CONF) as fp:
+        conf = fp.read()
+    pipeline = re.search(r'^# (pipeline = .*)$', conf, re.M).group(1)
+    conf = re.sub(r'^pipeline = .*$', pipeline, conf, flags=re.M)
+    conf = re.sub(r'^bind_port = .*$',
+                  'bind_port = %d\nserver_backend = %s\nlog_level = ERROR'
+                  % (port, backend), conf, flags=re.M)
+    conf = conf.replace('# user_test_tester = ', 'user_test_tester = ')
+    conf = re.sub(r'^backend_nodes = .*$',
+                  'backend_nodes = 127.0.0.1:%d/sda' % storage_port, conf,
+                  flags=re.M)
+    conf = re.sub(r'^replicas = .*$', 'replicas = 1', conf, flags=re.M)
+    path = os.path.join(swift_dir, '%s.conf' % backend)
+    with open(path, 'w') as fp:
+        fp.write(conf)
+    return path
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def request(sock, buf, data):
+    """Sends a request and reads its response; returns (status, headers)."""
+    sock.sendall(data)
+    while b'\r\n\r\n' not in buf:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise IOError('Connection closed')
+        buf += chunk
+    head, _, rest = bytes(buf).partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = dict((k.lower(), v.strip()) for k, _, v in
+                   (line.partition(':') for line in lines[1:]))
+    length = int(headers.get('content-length', 0))
+    while len(rest) < length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise IOError('Connection closed')
+        rest += chunk
+    buf[:] = rest[length:]
+    return int(lines[0].split()[1]), headers
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            request(sock, bytearray(),
+                    b'GET /healthcheck HTTP/1.1\r\nHost: x\r\n\r\n')
+            sock.close()
+            return
+        except (IOError, OSError):
+            time.sleep(0.1)
+    raise AssertionError('Server on port %d did not start' % port)
+
+
+def client(port, count, req, latencies):
+    sock = green_socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buf = bytearray()
+    for _ in range(count):
+        start = time.time()
+        status, _ = request(sock, buf, req)
+        latencies.append(time.time() - start)
+        if status != 200:
+            raise AssertionError('GET %s: %d' % (PATH, status))
+    sock.close()
+
+
+def run(backend, swift_dir, storage_port, requests, concurrency):
+    port = free_port()
+    conf = write_conf(swift_dir, port, backend, storage_port)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-W', 'ignore', '-c',
+                                   SERVE, conf], stderr=devnull)
+    try:
+        wait_for(port)
+        sock = socket.create_connection(('127.0.0.1', port))
+        _, headers = request(sock, bytearray(),
+                             b'GET /auth/v1.0 HTTP/1.1\r\nHost: x\r\n'
+                             b'X-Auth-User: test:tester\r\n'
+                             b'X-Auth-Key: testing\r\n\r\n')
+        token = headers['x-auth-token']
+        status, _ = request(sock, bytearray(), (
+            'PUT %s HTTP/1.1\r\nHost: x\r\nX-Auth-Token: %s\r\n'
+            'Content-Length: 4096\r\n\r\n%s' % (PATH, token, 'x' * 4096)
+        ).encode('latin-1'))
+        sock.close()
+        if status != 201:
+            raise AssertionError('PUT %s: %d' % (PATH, status))
+        req = ('GET %s HTTP/1.1\r\nHost: x\r\nX-Auth-Token: %s\r\n\r\n'
+               % (PATH, token)).encode('latin-1')
+        # warm up
+        client(port, 100, req, [])
+        latencies = []
+        pool = eventlet.GreenPool(concurrency)
+        start = time.time()
+        for _ in range(concurrency):
+            pool.spawn(client, port, requests // concurrency, req, latencies)
+        pool.waitall()
+        elapsed = time.time() - start
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    latencies.sort()
+    print('%-9s %8.0f req/s  p50 %6.2fms  p99 %6.2fms' % (
+        backend, len(latencies) / elapsed,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def main(requests, concurrency):
+    swift_dir = tempfile.mkdtemp()
+    storage_port = free_port()
+    storage = subprocess.Popen([sys.executable, STORAGE, str(storage_port)])
+    try:
+        print('GET %s through the example pipeline, %d requests on %d '
+              'connections' % (PATH, requests, concurrency))
+        for backend in ('eventlet', 'asyncio'):
+            run(backend, swift_dir, storage_port, requests, concurrency)
+    finally:
+        storage.kill()
+        storage.wait()
+        shutil.rmtree(swift_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 32)
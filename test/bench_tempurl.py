@@ -0,0 +1,100 @@
+"""
+Measures temp URL validations per second on one core.
+
+Runs GETs signed with an account key through
+:class:`swift.common.middleware.tempurl.TempURL` in front of a trivial app,
+with the account info already in the pipeline cache, three ways:
+
+* ``uncached``: both of the middleware's caches sized to nothing, so the
+  keys come from memcache and every HMAC is rekeyed, on every request
+* ``distinct urls``: every request has a different expiry, so every
+  signature is checked, against the prebuilt HMAC objects
+* ``repeated url``: the same URL each time, as behind a CDN, answered from
+  the cache of signatures already checked
+
+Usage: python test/bench_tempurl.py [requests]
+"""
+import hashlib
+import hmac
+import sys
+import time
+
+from swift.common.middleware.tempurl import TempURL
+
+KEY = 'mykey'
+PATH = '/v1/AUTH_test/c/o'
+
+
+class DictCache(object):
+    """Stands in for memcache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, serialize=True, time=0):
+        self.data[key] = value
+
+
+def app(env, start_response):
+    start_response('200 OK', [('Content-Length', '0')])
+    return [b'']
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def sign(expires):
+    return hmac.new(KEY.encode('utf-8'), ('GET\n%d\n%s' % (
+        expires, PATH)).encode('utf-8'), hashlib.sha1).hexdigest()
+
+
+def make_cache():
+    cache = DictCache()
+    cache.set('account/AUTH_test', {'status': 204, 'meta': {
+        'temp-url-key': KEY}, 'sysmeta': {}})
+    cache.set('container/AUTH_test/c', {'status': 204, 'meta': {},
+                                        'sysmeta': {}})
+    return cache
+
+
+def run(tempurl, envs):
+    for env in envs:
+        for _chunk in tempurl(env, start_response):
+            pass
+
+
+def make_envs(requests, distinct, cache):
+    base = int(time.time()) + 3600
+    envs = []
+    for i in range(requests):
+        expires = base + (i if distinct else 0)
+        envs.append({
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': PATH,
+            'QUERY_STRING': 'temp_url_sig=%s&temp_url_expires=%d' % (
+                sign(expires), expires),
+            'swift.cache': cache})
+    return envs
+
+
+def main(requests):
+    print('%d temp URL GETs' % requests)
+    uncached = {'key_cache_size': '0', 'sig_cache_size': '0'}
+    for name, conf, distinct in (
+            ('uncached', uncached, True),
+            ('distinct urls', {}, True),
+            ('repeated url', {}, False)):
+        tempurl = TempURL(app, conf, ['GET'])
+        envs = make_envs(requests, distinct, make_cache())
+        start = time.time()
+        run(tempurl, envs)
+        elapsed = time.time() - start
+        print('%-14s %8.3fs  %9.0f validations/s'
+              % (name, elapsed, requests / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -1,15 +1,27 @@
+from optparse import OptionParser
 from os.path import isfile
 
 import sys
 from swift.common.utils import parse_options
-from swift.common.wsgi import run_wsgi
+from swift.common.wsgi import describe_pipeline, PipelineOrderError, \
+    run_wsgi
 
 pass  # (clac) print 'Number of arguments:', len(sys.argv), 'arguments.'
 pass  # (clac) print 'Argument List:', str(sys.argv)
 
 if __name__ == '__main__':
-    conf_file, options = parse_options()
+    parser = OptionParser(usage="%prog CONFIG [options]")
+    parser.add_option("--dry-run", default=False, action="store_true",
+                      help="print the resolved pipeline and exit")
+    conf_file, options = parse_options(parser=parser)
     conf = 'proxy-server.conf'
     if len(sys.argv) >= 2 and isfile(sys.argv[1]):
         conf = sys.argv[1]
+    if options['dry_run']:
+        try:
+            print(describe_pipeline(conf))
+        except PipelineOrderError as err:
+            print('Error: %s' % err)
+            sys.exit(1)
+        sys.exit(0)
     run_wsgi(conf, 'proxy-server')
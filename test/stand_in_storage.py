@@ -0,0 +1,93 @@
+"""
+A stand-in storage node for the benchmarks: answers the account, container
+and object requests the proxy sends, ``/<device>/<partition>/<path>``,
+from memory.
+
+Each request takes ``latency`` seconds; one in ``stall_every`` takes
+``stall`` seconds instead, as a node busy with compaction or a slow disk
+would.
+
+Usage: python test/stand_in_storage.py port [latency]
+"""
+import hashlib
+import itertools
+import os
+import sys
+
+import eventlet
+from eventlet import wsgi
+
+
+class StandInStorage(object):
+
+    def __init__(self, latency=0, stall_every=0, stall=0):
+        self.latency = latency
+        self.stall_every = stall_every
+        self.stall = stall
+        self.requests = itertools.count(1)
+        self.objects = {}
+        self.containers = set()
+
+    def __call__(self, env, start_response):
+        count = next(self.requests)
+        if self.stall_every and count % self.stall_every == 0:
+            eventlet.sleep(self.stall)
+        elif self.latency:
+            eventlet.sleep(self.latency)
+        method = env['REQUEST_METHOD']
+        path = env['PATH_INFO'].split('/', 3)[3]
+        depth = path.count('/')
+        if depth >= 2:
+            return self.object(env, start_response, method, path)
+        if method in ('PUT', 'POST'):
+            created = path not in self.containers
+            self.containers.add(path)
+            start_response('201 Created' if created else '202 Accepted',
+                           [('Content-Length', '0')])
+        elif path in self.containers or depth == 0:
+            # accounts are there as soon as they are asked for
+            if method == 'DELETE':
+                self.containers.discard(path)
+            start_response('204 No Content', [
+                ('X-Container-Object-Count', '0'),
+                ('X-Container-Bytes-Used', '0')])
+        else:
+            start_response('404 Not Found', [('Content-Length', '0')])
+        return [b'']
+
+    def object(self, env, start_response, method, path):
+        if method == 'PUT':
+            body = env['wsgi.input'].read()
+            etag = hashlib.md5(body).hexdigest()
+            self.objects[path] = (body, etag, env.get('HTTP_X_TIMESTAMP'))
+            start_response('201 Created', [('Content-Length', '0'),
+                                           ('Etag', etag)])
+            return [b'']
+        if path not in self.objects:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return [b'']
+        if method == 'DELETE':
+            del self.objects[path]
+            start_response('204 No Content', [])
+            return [b'']
+        body, etag, timestamp = self.objects[path]
+        start_response('200 OK', [
+            ('Content-Length', str(len(body))), ('Etag', etag),
+            ('X-Timestamp', timestamp or '0'),
+            ('Content-Type', 'application/octet-stream')])
+        return [b''] if method == 'HEAD' else [body]
+
+
+def serve(app, port=0):
+    """Serves ``app`` from a green thread; returns the port."""
+    sock = eventlet.listen(('127.0.0.1', port))
+    eventlet.spawn(wsgi.server, sock, app, log=open(os.devnull, 'w'),
+                   max_size=4096)
+    return sock.getsockname()[1]
+
+
+if __name__ == '__main__':
+    serve(StandInStorage(float(sys.argv[2]) if len(sys.argv) > 2 else 0),
+          int(sys.argv[1]))
+    while True:
+        eventlet.sleep(3600)
@@ -0,0 +1,248 @@
+"""
+Tests for swift.common.middleware.bulk in front of stub apps: archive
+extraction, and bulk deletes with their container retries.
+
+Usage: python -m unittest test.unit.common.middleware.test_bulk
+"""
+import io
+import json
+import tarfile
+import unittest
+
+import eventlet
+
+from swift.common.middleware import bulk
+
+
+class FakeApp(object):
+    """
+    Answers object PUTs with 201, or with ``statuses[path]`` when set,
+    taking ``latency`` seconds over each; containers are created on first
+    PUT. Remembers the most object PUTs it had in flight at once.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.statuses = {}
+        self.containers = set()
+        self.objects = {}
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def __call__(self, env, start_response):
+        method, path = env['REQUEST_METHOD'], env['PATH_INFO']
+        if path.count('/') == 3:
+            return self.container(method, path, start_response)
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            body = env['wsgi.input'].read(int(env['CONTENT_LENGTH']))
+            if self.latency:
+                eventlet.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        status = self.statuses.get(path, '201 Created')
+        if status.startswith('201'):
+            self.objects[path] = body
+        start_response(status, [('Content-Length', '0')])
+        return [b'']
+
+    def container(self, method, path, start_response):
+        if method == 'PUT':
+            self.containers.add(path)
+            status = '201 Created'
+        else:
+            status = '204 No Content' if path in self.containers \
+                else '404 Not Found'
+        start_response(status, [('Content-Length', '0')])
+        return [b'']
+
+
+class DeleteApp(object):
+    """
+    Answers each DELETE of ``path`` with the next of ``statuses[path]``,
+    the last one over and over, or 404 if there are none; remembers the
+    paths it was asked to delete, in order.
+    """
+
+    def __init__(self, statuses=None):
+        self.statuses = statuses or {}
+        self.deletes = []
+
+    def __call__(self, env, start_response):
+        path = env['PATH_INFO']
+        self.deletes.append(path)
+        statuses = self.statuses.get(path, ['404 Not Found'])
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        start_response(status, [('Content-Length', '0')])
+        return [b'']
+
+
+def make_tar(files, compress_type=''):
+    buf = io.BytesIO()
+    tar = tarfile.open(mode='w:' + compress_type, fileobj=buf)
+    for name, body in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(body)
+        tar.addfile(info, io.BytesIO(body))
+    tar.close()
+    return buf.getvalue()
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def make_bulk(self, app, **conf):
+        return bulk.filter_factory({}, **conf)(app)
+
+    def call(self, middleware, method, query, body):
+        env = {'REQUEST_METHOD': method, 'PATH_INFO': '/v1/AUTH_test',
+               'SCRIPT_NAME': '', 'QUERY_STRING': query,
+               'HTTP_ACCEPT': 'application/json',
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body)}
+        status = []
+        # a request that can't finish fails here rather than hanging
+        with eventlet.Timeout(10):
+            out = b''.join(middleware(
+                env, lambda s, h, exc_info=None: status.append(s)))
+        self.assertEqual(status, ['200 OK'])
+        return json.loads(out.decode('utf-8').strip())
+
+
+class TestExtractArchive(BulkTestCase):
+
+    def extract(self, middleware, tar_bytes, archive='tar'):
+        return self.call(middleware, 'PUT', 'extract-archive=' + archive,
+                         tar_bytes)
+
+    def test_one_failing_put(self):
+        app = FakeApp()
+        app.statuses['/v1/AUTH_test/c/bad'] = '503 Service Unavailable'
+        result = self.extract(self.make_bulk(app), make_tar([
+            ('c/ok1', b'one'), ('c/bad', b'bad'), ('c/ok2', b'two'),
+            ('d/ok3', b'three'), ('top_level_file', b'ignored')]))
+        self.assertEqual(result['Number Files Created'], 3)
+        self.assertEqual(result['Response Status'], '502 Bad Gateway')
+        self.assertEqual(result['Errors'],
+                         [['/v1/AUTH_test/c/bad', '503 Service Unavailable']])
+        self.assertEqual(sorted(app.objects), [
+            '/v1/AUTH_test/c/ok1', '/v1/AUTH_test/c/ok2',
+            '/v1/AUTH_test/d/ok3'])
+        self.assertEqual(app.objects['/v1/AUTH_test/d/ok3'], b'three')
+        self.assertEqual(app.containers,
+                         set(['/v1/AUTH_test/c', '/v1/AUTH_test/d']))
+
+    def test_client_error_on_a_put(self):
+        app = FakeApp()
+        app.statuses['/v1/AUTH_test/c/big'] = '413 Request Entity Too Large'
+        result = self.extract(self.make_bulk(app), make_tar([
+            ('c/ok', b'ok'), ('c/big', b'big')], 'gz'), 'tar.gz')
+        self.assertEqual(result['Number Files Created'], 1)
+        self.assertEqual(result['Response Status'], '400 Bad Request')
+        self.assertEqual(result['Errors'], [
+            ['/v1/AUTH_test/c/big', '413 Request Entity Too Large']])
+
+    def test_puts_in_flight_stay_within_concurrency(self):
+        app = FakeApp(latency=0.01)
+        files = [('c/o%02d' % i, b'x' * 10) for i in range(20)]
+        result = self.extract(self.make_bulk(app, extract_concurrency='3'),
+                              make_tar(files))
+        self.assertEqual(result['Number Files Created'], 20)
+        self.assertEqual(result['Response Status'], '201 Created')
+        self.assertEqual(app.most_in_flight, 3)
+
+    def test_big_files_are_put_one_at_a_time(self):
+        app = FakeApp(latency=0.01)
+        files = [('c/o%02d' % i, b'x' * 100) for i in range(5)]
+        result = self.extract(self.make_bulk(
+            app, extract_concurrency='3', extract_buffer_size='50'),
+            make_tar(files))
+        self.assertEqual(result['Number Files Created'], 5)
+        self.assertEqual(app.most_in_flight, 1)
+
+    def test_truncated_tar(self):
+        files = [('c/o1', b'x' * 2000), ('c/o2', b'y' * 2000)]
+        tar_bytes = make_tar(files)
+        # cut off in the middle of the second file's data
+        truncated = tar_bytes[:512 * 6 + 700]
+        for buffer_size in ('1048576', '100'):
+            app = FakeApp()
+            result = self.extract(self.make_bulk(
+                app, extract_buffer_size=buffer_size), truncated)
+            self.assertEqual(result['Response Status'], '400 Bad Request',
+                             buffer_size)
+            self.assertIn('Invalid Tar File', result['Response Body'])
+            self.assertNotIn('/v1/AUTH_test/c/o2', app.objects)
+
+    def test_not_a_tar(self):
+        result = self.extract(self.make_bulk(FakeApp()), b'x' * 1024)
+        self.assertEqual(result['Response Status'], '400 Bad Request')
+        self.assertIn('Invalid Tar File', result['Response Body'])
+
+
+class TestBulkDelete(BulkTestCase):
+
+    def delete(self, app, body, retry_count=0):
+        middleware = self.make_bulk(
+            app, delete_container_retry_count=str(retry_count))
+        middleware.retry_interval = 0.01
+        return self.call(middleware, 'POST', 'bulk-delete', body)
+
+    def test_container_conflict_is_retried(self):
+        app = DeleteApp({'/v1/AUTH_test/c': ['409 Conflict',
+                                             '204 No Content']})
+        result = self.delete(app, b'/c/o1\n/c/o2\n/c\n', retry_count=2)
+        self.assertEqual(sorted(app.deletes[:2]),
+                         ['/v1/AUTH_test/c/o1', '/v1/AUTH_test/c/o2'])
+        # tried again once the 409 came back, then no more
+        self.assertEqual(app.deletes[2:],
+                         ['/v1/AUTH_test/c', '/v1/AUTH_test/c'])
+        self.assertEqual(result['Response Status'], '200 OK')
+        self.assertEqual(result['Number Deleted'], 1)
+        self.assertEqual(result['Number Not Found'], 2)
+        self.assertEqual(result['Errors'], [])
+
+    def test_conflict_after_the_last_retry_is_reported(self):
+        app = DeleteApp({'/v1/AUTH_test/c': ['409 Conflict']})
+        result = self.delete(app, b'/c\n/c/o1\n', retry_count=2)
+        self.assertEqual(app.deletes, ['/v1/AUTH_test/c/o1'] +
+                         ['/v1/AUTH_test/c'] * 3)
+        self.assertEqual(result['Response Status'], '400 Bad Request')
+        self.assertEqual(result['Number Deleted'], 0)
+        self.assertEqual(result['Number Not Found'], 1)
+        self.assertEqual(result['Errors'],
+                         [['/v1/AUTH_test/c', '409 Conflict']])
+
+    def test_conflict_is_not_retried_by_default(self):
+        app = DeleteApp({'/v1/AUTH_test/c': ['409 Conflict',
+                                             '204 No Content']})
+        result = self.delete(app, b'/c\n')
+        self.assertEqual(app.deletes, ['/v1/AUTH_test/c'])
+        self.assertEqual(result['Errors'],
+                         [['/v1/AUTH_test/c', '409 Conflict']])
+
+    def test_per_item_report(self):
+        app = DeleteApp({
+            '/v1/AUTH_test/c/gone': ['204 No Content'],
+            '/v1/AUTH_test/c/busy': ['503 Service Unavailable'],
+            '/v1/AUTH_test/d': ['204 No Content']})
+        result = self.delete(
+            app, b'/c/gone\n/c/missing\n/c/busy\n/d\n/d\n\n')
+        # a container listed twice is deleted once
+        self.assertEqual(app.deletes.count('/v1/AUTH_test/d'), 1)
+        self.assertEqual(result['Response Status'], '502 Bad Gateway')
+        self.assertEqual(result['Number Deleted'], 2)
+        self.assertEqual(result['Number Not Found'], 1)
+        self.assertEqual(result['Errors'], [
+            ['/v1/AUTH_test/c/busy', '503 Service Unavailable']])
+
+    def test_unauthorized_stops_before_the_containers(self):
+        app = DeleteApp({'/v1/AUTH_test/c/o': ['401 Unauthorized'],
+                         '/v1/AUTH_test/c': ['204 No Content']})
+        result = self.delete(app, b'/c/o\n/c\n')
+        self.assertEqual(app.deletes, ['/v1/AUTH_test/c/o'])
+        self.assertEqual(result['Response Status'], '401 Unauthorized')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+Tests for swift.common.middleware.dlo in front of a stub cluster: how much
+of a segment listing longer than a page is read for a Range, a HEAD and a
+plain GET.
+
+Usage: python -m unittest test.unit.common.middleware.test_dlo
+"""
+import io
+import json
+import unittest
+from hashlib import md5
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+from swift.common.middleware.dlo import DynamicLargeObject, bounded_range
+
+MANIFEST = '/v1/AUTH_test/c/manifest'
+SEGMENTS = [(('seg_%02d' % i), (chr(ord('a') + i) * 10).encode('ascii'))
+            for i in range(10)]
+BODY = b''.join(body for _name, body in SEGMENTS)
+
+
+class FakeCluster(object):
+    """
+    Serves a manifest whose segments are SEGMENTS in container ``segs``,
+    and remembers the listing requests it gets.
+    """
+
+    def __init__(self):
+        self.objects = dict(('/v1/AUTH_test/segs/' + name, body)
+                            for name, body in SEGMENTS)
+        self.listings = []
+
+    def __call__(self, env, start_response):
+        path = env['PATH_INFO']
+        if path == MANIFEST:
+            start_response('200 OK', [('Content-Length', '0'),
+                                      ('X-Object-Manifest', 'segs/seg_')])
+            return [b'']
+        if path == '/v1/AUTH_test/segs':
+            query = dict((k, v[0]) for k, v in
+                         parse_qs(env['QUERY_STRING']).items())
+            self.listings.append(query.get('marker', ''))
+            names = sorted(name for name, _body in SEGMENTS
+                           if name > query.get('marker', ''))
+            page = [{'name': name, 'bytes': 10,
+                     'hash': md5(dict(SEGMENTS)[name]).hexdigest()}
+                    for name in names[:int(query['limit'])]]
+            body = json.dumps(page).encode('ascii')
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+        body = self.objects[path]
+        headers = [('Etag', md5(body).hexdigest())]
+        status = '200 OK'
+        if env.get('HTTP_RANGE'):
+            first, last = bounded_range(env['HTTP_RANGE'])
+            body = body[first:last + 1]
+            status = '206 Partial Content'
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+
+class TestDynamicLargeObject(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.dlo = DynamicLargeObject(self.cluster, {
+            'listing_page_size': '3'})
+
+    def call(self, method='GET', **env):
+        env.update({'REQUEST_METHOD': method, 'PATH_INFO': MANIFEST,
+                    'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                    'wsgi.input': io.BytesIO()})
+        captured = []
+        body = b''.join(self.dlo(env, lambda s, h, exc_info=None:
+                                 captured.extend([s, dict(h)])))
+        return captured[0], captured[1], body
+
+    def test_range_lists_only_what_it_covers(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=25-44')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(body, BODY[25:45])
+        self.assertEqual(headers['Content-Range'], 'bytes 25-44/*')
+        self.assertEqual(headers['Content-Length'], '20')
+        # bytes 0-29 are on the first page, 30-59 on the second
+        self.assertEqual(self.cluster.listings, ['', 'seg_02'])
+        # a partial listing is not kept
+        self.call(HTTP_RANGE='bytes=25-44')
+        self.assertEqual(len(self.cluster.listings), 4)
+
+    def test_range_past_the_listing_reads_it_all(self):
+        status, headers, _body = self.call(HTTP_RANGE='bytes=200-210')
+        self.assertEqual(status, '416 Requested Range Not Satisfiable')
+        self.assertEqual(headers['Content-Range'], 'bytes */100')
+        self.assertEqual(len(self.cluster.listings), 4)
+
+    def test_range_ending_past_the_listing_is_cut_short(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=95-200')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(body, BODY[95:])
+        self.assertEqual(headers['Content-Range'], 'bytes 95-99/100')
+
+    def test_suffix_range_reads_the_whole_listing(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=-15')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(body, BODY[-15:])
+        self.assertEqual(headers['Content-Range'], 'bytes 85-99/100')
+        self.assertEqual(len(self.cluster.listings), 4)
+
+    def test_open_ended_range_reads_the_whole_listing(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=5-')
+        self.assertEqual(body, BODY[5:])
+        self.assertEqual(headers['Content-Range'], 'bytes 5-99/100')
+
+    def test_head_reads_the_whole_listing(self):
+        status, headers, body = self.call('HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Length'], '100')
+        self.assertEqual(body, b'')
+        self.assertEqual(len(self.cluster.listings), 4)
+
+    def test_get_streams_then_caches_the_listing(self):
+        status, headers, body = self.call()
+        self.assertEqual((status, body), ('200 OK', BODY))
+        self.assertNotIn('Content-Length', headers)
+        # the second is served from the cached listing
+        status, headers, body = self.call(HTTP_RANGE='bytes=25-44')
+        self.assertEqual(body, BODY[25:45])
+        self.assertEqual(headers['Content-Range'], 'bytes 25-44/100')
+        self.assertEqual(len(self.cluster.listings), 4)
+
+
+class TestBoundedRange(unittest.TestCase):
+
+    def test_bounded_range(self):
+        self.assertEqual(bounded_range('bytes=3-7'), (3, 7))
+        self.assertEqual(bounded_range('bytes = 3 - 7'), (3, 7))
+        self.assertIsNone(bounded_range('bytes=3-'))
+        self.assertIsNone(bounded_range('bytes=-7'))
+        self.assertIsNone(bounded_range('bytes=7-3'))
+        self.assertIsNone(bounded_range('bytes=1-2,5-6'))
+        self.assertIsNone(bounded_range(''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+"""
+Tests for the account_quotas and container_quotas middlewares and the
+per-worker usage estimate they share
+(:class:`swift.common.request_helpers.UsageTracker`), in front of a stub
+backend that counts the HEADs it gets.
+
+Usage: python -m unittest test.unit.common.middleware.test_quotas
+"""
+import io
+import time
+import unittest
+
+from swift.common.middleware.account_quotas import AccountQuotaMiddleware
+from swift.common.middleware.container_quotas import \
+    ContainerQuotaMiddleware
+
+ACCOUNT = '/v1/AUTH_test'
+CONTAINER = ACCOUNT + '/c'
+
+
+class FakeBackend(object):
+    """
+    Holds objects, by path, and the metadata of the account and its
+    containers; a HEAD reports the bytes and objects under its path.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.meta = {ACCOUNT: {}, CONTAINER: {}}
+        self.heads = 0
+        self.puts = 0
+
+    def __call__(self, env, start_response):
+        method, path = env['REQUEST_METHOD'], env['PATH_INFO']
+        headers = [('Content-Length', '0')]
+        if method == 'HEAD':
+            self.heads += 1
+            server_type = 'Account' if path == ACCOUNT else 'Container'
+            sizes = [size for name, size in self.objects.items()
+                     if name.startswith(path + '/')]
+            headers.extend([
+                ('X-%s-Bytes-Used' % server_type, str(sum(sizes))),
+                ('X-%s-Object-Count' % server_type, str(len(sizes)))])
+            headers.extend(('X-%s-Meta-%s' % (server_type, name), value)
+                           for name, value in self.meta[path].items())
+            status = '204 No Content'
+        elif method == 'PUT':
+            self.puts += 1
+            self.objects[path] = len(env['wsgi.input'].read(
+                int(env.get('CONTENT_LENGTH') or 0)))
+            status = '201 Created'
+        elif method == 'DELETE':
+            status = '204 No Content' if self.objects.pop(path, None) \
+                is not None else '404 Not Found'
+        else:
+            status = '204 No Content'
+        start_response(status, headers)
+        return [b'']
+
+
+class FakeMemcache(object):
+    """Keeps what it is given, ignoring expiry."""
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, time=0):
+        self.store[key] = value
+
+
+def call(app, method, path, body=b'', **env):
+    env.update({'REQUEST_METHOD': method, 'PATH_INFO': path,
+                'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': io.BytesIO(body)})
+    status = []
+    b''.join(app(env, lambda s, h, exc_info=None: status.append(s)))
+    return int(status[0][:3])
+
+
+class QuotaTestCase(unittest.TestCase):
+
+    conf = {}
+
+    def setUp(self):
+        self.backend = FakeBackend()
+
+    def put(self, name, nbytes):
+        return call(self.app, 'PUT', '%s/%s' % (CONTAINER, name),
+                    b'x' * nbytes)
+
+
+class TestContainerQuotas(QuotaTestCase):
+
+    def make_app(self, **conf):
+        self.app = ContainerQuotaMiddleware(self.backend, conf)
+
+    def test_one_head_per_reconcile_interval(self):
+        self.backend.meta[CONTAINER]['Quota-Count'] = '1000'
+        self.make_app(quota_reconcile_interval='0.3')
+        for index in range(10):
+            self.assertEqual(self.put('o%d' % index, 10), 201)
+        self.assertEqual(self.backend.heads, 1)
+        time.sleep(0.35)
+        for index in range(10, 20):
+            self.assertEqual(self.put('o%d' % index, 10), 201)
+        self.assertEqual(self.backend.heads, 2)
+        self.assertEqual(self.backend.puts, 20)
+
+    def test_info_from_memcache_is_reconciled_once(self):
+        self.backend.meta[CONTAINER]['Quota-Bytes'] = '1000'
+        self.make_app()
+        memcache = FakeMemcache()
+        self.assertEqual(self.put('o1', 10), 201)
+        # another worker has cached the container's info
+        memcache.store['container/AUTH_test/c'] = \
+            self.app.usage.get({}, 'AUTH_test', 'c').info
+        self.app = ContainerQuotaMiddleware(self.backend, {})
+        for index in range(2, 5):
+            self.assertEqual(call(self.app, 'PUT', CONTAINER + '/o%d' % index,
+                                  b'x', **{'swift.cache': memcache}), 201)
+        self.assertEqual(self.backend.heads, 2)
+
+    def test_reconciled_once_slack_bytes_is_exceeded(self):
+        self.backend.meta[CONTAINER]['Quota-Bytes'] = '1000'
+        self.make_app(quota_slack_bytes='100')
+        self.assertEqual(self.put('o1', 40), 201)
+        self.assertEqual(self.put('o2', 40), 201)
+        self.assertEqual(self.backend.heads, 1)
+        # 40 + 40 + 40 added since the last reconcile is over the slack
+        self.assertEqual(self.put('o3', 40), 201)
+        self.assertEqual(self.backend.heads, 2)
+        self.assertEqual(self.put('o4', 40), 201)
+        self.assertEqual(self.backend.heads, 2)
+
+    def test_reconciled_once_slack_count_is_exceeded(self):
+        self.backend.meta[CONTAINER]['Quota-Count'] = '1000'
+        self.make_app(quota_slack_count='2')
+        for index in range(5):
+            self.put('o%d' % index, 1)
+        self.assertEqual(self.backend.heads, 3)
+
+    def test_bytes_quota_boundary(self):
+        self.backend.meta[CONTAINER]['Quota-Bytes'] = '100'
+        self.backend.objects[CONTAINER + '/old'] = 60
+        self.make_app()
+        self.assertEqual(self.put('o1', 30), 201)
+        # exactly at the quota still goes in, one byte past it does not
+        self.assertEqual(self.put('o2', 10), 201)
+        self.assertEqual(self.put('o3', 1), 413)
+        self.assertNotIn(CONTAINER + '/o3', self.backend.objects)
+        self.assertEqual(self.backend.heads, 1)
+
+    def test_count_quota_and_delete(self):
+        self.backend.meta[CONTAINER]['Quota-Count'] = '2'
+        self.make_app()
+        self.assertEqual(self.put('o1', 1), 201)
+        self.assertEqual(self.put('o2', 1), 201)
+        self.assertEqual(self.put('o3', 1), 413)
+        self.assertEqual(call(self.app, 'DELETE', CONTAINER + '/o1'), 204)
+        # the delete is counted, so there is room again without a HEAD
+        self.assertEqual(self.put('o3', 1), 201)
+        self.assertEqual(self.backend.heads, 1)
+        # a delete that found nothing frees nothing
+        self.assertEqual(call(self.app, 'DELETE', CONTAINER + '/nope'), 404)
+        self.assertEqual(self.put('o4', 1), 413)
+
+    def test_setting_a_quota_is_seen_at_once(self):
+        self.make_app()
+        self.assertEqual(self.put('o1', 10), 201)
+        self.backend.meta[CONTAINER]['Quota-Bytes'] = '10'
+        self.assertEqual(call(self.app, 'POST', CONTAINER,
+                              HTTP_X_CONTAINER_META_QUOTA_BYTES='10'), 204)
+        self.assertEqual(self.put('o2', 1), 413)
+
+    def test_invalid_quota(self):
+        self.make_app()
+        self.assertEqual(call(self.app, 'POST', CONTAINER,
+                              HTTP_X_CONTAINER_META_QUOTA_COUNT='many'),
+                         400)
+
+
+class TestAccountQuotas(QuotaTestCase):
+
+    def setUp(self):
+        super(TestAccountQuotas, self).setUp()
+        self.app = AccountQuotaMiddleware(self.backend, {})
+
+    def test_bytes_quota_boundary(self):
+        self.backend.meta[ACCOUNT]['Quota-Bytes'] = '50'
+        self.assertEqual(self.put('o1', 50), 201)
+        self.assertEqual(self.put('o2', 1), 413)
+        self.assertEqual(self.backend.heads, 1)
+
+    def test_delete_is_let_through(self):
+        self.backend.meta[ACCOUNT]['Quota-Bytes'] = '50'
+        self.assertEqual(self.put('o1', 50), 201)
+        self.assertEqual(call(self.app, 'DELETE', CONTAINER + '/o1'), 204)
+        # the bytes freed are only known once reconciled
+        self.assertEqual(self.put('o2', 1), 413)
+
+    def test_no_quota(self):
+        self.assertEqual(self.put('o1', 50), 201)
+        self.assertEqual(self.backend.heads, 1)
+
+    def test_non_reseller_cannot_set_a_quota(self):
+        for header in ('HTTP_X_ACCOUNT_META_QUOTA_BYTES',
+                       'HTTP_X_REMOVE_ACCOUNT_META_QUOTA_BYTES'):
+            self.assertEqual(call(self.app, 'POST', ACCOUNT,
+                                  **{header: '100'}), 403)
+        self.assertEqual(call(self.app, 'POST', ACCOUNT,
+                              HTTP_X_ACCOUNT_META_QUOTA_BYTES='100',
+                              reseller_request=True), 204)
+        self.assertEqual(call(self.app, 'POST', ACCOUNT,
+                              HTTP_X_ACCOUNT_META_QUOTA_BYTES='lots',
+                              reseller_request=True), 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
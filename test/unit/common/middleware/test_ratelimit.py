@@ -0,0 +1,97 @@
+"""
+Tests for the token buckets swift.common.middleware.ratelimit shares
+between the workers of a node.
+
+Usage: python -m unittest test.unit.common.middleware.test_ratelimit
+"""
+import fcntl
+import os
+import signal
+import unittest
+
+from swift.common.middleware.ratelimit import LOCK_STRIPES, \
+    MaxSleepTimeHitError, SharedTokenBuckets
+
+
+class TestSharedTokenBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.buckets = SharedTokenBuckets(1024)
+        # a test that hangs on a lock fails instead
+        self.addCleanup(signal.signal, signal.SIGALRM,
+                        signal.getsignal(signal.SIGALRM))
+        signal.signal(signal.SIGALRM, self.timed_out)
+        self.addCleanup(signal.alarm, 0)
+        signal.alarm(10)
+
+    @staticmethod
+    def timed_out(signum, frame):
+        raise AssertionError('timed out waiting for a lock')
+
+    def in_child(self, func):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                func()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def test_burst_then_wait(self):
+        for _junk in range(3):
+            self.assertEqual(self.buckets.acquire('k', 10, 3, 1, now=100),
+                             0)
+        self.assertAlmostEqual(self.buckets.acquire('k', 10, 3, 1, now=100),
+                               0.1)
+        # refilled as time goes by
+        self.assertEqual(self.buckets.acquire('k', 10, 3, 1, now=101), 0)
+
+    def test_max_sleep_takes_no_token(self):
+        self.buckets.acquire('k', 1, 1, 0, now=100)
+        for _junk in range(2):
+            self.assertRaises(MaxSleepTimeHitError, self.buckets.acquire,
+                              'k', 1, 1, 0.5, now=100)
+        self.assertEqual(self.buckets.acquire('k', 1, 1, 0.5, now=101), 0)
+
+    def test_shared_with_forked_workers(self):
+        self.in_child(lambda: self.buckets.acquire('k', 1, 1, 0, now=100))
+        self.assertRaises(MaxSleepTimeHitError, self.buckets.acquire,
+                          'k', 1, 1, 0, now=100)
+
+    def test_worker_dying_with_a_lock_held(self):
+        def die_holding_every_stripe():
+            for stripe in range(LOCK_STRIPES):
+                self.buckets._lock(stripe, fcntl.LOCK_EX)
+            os.kill(os.getpid(), signal.SIGKILL)
+        self.in_child(die_holding_every_stripe)
+        self.assertEqual(self.buckets.acquire('k', 1, 1, 0, now=100), 0)
+
+    def test_lock_held_by_another_worker_is_waited_for(self):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            for stripe in range(LOCK_STRIPES):
+                self.buckets._lock(stripe, fcntl.LOCK_EX)
+            os.write(write, b'x')
+            # until SIGTERM, which releases them
+            signal.pause()
+            os._exit(0)
+        os.close(write)
+        os.read(read, 1)
+        os.close(read)
+        self.addCleanup(os.waitpid, pid, 0)
+        self.assertRaises(AssertionError, self._acquire_within, 0.5)
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(self._acquire_within(5), 0)
+
+    def _acquire_within(self, seconds):
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            return self.buckets.acquire('k', 1, 1, 0, now=100)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+"""
+Tests for swift.common.middleware.slo in front of a stub cluster, and for
+the request_helpers it streams a large object with: mapping a Range onto
+the segments, checking each segment's ETag and keeping the segments read
+ahead within their byte budget.
+
+Usage: python -m unittest test.unit.common.middleware.test_slo
+"""
+import io
+import json
+import unittest
+from hashlib import md5
+
+import eventlet
+
+from swift.common.middleware.slo import StaticLargeObject, parse_manifest
+from swift.common.request_helpers import RANGE_RE, SegmentError, \
+    SegmentedIterable, parse_range, segment_byte_ranges
+
+MANIFEST = '/v1/AUTH_test/c/manifest'
+
+
+def segment(name, body):
+    return {'name': '/segs/' + name, 'bytes': len(body),
+            'hash': md5(body).hexdigest()}
+
+
+class FakeCluster(object):
+    """
+    Serves objects from ``objects``, path -> body, honouring a Range with
+    both ends given, in chunks of ``chunk_size``; remembers every GET.
+    """
+
+    def __init__(self, chunk_size=4):
+        self.objects = {}
+        self.etags = {}
+        self.manifests = set()
+        self.chunk_size = chunk_size
+        self.gets = []
+
+    def store(self, path, body, manifest=False):
+        self.objects[path] = body
+        self.etags[path] = md5(body).hexdigest()
+        if manifest:
+            self.manifests.add(path)
+
+    def __call__(self, env, start_response):
+        path = env['PATH_INFO']
+        if env['REQUEST_METHOD'] == 'GET':
+            self.gets.append((path, env.get('HTTP_RANGE')))
+        body = self.objects[path]
+        headers = [('Etag', '"%s"' % self.etags[path])]
+        if path in self.manifests:
+            headers.append(('X-Static-Large-Object', 'True'))
+        status = '200 OK'
+        if env.get('HTTP_RANGE') and path not in self.manifests:
+            first, last = RANGE_RE.match(env['HTTP_RANGE']).groups()
+            body = body[int(first):int(last) + 1]
+            status = '206 Partial Content'
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        if env['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
+        return [body[i:i + self.chunk_size]
+                for i in range(0, len(body), self.chunk_size)] or [b'']
+
+
+class TestParseRange(unittest.TestCase):
+
+    def test_closed(self):
+        self.assertEqual(parse_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(parse_range('bytes=2-50', 10), (2, 9))
+
+    def test_open_ended(self):
+        self.assertEqual(parse_range('bytes=4-', 10), (4, 9))
+        self.assertIs(parse_range('bytes=10-', 10), False)
+
+    def test_suffix(self):
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=-30', 10), (0, 9))
+        self.assertIs(parse_range('bytes=-0', 10), False)
+        self.assertIs(parse_range('bytes=-3', 0), False)
+
+    def test_ignored(self):
+        for header in ('bytes=5-2', 'bytes=1-2,4-5', 'bytes=-', 'items=1-2'):
+            self.assertIsNone(parse_range(header, 10), header)
+
+
+class TestSegmentByteRanges(unittest.TestCase):
+
+    def ranges(self, sizes, first, last):
+        segments = [{'name': '/segs/%d' % i, 'bytes': size, 'hash': str(i)}
+                    for i, size in enumerate(sizes)]
+        manifest = parse_manifest(json.dumps(segments))
+        return [(path, seg_first, seg_last)
+                for path, seg_first, seg_last, _size, _etag in
+                segment_byte_ranges(manifest.segments, manifest.starts,
+                                    first, last, '/v1/a')]
+
+    def test_within_a_segment(self):
+        self.assertEqual(self.ranges([10, 10, 10], 12, 15),
+                         [('/v1/a/segs/1', 2, 5)])
+
+    def test_crossing_segment_boundaries(self):
+        self.assertEqual(self.ranges([10, 10, 10], 8, 21),
+                         [('/v1/a/segs/0', 8, 9), ('/v1/a/segs/1', 0, 9),
+                          ('/v1/a/segs/2', 0, 1)])
+
+    def test_on_segment_boundaries(self):
+        self.assertEqual(self.ranges([10, 10, 10], 10, 19),
+                         [('/v1/a/segs/1', 0, 9)])
+
+    def test_zero_byte_segments_are_skipped(self):
+        self.assertEqual(self.ranges([0, 10, 0, 0, 10, 0], 0, 19),
+                         [('/v1/a/segs/1', 0, 9), ('/v1/a/segs/4', 0, 9)])
+        self.assertEqual(self.ranges([10, 0, 10], 10, 12),
+                         [('/v1/a/segs/2', 0, 2)])
+
+
+class TestStaticLargeObject(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = FakeCluster()
+        self.bodies = [b'a' * 10, b'', b'b' * 10, b'c' * 10]
+        segments = []
+        for index, body in enumerate(self.bodies):
+            segments.append(segment('s%d' % index, body))
+            self.cluster.store('/v1/AUTH_test' + segments[-1]['name'], body)
+        self.cluster.store(MANIFEST, json.dumps(segments).encode('ascii'),
+                           manifest=True)
+        self.body = b''.join(self.bodies)
+        self.slo = StaticLargeObject(self.cluster, {'prefetch_segments': '2'})
+
+    def call(self, method='GET', **env):
+        env.update({'REQUEST_METHOD': method, 'PATH_INFO': MANIFEST,
+                    'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                    'wsgi.input': io.BytesIO()})
+        captured = []
+        body = b''.join(self.slo(env, lambda s, h, exc_info=None:
+                                 captured.extend([s, dict(h)])))
+        return captured[0], captured[1], body
+
+    def segment_gets(self):
+        return [get for get in self.cluster.gets if get[0] != MANIFEST]
+
+    def test_whole_object(self):
+        status, headers, body = self.call()
+        self.assertEqual((status, body), ('200 OK', self.body))
+        self.assertEqual(headers['Content-Length'], '30')
+        # the zero-byte segment is never fetched
+        self.assertEqual(self.segment_gets(), [
+            ('/v1/AUTH_test/segs/s0', None), ('/v1/AUTH_test/segs/s2', None),
+            ('/v1/AUTH_test/segs/s3', None)])
+
+    def test_range_crossing_segments(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=8-21')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(body, self.body[8:22])
+        self.assertEqual(headers['Content-Range'], 'bytes 8-21/30')
+        self.assertEqual(headers['Content-Length'], '14')
+        self.assertEqual(self.segment_gets(), [
+            ('/v1/AUTH_test/segs/s0', 'bytes=8-9'),
+            ('/v1/AUTH_test/segs/s2', None),
+            ('/v1/AUTH_test/segs/s3', 'bytes=0-1')])
+
+    def test_suffix_range(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=-15')
+        self.assertEqual(body, self.body[-15:])
+        self.assertEqual(headers['Content-Range'], 'bytes 15-29/30')
+        self.assertEqual(self.segment_gets(), [
+            ('/v1/AUTH_test/segs/s2', 'bytes=5-9'),
+            ('/v1/AUTH_test/segs/s3', None)])
+
+    def test_open_ended_range(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=10-')
+        self.assertEqual(body, self.body[10:])
+        self.assertEqual(headers['Content-Range'], 'bytes 10-29/30')
+        self.assertEqual(self.segment_gets(), [
+            ('/v1/AUTH_test/segs/s2', None), ('/v1/AUTH_test/segs/s3', None)])
+
+    def test_unsatisfiable_range(self):
+        status, headers, body = self.call(HTTP_RANGE='bytes=30-')
+        self.assertEqual(status, '416 Requested Range Not Satisfiable')
+        self.assertEqual(headers['Content-Range'], 'bytes */30')
+        self.assertEqual(self.segment_gets(), [])
+
+    def test_head_fetches_no_segment(self):
+        status, _headers, body = self.call('HEAD')
+        self.assertEqual((status, body), ('200 OK', b''))
+        self.assertEqual(self.cluster.gets, [])
+
+    def test_segment_etag_mismatch(self):
+        self.cluster.store('/v1/AUTH_test/segs/s2', b'x' * 10)
+        env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': MANIFEST,
+               'SCRIPT_NAME': '', 'QUERY_STRING': '',
+               'wsgi.input': io.BytesIO()}
+        app_iter = iter(self.slo(env, lambda *args: None))
+        # the segments before it are sent, then the response is cut short
+        self.assertEqual(b''.join(next(app_iter) for _junk in range(3)),
+                         b'a' * 10)
+        with self.assertRaises(SegmentError) as caught:
+            next(app_iter)
+        self.assertIn('etag', str(caught.exception))
+        self.assertIn('/v1/AUTH_test/segs/s2', str(caught.exception))
+
+    def test_etag_of_a_partly_fetched_segment_is_not_checked(self):
+        self.cluster.store('/v1/AUTH_test/segs/s2', b'x' * 10)
+        _status, _headers, body = self.call(HTTP_RANGE='bytes=12-14')
+        self.assertEqual(body, b'xxx')
+
+
+class TestReadAheadWindow(unittest.TestCase):
+
+    def stream(self, sizes, prefetch, window_size, chunk_size=4):
+        cluster = FakeCluster(chunk_size)
+        ranges = []
+        for index, size in enumerate(sizes):
+            path = '/v1/a/segs/%d' % index
+            cluster.store(path, (chr(ord('a') + index) * size).encode())
+            ranges.append((path, 0, size - 1, size, cluster.etags[path]))
+        it = SegmentedIterable({}, cluster, iter(ranges), prefetch,
+                               window_size, 'SLO')
+        peak = [0]
+        self.most_in_flight = 0
+        acquire = it.window.acquire
+
+        def counting_acquire(fetch, nbytes):
+            counted = acquire(fetch, nbytes)
+            peak[0] = max(peak[0], it.window.used)
+            return counted
+        it.window.acquire = counting_acquire
+        body = []
+        for chunk in it:
+            body.append(chunk)
+            self.most_in_flight = max(self.most_in_flight, len(it.fetches))
+            # a slow client: the fetchers get to run between chunks
+            for _junk in range(5):
+                eventlet.sleep(0)
+        self.assertEqual(b''.join(body), b''.join(
+            cluster.objects[path] for path, _f, _l, _s, _e in ranges))
+        self.assertEqual(it.window.used, 0)
+        return peak[0], cluster
+
+    def test_read_ahead_stays_within_its_budget(self):
+        peak, _cluster = self.stream([40] * 6, prefetch=4, window_size=12)
+        self.assertGreater(peak, 0)
+        self.assertLessEqual(peak, 12)
+
+    def test_chunk_bigger_than_the_window_still_goes_ahead(self):
+        # an empty window takes any chunk, so read-ahead never stalls
+        peak, _cluster = self.stream([40] * 3, prefetch=2, window_size=4,
+                                     chunk_size=8)
+        self.assertEqual(peak, 8)
+
+    def test_prefetch_bounds_segments_in_flight(self):
+        _peak, cluster = self.stream([8] * 6, prefetch=2,
+                                     window_size=1 << 20)
+        # the one being sent and the two after it
+        self.assertEqual(self.most_in_flight, 3)
+        self.assertEqual(len(cluster.gets), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Tests for swift.common.middleware.tempauth: tokens issued through memcache
+and validated by other workers, and the per-worker caches of good and bad
+tokens.
+
+Usage: python -m unittest test.unit.common.middleware.test_tempauth
+"""
+import io
+import time
+import unittest
+
+from swift.common.middleware.tempauth import TempAuth
+
+PATH = '/v1/AUTH_test/c/o'
+
+
+class FakeMemcache(object):
+    """Keeps what it is given, ignoring expiry; counts the gets."""
+
+    def __init__(self):
+        self.store = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.store.get(key)
+
+    def set(self, key, value, time=0):
+        self.store[key] = value
+
+
+class FakeApp(object):
+
+    def __init__(self):
+        self.users = []
+
+    def __call__(self, env, start_response):
+        self.users.append(env.get('REMOTE_USER'))
+        start_response('200 OK', [('Content-Length', '0')])
+        return [b'']
+
+
+class TestTempAuth(unittest.TestCase):
+
+    def setUp(self):
+        self.memcache = FakeMemcache()
+        self.app = FakeApp()
+        conf = {'user_test_tester': 'testing .admin',
+                'negative_cache_ttl': '0.1'}
+        # two workers, sharing the memcache
+        self.issuer = TempAuth(self.app, conf)
+        self.validator = TempAuth(self.app, conf)
+
+    def call(self, auth, path=PATH, **headers):
+        env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+               'SCRIPT_NAME': '', 'QUERY_STRING': '',
+               'HTTP_HOST': 'localhost', 'wsgi.input': io.BytesIO(),
+               'swift.cache': self.memcache}
+        env.update(('HTTP_' + name.upper(), value)
+                   for name, value in headers.items())
+        captured = []
+        b''.join(auth(env, lambda s, h, exc_info=None:
+                      captured.extend([s, dict(h)])))
+        return captured[0], captured[1]
+
+    def get_token(self):
+        status, headers = self.call(self.issuer, '/auth/v1.0',
+                                    x_auth_user='test:tester',
+                                    x_auth_key='testing')
+        self.assertEqual(status, '200 OK')
+        return headers['X-Auth-Token']
+
+    def test_token_validated_by_another_worker(self):
+        token = self.get_token()
+        gets = self.memcache.gets
+        status, _headers = self.call(self.validator, x_auth_token=token)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.app.users,
+                         ['test:tester,test,AUTH_test'])
+        self.assertEqual(self.memcache.gets, gets + 1)
+        # from then on it is validated from the worker's own cache
+        for _junk in range(3):
+            self.assertEqual(self.call(self.validator,
+                                       x_auth_token=token)[0], '200 OK')
+        self.assertEqual(self.memcache.gets, gets + 1)
+
+    def test_issuing_reuses_the_users_token(self):
+        self.assertEqual(self.get_token(), self.get_token())
+
+    def test_bad_token_is_remembered(self):
+        status, _headers = self.call(self.validator,
+                                     x_auth_token='AUTH_tkbogus')
+        self.assertEqual(status, '401 Unauthorized')
+        self.assertEqual(self.memcache.gets, 1)
+        # answered from bad_tokens, with no second lookup
+        status, _headers = self.call(self.validator,
+                                     x_auth_token='AUTH_tkbogus')
+        self.assertEqual(status, '401 Unauthorized')
+        self.assertEqual(self.memcache.gets, 1)
+        self.assertEqual(self.app.users, [])
+        # for negative_cache_ttl only
+        time.sleep(0.15)
+        self.call(self.validator, x_auth_token='AUTH_tkbogus')
+        self.assertEqual(self.memcache.gets, 2)
+
+    def test_entry_expires_with_its_token(self):
+        token = 'AUTH_tkshortlived'
+        cache_key = self.validator._cache_key(token)
+        self.memcache.set(cache_key,
+                          (time.time() + 0.2, 'test:tester,test,AUTH_test'))
+        self.assertEqual(self.call(self.validator, x_auth_token=token)[0],
+                         '200 OK')
+        self.assertIsNotNone(self.validator.tokens.get(cache_key))
+        time.sleep(0.25)
+        # gone from the worker's cache, and memcache's copy is stale too
+        self.assertIsNone(self.validator.tokens.get(cache_key))
+        self.assertEqual(self.call(self.validator, x_auth_token=token)[0],
+                         '401 Unauthorized')
+
+    def test_no_token(self):
+        status, headers = self.call(self.validator)
+        self.assertEqual(status, '401 Unauthorized')
+        self.assertEqual(headers['Www-Authenticate'],
+                         'Swift realm="AUTH_"')
+        self.assertEqual(self.memcache.gets, 0)
+
+    def test_bad_key(self):
+        status, _headers = self.call(self.issuer, '/auth/v1.0',
+                                     x_auth_user='test:tester',
+                                     x_auth_key='wrong')
+        self.assertEqual(status, '401 Unauthorized')
+
+
+if __name__ == '__main__':
+    unittest.main()
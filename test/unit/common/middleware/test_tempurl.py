@@ -0,0 +1,100 @@
+"""
+Tests for swift.common.middleware.tempurl in front of tempauth, as in the
+example pipeline.
+
+Usage: python -m unittest test.unit.common.middleware.test_tempurl
+"""
+import hmac
+import io
+import time
+import unittest
+from hashlib import sha1
+
+from swift.common.middleware.tempauth import TempAuth
+from swift.common.middleware.tempurl import TempURL
+
+PATH = '/v1/AUTH_test/c/o'
+
+
+class FakeBackend(object):
+    """Answers every request, an account HEAD with its temp URL key."""
+
+    def __init__(self, key='secret'):
+        self.key = key
+        self.calls = []
+
+    def __call__(self, env, start_response):
+        self.calls.append((env['REQUEST_METHOD'], env['PATH_INFO']))
+        headers = [('Content-Length', '0')]
+        if env['PATH_INFO'] == '/v1/AUTH_test' and self.key:
+            headers.append(('X-Account-Meta-Temp-URL-Key', self.key))
+        start_response('200 OK', headers)
+        return [b'']
+
+
+def sign(key, method='GET', path=PATH, expires=None):
+    expires = expires or int(time.time() + 60)
+    sig = hmac.new(key.encode('ascii'), ('%s\n%s\n%s' % (
+        method, expires, path)).encode('ascii'), sha1).hexdigest()
+    return 'temp_url_sig=%s&temp_url_expires=%d' % (sig, expires)
+
+
+def call(app, query_string, method='GET', path=PATH, **env):
+    env.update({'REQUEST_METHOD': method, 'PATH_INFO': path,
+                'QUERY_STRING': query_string, 'SCRIPT_NAME': '',
+                'wsgi.input': io.BytesIO()})
+    status = []
+    body = b''.join(app(env, lambda s, h, exc_info=None: status.append(s)))
+    return status[0], body
+
+
+class TestTempURL(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.app = TempURL(TempAuth(self.backend, {}), {},
+                           methods=['GET', 'HEAD', 'PUT'])
+
+    def test_valid_through_tempauth(self):
+        status, _body = call(self.app, sign('secret'))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.backend.calls[-1], ('GET', PATH))
+
+    def test_client_token_does_not_spoil_key_lookup(self):
+        status, _body = call(self.app, sign('secret'),
+                             HTTP_X_AUTH_TOKEN='AUTH_tkbogus')
+        self.assertEqual(status[:3], '401')
+        # the key lookup was not refused, only the request
+        self.assertIn(('HEAD', '/v1/AUTH_test'), self.backend.calls)
+        self.assertEqual(call(self.app, sign('secret'))[0], '200 OK')
+
+    def test_wrong_key(self):
+        status, _body = call(self.app, sign('other'))
+        self.assertEqual(status, '401 Unauthorized')
+        self.assertNotIn(('GET', PATH), self.backend.calls)
+
+    def test_expired(self):
+        status, _body = call(self.app, sign('secret', expires=1))
+        self.assertEqual(status, '401 Unauthorized')
+
+    def test_not_hex_sig(self):
+        expires = int(time.time() + 60)
+        for sig in (u'\u00e9' * 40, 'g' * 40, 'A' * 40):
+            status, _body = call(self.app, u'temp_url_sig=%s&'
+                                 u'temp_url_expires=%d' % (sig, expires))
+            self.assertEqual(status, '401 Unauthorized')
+
+    def test_refused_key_lookup_is_not_cached(self):
+        def refusing(env, start_response):
+            start_response('401 Unauthorized', [('Content-Length', '0')])
+            return [b'']
+        app = TempURL(refusing, {}, methods=['GET'])
+        self.assertEqual(call(app, sign('secret'))[0],
+                         '401 Unauthorized')
+        self.assertEqual(len(app.key_cache), 0)
+        app.app = self.backend
+        self.assertEqual(call(app, sign('secret'))[0], '200 OK')
+
+
+if __name__ == '__main__':
+    unittest.main()
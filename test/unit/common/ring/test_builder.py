@@ -0,0 +1,112 @@
+"""
+Tests for swift.common.ring.builder: every device getting its share of a
+ring's partitions, in different zones, and rings too small for that.
+
+Usage: python -m unittest test.unit.common.ring.test_builder
+"""
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import islice
+
+from swift.common.ring import Ring, build_ring
+
+
+def make_devs(count, zones=8, weight=100):
+    return [{'ip': '10.0.%d.%d' % (i // 250, i % 250), 'port': 6200,
+             'device': 'sd%d' % i, 'zone': i % zones, 'weight': weight}
+            for i in range(count)]
+
+
+def dealt(ring):
+    counts = collections.Counter()
+    for row in ring._replica2part2dev_id:
+        counts.update(row)
+    return counts
+
+
+class TestBuildRing(unittest.TestCase):
+
+    def assertBalanced(self, ring, devs):
+        counts = dealt(ring)
+        total = float(sum(dev['weight'] for dev in devs))
+        slots = ring.partition_count * ring.replica_count
+        for dev in devs:
+            share = slots * dev['weight'] / total
+            self.assertLessEqual(abs(counts[dev['id']] - share),
+                                 max(2, share / 32), dev)
+
+    def test_every_device_gets_its_share(self):
+        devs = make_devs(20000)
+        ring = build_ring(devs, 16, 3)
+        self.assertEqual(len(dealt(ring)), 20000)
+        self.assertBalanced(ring, ring.devs)
+
+    def test_weights(self):
+        devs = make_devs(300)
+        for dev in devs[:100]:
+            dev['weight'] = 300
+        devs[100]['weight'] = 1
+        devs[101]['weight'] = 0
+        ring = build_ring(devs, 16, 3)
+        self.assertBalanced(ring, ring.devs)
+        counts = dealt(ring)
+        self.assertTrue(counts[100])
+        self.assertFalse(counts[101])
+
+    def test_replicas_in_different_zones(self):
+        ring = build_ring(make_devs(50, zones=5), 12, 3)
+        for part in range(ring.partition_count):
+            zones = set(ring.devs[row[part]]['zone']
+                        for row in ring._replica2part2dev_id)
+            self.assertEqual(len(zones), 3)
+
+    def test_handoffs_in_other_zones(self):
+        # the handoff search walks the partitions 16 apart in a ring this
+        # big; it must not fall into step with the rounds dealt
+        swift_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, swift_dir)
+        build_ring(make_devs(200), 20, 3).save(
+            os.path.join(swift_dir, 'object.ring'))
+        ring = Ring(swift_dir)
+        for part in range(0, ring.partition_count, 10007):
+            zones = [node['zone'] for node in ring.get_part_nodes(part)]
+            zones.extend(node['zone'] for node in
+                         islice(ring.get_more_nodes(part), 5))
+            self.assertEqual(len(set(zones)), 8)
+
+    def test_fewer_zones_than_replicas(self):
+        ring = build_ring(make_devs(10, zones=2), 10, 3)
+        for part in range(ring.partition_count):
+            ids = [row[part] for row in ring._replica2part2dev_id]
+            self.assertEqual(len(set(ids)), 3)
+            self.assertEqual(len(set(ring.devs[i]['zone'] for i in ids)), 2)
+
+    def test_fewer_devices_than_replicas(self):
+        ring = build_ring(make_devs(2), 8, 3)
+        for part in range(ring.partition_count):
+            self.assertEqual(
+                set(row[part] for row in ring._replica2part2dev_id),
+                set([0, 1]))
+
+    def test_too_few_partitions_for_every_device(self):
+        # 4096 partitions of 3 replicas go round 12288 of them
+        ring = build_ring(make_devs(20000), 12, 3)
+        counts = dealt(ring)
+        self.assertEqual(len(counts), 12288)
+        self.assertEqual(set(counts.values()), set([1]))
+
+    def test_bad_devices(self):
+        self.assertRaises(ValueError, build_ring, [], 8, 3)
+        self.assertRaises(ValueError, build_ring, make_devs(65536), 8, 3)
+        self.assertRaises(ValueError, build_ring, make_devs(3, weight=0),
+                          8, 3)
+        devs = make_devs(3)
+        devs[0]['weight'] = -1
+        self.assertRaises(ValueError, build_ring, devs, 8, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+Tests for the asyncio server backend, serving the example pipeline of
+etc/proxy-server.conf from a worker process in front of a stand-in
+storage node (see test/stand_in_storage.py).
+
+Usage: python -m unittest test.unit.common.test_asyncio_server
+"""
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import eventlet
+from eventlet import wsgi
+from eventlet.green import socket as green_socket
+
+if sys.version_info < (3,):
+    from eventlet.green.httplib import HTTPConnection
+else:
+    from eventlet.green.http.client import HTTPConnection
+
+from test.stand_in_storage import StandInStorage
+
+REPO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+RUN = ("import sys; from swift.common.wsgi import run_wsgi; "
+       "sys.exit(run_wsgi(sys.argv[1], 'proxy-server'))")
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def example_conf(port, backend_port, access_log, flush_interval):
+    """etc/proxy-server.conf with its example pipeline, on the backend."""
+    with open(os.path.join(REPO, 'etc', 'proxy-server.conf')) as fp:
+        lines = fp.read().split('\n')
+    conf = []
+    for line in lines:
+        if line.startswith('bind_port ='):
+            line = 'bind_port = %d\nserver_backend = asyncio' % port
+        elif line.startswith('# pipeline = '):
+            line = line[2:]
+        elif line.startswith('pipeline = '):
+            continue
+        elif line.startswith('backend_nodes ='):
+            line = 'backend_nodes = 127.0.0.1:%d/sda' % backend_port
+        elif line.startswith('replicas ='):
+            line = 'replicas = 1'
+        elif line == 'use = egg:swift#proxy_logging':
+            line += '\naccess_log_path = %s\naccess_log_flush_interval = %s' \
+                % (access_log, flush_interval)
+        elif line == 'use = egg:swift#tempauth':
+            line += '\nuser_test_tester = testing .admin'
+        conf.append(line)
+    return '\n'.join(conf)
+
+
+class ExamplePipelineTestCase(unittest.TestCase):
+
+    flush_interval = 1
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        listener = eventlet.listen(('127.0.0.1', 0))
+        backend = eventlet.spawn(wsgi.server, listener, StandInStorage(),
+                                 log=open(os.devnull, 'w'))
+        # started, so it can be killed
+        eventlet.sleep(0)
+        self.addCleanup(backend.kill)
+        self.port = free_port()
+        self.access_log = os.path.join(self.tmpdir, 'access.log')
+        conf_path = os.path.join(self.tmpdir, 'proxy-server.conf')
+        with open(conf_path, 'w') as fp:
+            fp.write(example_conf(self.port, listener.getsockname()[1],
+                                  self.access_log, self.flush_interval))
+        self.server = subprocess.Popen(
+            [sys.executable, '-c', RUN, conf_path], cwd=REPO,
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        self.addCleanup(self.stop)
+        deadline = time.time() + 10
+        while True:
+            try:
+                green_socket.create_connection(
+                    ('127.0.0.1', self.port)).close()
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                eventlet.sleep(0.05)
+
+    def stop(self):
+        if self.server.poll() is None:
+            self.server.send_signal(signal.SIGTERM)
+        deadline = time.time() + 10
+        while self.server.poll() is None:
+            if time.time() > deadline:
+                self.server.kill()
+            eventlet.sleep(0.05)
+
+    def request(self, method, path, headers=None, body=None):
+        conn = HTTPConnection('127.0.0.1', self.port)
+        try:
+            conn.request(method, path, body, headers or {})
+            resp = conn.getresponse()
+            return resp.status, dict(resp.getheaders()), resp.read()
+        finally:
+            conn.close()
+
+    def logged(self):
+        if not os.path.exists(self.access_log):
+            return []
+        with open(self.access_log) as fp:
+            return fp.read().splitlines()
+
+    def requests_logged(self):
+        """``(method, path, status)`` of each line logged."""
+        requests = []
+        for line in self.logged():
+            fields = line.split()
+            requests.append((fields[3], fields[4], fields[6]))
+        return requests
+
+
+@unittest.skipIf(sys.version_info < (3,), 'asyncio needs Python 3')
+class TestAccessLog(ExamplePipelineTestCase):
+
+    flush_interval = 0.2
+
+    def test_written_while_serving(self):
+        status, headers, _body = self.request(
+            'GET', '/auth/v1.0', {'X-Auth-User': 'test:tester',
+                                  'X-Auth-Key': 'testing'})
+        self.assertEqual(status, 200)
+        token = {'X-Auth-Token': headers['X-Auth-Token']}
+        self.assertEqual(self.request('PUT', '/v1/AUTH_test/c', token)[0],
+                         201)
+        self.assertEqual(self.request('PUT', '/v1/AUTH_test/c/o', token,
+                                      b'data')[0], 201)
+        status, _headers, body = self.request('GET', '/v1/AUTH_test/c/o',
+                                              token)
+        self.assertEqual((status, body), (200, b'data'))
+        self.assertEqual(self.request('GET', '/v1/AUTH_test/c/o')[0], 401)
+        expected = [('GET', '/auth/v1.0', '200'),
+                    ('PUT', '/v1/AUTH_test/c', '201'),
+                    ('PUT', '/v1/AUTH_test/c/o', '201'),
+                    ('GET', '/v1/AUTH_test/c/o', '200'),
+                    ('GET', '/v1/AUTH_test/c/o', '401')]
+        # written by the flusher, with the server still running
+        deadline = time.time() + 5
+        while not set(expected) <= set(self.requests_logged()) and \
+                time.time() < deadline:
+            eventlet.sleep(0.1)
+        for request in expected:
+            self.assertIn(request, self.requests_logged())
+        self.assertIsNone(self.server.poll())
+
+
+@unittest.skipIf(sys.version_info < (3,), 'asyncio needs Python 3')
+class TestAccessLogOnShutdown(ExamplePipelineTestCase):
+
+    flush_interval = 60
+
+    def test_written_as_the_worker_exits(self):
+        self.assertEqual(self.request('GET', '/v1/AUTH_test/c/o')[0], 401)
+        eventlet.sleep(0.5)
+        self.assertEqual(self.logged(), [])
+        self.stop()
+        self.assertEqual(self.server.returncode, 0)
+        self.assertEqual(self.requests_logged(),
+                         [('GET', '/v1/AUTH_test/c/o', '401')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+"""
+Tests for swift.common.memcached against fake memcached servers run in
+this process.
+
+Usage: python -m unittest test.unit.common.test_memcached
+"""
+import socket
+import unittest
+
+import eventlet
+
+from swift.common import memcached
+from swift.common.middleware.memcache import MemcacheMiddleware
+
+
+class FakeMemcached(object):
+    """
+    Speaks enough of the memcache text protocol for the client: get (of
+    several keys), set, add, incr, decr and delete. Counts the connections
+    it accepts and the commands of each kind it answers.
+    """
+
+    def __init__(self):
+        self.store = {}
+        self.connections = 0
+        self.socks = set()
+        self.commands = {}
+        self.listener = eventlet.listen(('127.0.0.1', 0))
+        self.server = '127.0.0.1:%d' % self.listener.getsockname()[1]
+        self._thread = eventlet.spawn(self._accept)
+
+    def stop(self):
+        """Stops listening and drops every open connection."""
+        self._thread.kill()
+        self.listener.close()
+        for sock in list(self.socks):
+            # close() alone leaves it open while _serve's file holds it
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+    def _accept(self):
+        while True:
+            sock, _addr = self.listener.accept()
+            self.connections += 1
+            self.socks.add(sock)
+            eventlet.spawn_n(self._serve, sock)
+
+    def _serve(self, sock):
+        fp = sock.makefile('rb')
+        try:
+            while True:
+                line = fp.readline()
+                if not line:
+                    return
+                parts = line.split()
+                command = parts[0].decode('ascii')
+                self.commands[command] = self.commands.get(command, 0) + 1
+                if command == 'get':
+                    reply = []
+                    for key in parts[1:]:
+                        if key in self.store:
+                            flags, data = self.store[key]
+                            reply.append(b'VALUE ' + key + (
+                                ' %d %d\r\n' % (flags, len(data))).encode(
+                                    'ascii') + data + b'\r\n')
+                    sock.sendall(b''.join(reply) + b'END\r\n')
+                elif command in ('set', 'add'):
+                    key, flags, size = parts[1], parts[2], parts[4]
+                    data = fp.read(int(size) + 2)[:-2]
+                    if command == 'add' and key in self.store:
+                        sock.sendall(b'NOT_STORED\r\n')
+                        continue
+                    self.store[key] = (int(flags), data)
+                    sock.sendall(b'STORED\r\n')
+                elif command in ('incr', 'decr'):
+                    key, delta = parts[1], int(parts[2])
+                    if key not in self.store:
+                        sock.sendall(b'NOT_FOUND\r\n')
+                        continue
+                    value = int(self.store[key][1])
+                    value = value + delta if command == 'incr' else \
+                        max(0, value - delta)
+                    self.store[key] = (0, str(value).encode('ascii'))
+                    sock.sendall(str(value).encode('ascii') + b'\r\n')
+                elif command == 'delete':
+                    found = self.store.pop(parts[1], None) is not None
+                    sock.sendall(b'DELETED\r\n' if found else
+                                 b'NOT_FOUND\r\n')
+        except (IOError, OSError, ValueError):
+            pass
+        finally:
+            self.socks.discard(sock)
+            sock.close()
+
+
+def dead_server():
+    """Returns the address of a port nothing listens on."""
+    sock = eventlet.listen(('127.0.0.1', 0))
+    server = '127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    return server
+
+
+class TestMemcacheRing(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakeMemcached() for _ in range(3)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def ring(self, servers=None, **kwargs):
+        return memcached.MemcacheRing(
+            [s.server for s in (servers or self.servers)], **kwargs)
+
+    def test_set_get(self):
+        ring = self.ring(lru_size=0)
+        ring.set('some_key', [1, 2, 3])
+        self.assertEqual(ring.get('some_key'), [1, 2, 3])
+        ring.set('some_key', {'a': 'b'})
+        self.assertEqual(ring.get('some_key'), {'a': 'b'})
+        self.assertIsNone(ring.get('not_there'))
+        ring.delete('some_key')
+        self.assertIsNone(ring.get('some_key'))
+
+    def test_lru_returns_what_memcache_would(self):
+        cached = self.ring()
+        uncached = self.ring(lru_size=0)
+        cached.set('raw', 'abc', serialize=False)
+        cached.set('json', {'count': 1})
+        # the first answer is from the LRU, the second from memcache
+        self.assertEqual(cached.get('raw'), uncached.get('raw'))
+        self.assertEqual(type(cached.get('raw')), type(uncached.get('raw')))
+        self.assertEqual(cached.get('raw'), b'abc')
+        self.assertEqual(cached.get('json'), uncached.get('json'))
+        cached.set_multi({'m1': 5, 'm2': 'x'}, serialize=False)
+        self.assertEqual(cached.get_multi(['m1', 'm2']),
+                         uncached.get_multi(['m1', 'm2']))
+        self.assertEqual(cached.get_multi(['m1', 'm2']), [b'5', b'x'])
+
+    def test_lru_hits_are_copies(self):
+        ring = self.ring()
+        ring.set('info', {'object_count': 1})
+        ring.get('info')['object_count'] = 100
+        self.assertEqual(ring.get('info'), {'object_count': 1})
+
+    def test_lru_answers_without_memcache(self):
+        ring = self.ring()
+        ring.set('hot', 'value')
+        gets = sum(s.commands.get('get', 0) for s in self.servers)
+        for _ in range(10):
+            self.assertEqual(ring.get('hot'), 'value')
+        self.assertEqual(
+            sum(s.commands.get('get', 0) for s in self.servers), gets)
+
+    def test_lru_ttl(self):
+        ring = self.ring(lru_ttl=0.01)
+        ring.set('key', 'old')
+        for server in self.servers:
+            for hashed, (flags, data) in server.store.items():
+                server.store[hashed] = (flags, b'"new"')
+        self.assertEqual(ring.get('key'), 'old')
+        eventlet.sleep(0.02)
+        self.assertEqual(ring.get('key'), 'new')
+
+    def test_incr_decr(self):
+        ring = self.ring()
+        self.assertEqual(ring.incr('counter'), 1)
+        self.assertEqual(ring.incr('counter', delta=10), 11)
+        self.assertEqual(ring.decr('counter', delta=4), 7)
+        self.assertEqual(ring.decr('other', delta=4), 0)
+        ring.set('counter', '3', serialize=False)
+        self.assertEqual(ring.get('counter'), b'3')
+        self.assertEqual(ring.incr('counter'), 4)
+        # incr drops the LRU entry, so the next get sees the new count
+        self.assertEqual(ring.get('counter'), b'4')
+
+    def test_multi_is_batched_per_server(self):
+        ring = self.ring(lru_size=0)
+        mapping = dict(('key%d' % i, i) for i in range(30))
+        ring.set_multi(mapping)
+        self.assertEqual(
+            sum(s.commands.get('set', 0) for s in self.servers), 30)
+        values = ring.get_multi(['key%d' % i for i in range(30)] + ['nope'])
+        self.assertEqual(values, list(range(30)) + [None])
+        used = [s for s in self.servers if s.commands.get('get')]
+        self.assertTrue(len(used) > 1)
+        for server in used:
+            self.assertEqual(server.commands['get'], 1)
+
+    def test_server_key_keeps_keys_together(self):
+        ring = self.ring(lru_size=0)
+        ring.set_multi(dict(('key%d' % i, i) for i in range(10)),
+                       server_key='account')
+        self.assertEqual(
+            sorted(len(s.store) for s in self.servers), [0, 0, 10])
+        self.assertEqual(ring.get_multi(['key1', 'key9'],
+                                        server_key='account'), [1, 9])
+
+    def test_adding_a_server_moves_few_keys(self):
+        keys = ['key%d' % i for i in range(1000)]
+        before = self.ring(self.servers[:2])
+        after = self.ring()
+
+        def first_server(ring, key):
+            return next(ring._servers_for(memcached.md5hash(key)))
+        moved = [key for key in keys
+                 if first_server(before, key) != first_server(after, key)]
+        # a third of the keys should move, all of them to the new server
+        self.assertTrue(200 < len(moved) < 500, len(moved))
+        for key in moved:
+            self.assertEqual(first_server(after, key),
+                             self.servers[2].server)
+
+    def test_connections_are_pooled(self):
+        ring = self.ring(lru_size=0, pool_size=2)
+        pile = eventlet.GreenPile(20)
+        for i in range(200):
+            pile.spawn(ring.set, 'key%d' % (i % 10), i)
+        list(pile)
+        for server in self.servers:
+            self.assertTrue(server.connections <= 2, server.connections)
+
+    def test_dead_server_fails_over(self):
+        dead = dead_server()
+        ring = memcached.MemcacheRing(
+            [dead] + [s.server for s in self.servers], lru_size=0)
+        for i in range(200):
+            ring.set('key%d' % i, i)
+        for i in range(200):
+            self.assertEqual(ring.get('key%d' % i), i)
+        self.assertTrue(ring._error_limited[dead] > 0)
+
+    def test_failed_reconnects_give_back_their_slots(self):
+        server = self.servers[0]
+        ring = self.ring([server], lru_size=0, pool_size=2, io_timeout=0.5)
+        pile = eventlet.GreenPile()
+        for _ in range(4):
+            pile.spawn(ring.set, 'key', 'value')
+        list(pile)
+        server.stop()
+        # each broken connection leaves a slot for a new one, which cannot
+        # connect
+        for _ in range(6):
+            ring._error_limited[server.server] = 0
+            with eventlet.Timeout(1):
+                self.assertIsNone(ring.get('key'))
+        self.assertEqual(ring._pools[server.server].free(), 2)
+
+    def test_all_servers_down(self):
+        ring = memcached.MemcacheRing([dead_server()], lru_size=0)
+        self.assertIsNone(ring.get('key'))
+        ring.set('key', 'value')
+        self.assertRaises(memcached.MemcacheConnectionError,
+                          ring.incr, 'key')
+
+
+class TestMemcacheMiddleware(unittest.TestCase):
+
+    def test_publishes_cache(self):
+        server = FakeMemcached()
+        self.addCleanup(server.stop)
+        seen = []
+
+        def app(env, start_response):
+            seen.append(env['swift.cache'])
+            return []
+        middleware = MemcacheMiddleware(app, {
+            'memcache_servers': server.server, 'memcache_lru_size': '0'})
+        middleware({}, None)
+        seen[0].set('key', 'value')
+        self.assertEqual(seen[0].get('key'), 'value')
+        self.assertEqual(server.commands['get'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
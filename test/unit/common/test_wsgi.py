@@ -0,0 +1,90 @@
+"""
+Tests for the pre-forking worker supervisor of swift.common.wsgi: how
+workers that die as they start are respawned.
+
+Usage: python -m unittest test.unit.common.test_wsgi
+"""
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from swift.common import wsgi
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestRunWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGINT,
+                       signal.SIGUSR1):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        self.logger = logging.getLogger('test_wsgi')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = RecordingHandler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        backoff = wsgi.RESPAWN_BACKOFF
+        self.addCleanup(setattr, wsgi, 'RESPAWN_BACKOFF', backoff)
+        wsgi.RESPAWN_BACKOFF = 0.1
+
+    def run_workers(self, **conf):
+        # no such file: each worker dies as it loads the pipeline
+        conf.setdefault('__file__', os.path.join(self.tmpdir, 'missing'))
+        start = time.time()
+        status = wsgi.run_workers(conf, self.logger, sock=object())
+        return status, time.time() - start
+
+    def test_workers_dying_at_startup_back_off_then_stop(self):
+        status, took = self.run_workers(max_startup_failures='4')
+        self.assertEqual(status, 1)
+        respawns = [msg for msg in self.handler.messages
+                    if 'respawning in' in msg]
+        self.assertEqual([msg.rsplit(' ', 1)[1] for msg in respawns],
+                         ['0.1s', '0.2s', '0.4s'])
+        # each respawn waited for its backoff
+        self.assertGreaterEqual(took, 0.1 + 0.2 + 0.4)
+        self.assertEqual(len([msg for msg in self.handler.messages
+                              if msg.startswith('Started child')]), 4)
+        self.assertIn('4 workers in a row died within 10.0s of starting, '
+                      'stopping', self.handler.messages)
+
+    def test_backoff_is_capped(self):
+        cap = wsgi.MAX_RESPAWN_BACKOFF
+        self.addCleanup(setattr, wsgi, 'MAX_RESPAWN_BACKOFF', cap)
+        wsgi.MAX_RESPAWN_BACKOFF = 0.2
+        self.assertEqual(self.run_workers(max_startup_failures='5')[0], 1)
+        self.assertEqual([msg.rsplit(' ', 1)[1]
+                          for msg in self.handler.messages
+                          if 'respawning in' in msg],
+                         ['0.1s', '0.2s', '0.2s', '0.2s'])
+
+    def test_workers_that_started_are_respawned_at_once(self):
+        # never given up on, so it is stopped from the outside
+        threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        status = self.run_workers(worker_startup_time='0',
+                                  max_startup_failures='1')[0]
+        self.assertEqual(status, 0)
+        self.assertFalse([msg for msg in self.handler.messages
+                          if 'respawning in' in msg])
+        self.assertGreater(len([msg for msg in self.handler.messages
+                                if msg.startswith('Started child')]), 2)
+
+if __name__ == '__main__':
+    unittest.main()
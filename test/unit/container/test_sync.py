@@ -0,0 +1,232 @@
+"""
+Tests for container sync, both ends: swift.container.sync pushing to a
+stand-in destination cluster on localhost, and the
+swift.common.middleware.container_sync filter checking what it is sent.
+
+Usage: python -m unittest test.unit.container.test_sync
+"""
+import io
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import eventlet
+from eventlet import wsgi
+
+from swift.common.connection_pool import HTTPConnPool
+from swift.common.container_sync_realms import ContainerSyncRealms
+from swift.common.middleware.container_sync import ContainerSync
+from swift.common.middleware.tempauth import TempAuth
+from swift.container.sync import ContainerSyncWorker, RowSource
+
+SYNC_KEY = 'containerkey'
+REALM_KEY = 'realmkey'
+
+
+class MemoryRowSource(RowSource):
+
+    def __init__(self, names, deleted=()):
+        self.rows = [{'ROWID': i, 'name': name, 'created_at': '%d' % i,
+                      'deleted': int(name in deleted)}
+                     for i, name in enumerate(names)]
+        self.sync_point = -1
+
+    def get_sync_point(self):
+        return self.sync_point
+
+    def set_sync_point(self, rowid):
+        self.sync_point = rowid
+
+    def get_items_since(self, rowid, count):
+        return self.rows[rowid + 1:rowid + 1 + count]
+
+    def get_object(self, name):
+        body = name.encode('utf-8')
+        return {'Content-Length': str(len(body))}, [body]
+
+
+class StandInCluster(object):
+    """
+    The object store of the destination, behind container sync and
+    tempauth; refuses PUTs of objects named in ``refuse``.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.refuse = set()
+
+    def __call__(self, env, start_response):
+        path = env['PATH_INFO']
+        method = env['REQUEST_METHOD']
+        if method == 'HEAD' and path.count('/') == 3:
+            start_response('204 No Content', [
+                ('X-Container-Sync-Key', SYNC_KEY)])
+        elif method == 'PUT' and path.rsplit('/', 1)[1] in self.refuse:
+            start_response('503 Service Unavailable',
+                           [('Content-Length', '0')])
+        elif method == 'PUT':
+            self.objects[path] = env['wsgi.input'].read()
+            start_response('201 Created', [('Content-Length', '0')])
+        elif method == 'DELETE':
+            found = self.objects.pop(path, None) is not None
+            start_response('204 No Content' if found else '404 Not Found',
+                           [('Content-Length', '0')])
+        return [b'']
+
+
+class SyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.swift_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.swift_dir)
+        self.logger = logging.getLogger('test_sync')
+        self.logger.disabled = True
+        self.cluster = StandInCluster()
+        self.app = ContainerSync(TempAuth(self.cluster, {}),
+                                 {'swift_dir': self.swift_dir})
+        self.listener = eventlet.listen(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.server = eventlet.spawn(wsgi.server, self.listener, self.app,
+                                     log=open(os.devnull, 'w'))
+        # started, so it can be killed
+        eventlet.sleep(0)
+        self.addCleanup(self.server.kill)
+        self.write_realms(self.port)
+
+    def write_realms(self, port):
+        with open(os.path.join(self.swift_dir,
+                               'container-sync-realms.conf'), 'w') as fp:
+            fp.write('[realm]\nkey = %s\ncluster_dest = '
+                     'http://127.0.0.1:%d/v1/\n' % (REALM_KEY, port))
+        self.app.realms_conf.reload()
+        self.realms = ContainerSyncRealms(
+            os.path.join(self.swift_dir, 'container-sync-realms.conf'),
+            self.logger)
+
+
+class TestContainerSyncMiddleware(SyncTestCase):
+
+    def call(self, method, path, sig=None, nonce='nonce', timestamp='1'):
+        if sig is None:
+            sig = self.realms.get_sig(method, path, timestamp, nonce,
+                                      REALM_KEY, SYNC_KEY)
+        env = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'QUERY_STRING': '', 'SCRIPT_NAME': '',
+               'CONTENT_LENGTH': '4', 'wsgi.input': io.BytesIO(b'data'),
+               'HTTP_X_TIMESTAMP': timestamp,
+               'HTTP_X_CONTAINER_SYNC_AUTH': 'realm %s %s' % (nonce, sig)}
+        status = []
+        body = b''.join(self.app(env, lambda s, h, exc_info=None:
+                                 status.append(s)))
+        return status[0], body
+
+    def test_signed_request_gets_through_tempauth(self):
+        status, _body = self.call('PUT', '/v1/AUTH_b/c/o')
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(self.cluster.objects['/v1/AUTH_b/c/o'], b'data')
+
+    def test_bad_signature(self):
+        status, body = self.call('PUT', '/v1/AUTH_b/c/o', sig='0' * 40)
+        self.assertEqual(status, '401 Unauthorized')
+        self.assertIn(b'bad signature', body)
+        self.assertEqual(self.cluster.objects, {})
+
+    def test_not_hex_signature(self):
+        for sig in (u'\u00e9' * 40, 'G' * 40):
+            status, body = self.call('PUT', '/v1/AUTH_b/c/o', sig=sig)
+            self.assertEqual(status, '401 Unauthorized')
+            self.assertIn(b'bad signature', body)
+
+    def test_unsigned_request_is_left_to_auth(self):
+        env = {'REQUEST_METHOD': 'PUT', 'PATH_INFO': '/v1/AUTH_b/c/o',
+               'QUERY_STRING': '', 'SCRIPT_NAME': '',
+               'wsgi.input': io.BytesIO()}
+        status = []
+        b''.join(self.app(env, lambda s, h, exc_info=None:
+                          status.append(s)))
+        self.assertEqual(status, ['401 Unauthorized'])
+
+
+class TestContainerSyncWorker(SyncTestCase):
+
+    def worker(self, **kwargs):
+        kwargs.setdefault('conn_timeout', 0.5)
+        kwargs.setdefault('node_timeout', 2)
+        return ContainerSyncWorker(self.realms, self.logger, **kwargs)
+
+    def test_sync(self):
+        names = ['o%d' % i for i in range(50)]
+        source = MemoryRowSource(names)
+        worker = self.worker(batch_size=7, conns_per_destination=4)
+        self.assertTrue(worker.sync_container(
+            source, '//realm/dest/AUTH_b/c', SYNC_KEY))
+        self.assertEqual(sorted(self.cluster.objects),
+                         sorted('/v1/AUTH_b/c/%s' % n for n in names))
+        self.assertEqual(source.sync_point, 49)
+        self.assertEqual(worker.stats['puts'], 50)
+
+    def test_deletes_and_superseded_rows(self):
+        self.cluster.objects['/v1/AUTH_b/c/gone'] = b'old'
+        source = MemoryRowSource(['a', 'gone', 'a', 'never'],
+                                 deleted=('gone', 'never'))
+        worker = self.worker()
+        self.assertTrue(worker.sync_container(
+            source, '//realm/dest/AUTH_b/c', SYNC_KEY))
+        self.assertEqual(sorted(self.cluster.objects), ['/v1/AUTH_b/c/a'])
+        self.assertEqual(worker.stats['skips'], 1)
+        self.assertEqual(worker.stats['deletes'], 2)
+
+    def test_sync_point_stops_before_a_failure(self):
+        source = MemoryRowSource(['o%d' % i for i in range(10)])
+        self.cluster.refuse.add('o6')
+        worker = self.worker(batch_size=4)
+        self.assertFalse(worker.sync_container(
+            source, '//realm/dest/AUTH_b/c', SYNC_KEY))
+        self.assertEqual(source.sync_point, 5)
+        self.cluster.refuse.clear()
+        self.assertTrue(worker.sync_container(
+            source, '//realm/dest/AUTH_b/c', SYNC_KEY))
+        self.assertEqual(source.sync_point, 9)
+        self.assertEqual(len(self.cluster.objects), 10)
+
+    def test_destination_going_away_does_not_hang(self):
+        worker = self.worker(conns_per_destination=2)
+        self.assertTrue(worker.sync_container(
+            MemoryRowSource(['a', 'b', 'c', 'd']),
+            '//realm/dest/AUTH_b/c', SYNC_KEY))
+        # the pooled connections break and new ones cannot be made
+        self.server.kill()
+        self.listener.close()
+        for attempt in range(6):
+            with eventlet.Timeout(5):
+                self.assertFalse(worker.sync_container(
+                    MemoryRowSource(['x%d' % attempt]),
+                    '//realm/dest/AUTH_b/c', SYNC_KEY))
+        dest = worker.destinations[('http', '127.0.0.1:%d' % self.port)]
+        self.assertEqual(dest.conns.free(), 2)
+
+    def test_unknown_cluster(self):
+        self.assertFalse(self.worker().sync_container(
+            MemoryRowSource(['a']), '//realm/nowhere/AUTH_b/c', SYNC_KEY))
+
+
+class TestHTTPConnPool(unittest.TestCase):
+
+    def test_failed_reconnect_gives_back_its_slot(self):
+        listener = eventlet.listen(('127.0.0.1', 0))
+        pool = HTTPConnPool('http', '127.0.0.1:%d' %
+                            listener.getsockname()[1], 1, 0.5, 0.5)
+        conn = pool.get()
+        conn.close()
+        pool.put(None)
+        listener.close()
+        for _ in range(3):
+            with eventlet.Timeout(2):
+                self.assertRaises(socket.error, pool.get)
+        self.assertEqual(pool.free(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+"""
+Tests for the proxy server app against stand-in storage nodes on
+localhost (see test/stand_in_storage.py): which nodes a request goes to
+when others fail, how writes are answered without a quorum, error
+limiting, and what becomes of the connections hedged reads leave behind.
+
+Usage: python -m unittest test.unit.proxy.test_server
+"""
+import hashlib
+import io
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import eventlet
+from eventlet import wsgi
+
+from swift.common.wsgi import run_wsgi
+from swift.proxy.server import Application
+from test.stand_in_storage import StandInStorage
+
+BODY = b'x' * 1024
+
+
+class StandInNode(StandInStorage):
+    """
+    A stand-in storage node that remembers the requests it gets, and
+    answers every one of them with ``status`` when that is set.
+    """
+
+    def __init__(self):
+        StandInStorage.__init__(self)
+        self.status = None
+        self.got = []
+
+    def __call__(self, env, start_response):
+        self.got.append(env['REQUEST_METHOD'])
+        if self.status:
+            env['wsgi.input'].read()
+            if self.latency:
+                eventlet.sleep(self.latency)
+            start_response(self.status, [('Content-Length', '0')])
+            return [b'']
+        return StandInStorage.__call__(self, env, start_response)
+
+    def seed(self, path, body=BODY):
+        self.objects[path.lstrip('/')] = (
+            body, hashlib.md5(body).hexdigest(), '1')
+
+
+class ProxyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('test_proxy')
+        self.logger.disabled = True
+
+    def serve(self, node):
+        listener = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, listener, node,
+                                log=open(os.devnull, 'w'))
+        # started, so it can be killed
+        eventlet.sleep(0)
+        self.addCleanup(server.kill)
+        return listener.getsockname()[1]
+
+    @staticmethod
+    def dead_port():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def make_app(self, nodes, replicas=3, **conf):
+        """
+        A proxy in front of ``nodes``, the first ``replicas`` of them the
+        primaries and the rest handoffs; a None in ``nodes`` is a node
+        that refuses connections.
+        """
+        self.ports = [self.dead_port() if node is None else self.serve(node)
+                      for node in nodes]
+        conf.update(backend_nodes=','.join(
+            '127.0.0.1:%d/sda' % port for port in self.ports),
+            replicas=replicas)
+        return Application(dict((k, str(v)) for k, v in conf.items()),
+                           logger=self.logger)
+
+    @staticmethod
+    def call(app, method, path='/v1/a/c/o', body=b''):
+        env = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'SCRIPT_NAME': '', 'QUERY_STRING': '',
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body)}
+        status = []
+        app_iter = app(env, lambda s, h, exc_info=None: status.append(s))
+        got = b''.join(app_iter)
+        getattr(app_iter, 'close', lambda: None)()
+        return int(status[0][:3]), got
+
+    def node(self, app, index):
+        return app.rings['object'].devs[index]
+
+    def pool(self, app, index):
+        return app.conn_pools['127.0.0.1:%d' % self.ports[index]]
+
+
+class TestReads(ProxyTestCase):
+
+    def test_first_replica_answers(self):
+        nodes = [StandInNode() for _ in range(3)]
+        for node in nodes:
+            node.seed('/a/c/o')
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'GET'), (200, BODY))
+        self.assertEqual([node.got for node in nodes],
+                         [['GET'], [], []])
+
+    def test_404_moves_on_to_the_next_replica(self):
+        nodes = [StandInNode() for _ in range(3)]
+        nodes[1].seed('/a/c/o')
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'GET'), (200, BODY))
+        self.assertEqual([node.got for node in nodes],
+                         [['GET'], ['GET'], []])
+        # a 404 is no error of the node's
+        self.assertFalse(app.node_errors)
+
+    def test_failures_move_on_to_a_handoff(self):
+        failing, handoff = StandInNode(), StandInNode()
+        failing.status = '503 Service Unavailable'
+        handoff.seed('/a/c/o')
+        app = self.make_app([None, failing, handoff], replicas=2)
+        self.assertEqual(self.call(app, 'GET'), (200, BODY))
+        self.assertEqual(failing.got, ['GET'])
+        self.assertEqual(handoff.got, ['GET'])
+        self.assertEqual(sorted(app.node_errors),
+                         ['127.0.0.1:%d/sda' % port
+                          for port in sorted(self.ports[:2])])
+
+    def test_404_when_no_node_has_it(self):
+        nodes = [StandInNode() for _ in range(3)]
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'GET')[0], 404)
+
+    def test_503_when_every_node_fails(self):
+        failing = StandInNode()
+        failing.status = '500 Internal Error'
+        app = self.make_app([None, failing, None])
+        self.assertEqual(self.call(app, 'GET')[0], 503)
+
+    def test_hedged_loser_is_closed(self):
+        slow, fast = StandInNode(), StandInNode()
+        slow.latency = 0.3
+        slow.seed('/a/c/o')
+        fast.seed('/a/c/o')
+        app = self.make_app([slow, fast], replicas=2,
+                            concurrency_timeout=0.05)
+        start = time.time()
+        self.assertEqual(self.call(app, 'GET'), (200, BODY))
+        self.assertLess(time.time() - start, slow.latency)
+        pool = self.pool(app, 0)
+        self.assertEqual(pool.free(), pool.max_size - 1)
+        eventlet.sleep(slow.latency + 0.1)
+        # its response was not read, so its connection is not kept
+        self.assertEqual(pool.free(), pool.max_size)
+        self.assertEqual(list(pool.free_items), [None])
+        # and the fast node's went back to be used again
+        self.assertEqual(len(self.pool(app, 1).free_items), 1)
+        self.assertIsNotNone(self.pool(app, 1).free_items[0])
+
+    def test_without_hedging_the_slow_node_is_waited_for(self):
+        slow, fast = StandInNode(), StandInNode()
+        slow.latency = 0.1
+        slow.seed('/a/c/o')
+        app = self.make_app([slow, fast], replicas=2,
+                            concurrent_gets='false')
+        self.assertEqual(self.call(app, 'GET'), (200, BODY))
+        self.assertEqual(fast.got, [])
+
+
+class TestWrites(ProxyTestCase):
+
+    def test_put_to_every_replica(self):
+        nodes = [StandInNode() for _ in range(4)]
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'PUT', body=BODY)[0], 201)
+        self.assertEqual([node.got for node in nodes],
+                         [['PUT'], ['PUT'], ['PUT'], []])
+
+    def test_put_goes_to_a_handoff_for_an_unreachable_replica(self):
+        nodes = [StandInNode(), None, StandInNode(), StandInNode()]
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'PUT', body=BODY)[0], 201)
+        self.assertEqual(nodes[3].objects['a/c/o'][0], BODY)
+
+    def test_delete_goes_to_a_handoff_for_an_unreachable_replica(self):
+        nodes = [StandInNode(), None, StandInNode(), StandInNode()]
+        for node in nodes:
+            if node:
+                node.seed('/a/c/o')
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'DELETE')[0], 204)
+        self.assertEqual(nodes[3].got, ['DELETE'])
+
+    def test_503_without_a_quorum(self):
+        nodes = [StandInNode() for _ in range(3)]
+        nodes[0].status = nodes[2].status = '503 Service Unavailable'
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'PUT', body=BODY)[0], 503)
+        self.assertEqual(self.call(app, 'DELETE')[0], 503)
+
+    def test_503_without_a_quorum_of_reachable_nodes(self):
+        app = self.make_app([None, StandInNode(), None])
+        self.assertEqual(self.call(app, 'PUT', body=BODY)[0], 503)
+        self.assertEqual(self.call(app, 'POST')[0], 503)
+
+    def test_quorum_is_enough(self):
+        nodes = [StandInNode() for _ in range(3)]
+        nodes[2].status = '503 Service Unavailable'
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'PUT', body=BODY)[0], 201)
+
+
+class TestErrorLimiting(ProxyTestCase):
+
+    def test_507_error_limits_at_once(self):
+        nodes = [StandInNode() for _ in range(3)]
+        nodes[0].status = '507 Insufficient Storage'
+        nodes[1].seed('/a/c/o')
+        app = self.make_app(nodes)
+        self.assertEqual(self.call(app, 'GET')[0], 200)
+        self.assertTrue(app.error_limited(self.node(app, 0)))
+        self.assertEqual(self.call(app, 'GET')[0], 200)
+        self.assertEqual(nodes[0].got, ['GET'])
+        self.assertEqual(nodes[1].got, ['GET', 'GET'])
+
+    def test_repeated_errors_error_limit(self):
+        nodes = [StandInNode() for _ in range(3)]
+        nodes[0].status = '500 Internal Error'
+        nodes[1].seed('/a/c/o')
+        app = self.make_app(nodes, error_suppression_limit=2)
+        for _ in range(3):
+            self.assertEqual(self.call(app, 'GET')[0], 200)
+        self.assertTrue(app.error_limited(self.node(app, 0)))
+        self.assertEqual(self.call(app, 'GET')[0], 200)
+        self.assertEqual(len(nodes[0].got), 3)
+
+    def test_error_limit_passes(self):
+        nodes = [StandInNode() for _ in range(3)]
+        nodes[0].status = '507 Insufficient Storage'
+        app = self.make_app(nodes, error_suppression_interval=0.1)
+        self.call(app, 'GET')
+        self.assertTrue(app.error_limited(self.node(app, 0)))
+        eventlet.sleep(0.2)
+        self.assertFalse(app.error_limited(self.node(app, 0)))
+
+    def test_error_limited_replica_is_written_to_a_handoff(self):
+        nodes = [StandInNode() for _ in range(4)]
+        app = self.make_app(nodes)
+        app.error_limit(self.node(app, 1), 'test')
+        self.assertEqual(self.call(app, 'PUT', body=BODY)[0], 201)
+        self.assertEqual(nodes[1].got, [])
+        self.assertEqual(nodes[3].got, ['PUT'])
+
+
+class TestConnectionPools(ProxyTestCase):
+
+    def test_waiting_for_a_connection_takes_no_slot(self):
+        node = StandInNode()
+        node.seed('/a/c/o')
+        app = self.make_app([node], replicas=1, max_conns_per_node=1,
+                            node_timeout=0.1)
+        pool = self.pool(app, 0)
+        held = pool.get()
+        # no connection comes free in time
+        self.assertEqual(self.call(app, 'GET')[0], 503)
+        pool.put(held)
+        self.assertEqual(pool.free(), 1)
+        self.assertEqual(self.call(app, 'GET'), (200, BODY))
+        self.assertEqual(pool.free(), 1)
+
+    def test_connections_do_not_delay_small_writes(self):
+        app = self.make_app([StandInNode()], replicas=1)
+        conn = self.pool(app, 0).get()
+        self.addCleanup(conn.close)
+        self.assertTrue(conn.sock.getsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_NODELAY))
+
+    def test_failed_connect_takes_no_slot(self):
+        app = self.make_app([None], replicas=1, max_conns_per_node=1)
+        self.assertEqual(self.call(app, 'GET')[0], 503)
+        pool = self.pool(app, 0)
+        self.assertEqual(pool.free(), 1)
+        self.assertEqual(list(pool.free_items), [])
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.swift_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.swift_dir)
+
+    def test_missing_ring_is_a_config_error(self):
+        with self.assertRaises(ValueError) as caught:
+            Application({'swift_dir': self.swift_dir})
+        self.assertIn('account ring', str(caught.exception))
+        self.assertIn('backend_nodes', str(caught.exception))
+
+    def test_server_does_not_start_without_rings(self):
+        with open(os.path.join(os.path.dirname(os.path.dirname(
+                os.path.dirname(os.path.dirname(os.path.abspath(
+                    __file__))))), 'etc', 'proxy-server.conf')) as fp:
+            conf = fp.read()
+        conf = conf.replace('bind_port = 8080', 'bind_port = 0')
+        conf = conf.replace('\nbackend_nodes = ', '\n# backend_nodes = ')
+        conf = conf.replace('# swift_dir = /etc/swift',
+                            'swift_dir = %s' % self.swift_dir)
+        conf_path = os.path.join(self.swift_dir, 'proxy-server.conf')
+        with open(conf_path, 'w') as fp:
+            fp.write(conf)
+        # reported before any worker is forked, which would only die
+        self.assertEqual(run_wsgi(conf_path, 'proxy-server'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()